@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Compares the encoder backends of lib/encoders.py on data/movies.json:
+# query latency (one text per encode call, as a search makes), bulk
+# throughput (description chunks, as embed_chunks encodes them) and the
+# cosine similarity of every backend's embeddings to the torch model's.
+# Export the ONNX models first, then run from the repository root:
+#   python cli/semantic_search_cli.py export_encoder --backend onnx
+#   python cli/semantic_search_cli.py export_encoder --backend onnx-int8
+#   python bench/encoder_bench.py --threads 4
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli"))
+
+import numpy as np
+
+from lib.encoders import DEFAULT_MODEL_NAME, ENCODER_BACKENDS, MIN_PARITY_COSINE, embedding_parity, load_encoder
+from lib.movie import load_movies
+from lib.semantic_search import CHUNK_OVERLAP, CHUNK_SIZE, chunk_semantically
+
+WARMUP_CALLS = 5
+
+
+def chunk_texts(n: int) -> List[str]:
+    texts: List[str] = []
+    for m in load_movies():
+        if m.description:
+            texts.extend(chunk_semantically(m.description, CHUNK_SIZE, CHUNK_OVERLAP))
+        if len(texts) >= n:
+            break
+    return texts[:n]
+
+
+def bench_backend(backend: str, args: argparse.Namespace, queries: List[str], texts: List[str]) -> Dict[str, Any]:
+    start = time.perf_counter()
+    model = load_encoder(args.model, backend, args.encoder_path, args.threads)
+    load_seconds = time.perf_counter() - start
+
+    for q in queries[:WARMUP_CALLS]:
+        model.encode([q])
+    latencies = []
+    query_embeddings = []
+    for q in queries:
+        start = time.perf_counter()
+        query_embeddings.append(model.encode([q])[0])
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    text_embeddings = model.encode(texts, batch_size=args.batch_size)
+    bulk_seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "backend": backend,
+        "load_ms": round(load_seconds * 1000, 1),
+        "query_p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "query_p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 3),
+        "bulk_texts_per_sec": round(len(texts) / bulk_seconds, 1),
+        "embeddings": np.vstack([np.stack(query_embeddings), text_embeddings]),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Encoder backend benchmark")
+    parser.add_argument("--backends", nargs="+", choices=ENCODER_BACKENDS, default=list(ENCODER_BACKENDS))
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL_NAME, help="Model name or local directory, exported with the same name")
+    parser.add_argument("--encoder-path", type=str, help="Directory of the exported ONNX models")
+    parser.add_argument("--threads", type=int, help="Threads per encode call, one per core by default")
+    parser.add_argument("--queries", type=int, default=200, help="Queries encoded one at a time")
+    parser.add_argument("--texts", type=int, default=2000, help="Description chunks encoded in bulk")
+    parser.add_argument("--batch-size", type=int, default=32, help="Texts per batch in the bulk encode")
+    parser.add_argument("--min-cosine", type=float, default=MIN_PARITY_COSINE, help="Fail when a backend's lowest cosine to torch is below this")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    queries = [m.title for m in load_movies()[:args.queries] if m.title.strip()]
+    texts = chunk_texts(args.texts)
+    results = [bench_backend(backend, args, queries, texts) for backend in args.backends]
+
+    # Parity and speedups are relative to torch, when it was run.
+    reference = next((r for r in results if r["backend"] == "torch"), None)
+    embeddings = {r["backend"]: r.pop("embeddings") for r in results}
+    failed = []
+    if reference is not None:
+        for r in results:
+            r["query_speedup"] = round(reference["query_p50_ms"] / r["query_p50_ms"], 2)
+            r["bulk_speedup"] = round(r["bulk_texts_per_sec"] / reference["bulk_texts_per_sec"], 2)
+            if r is reference:
+                continue
+            r.update(embedding_parity(embeddings["torch"], embeddings[r["backend"]]))
+            if r["min_cosine"] < args.min_cosine:
+                failed.append(r["backend"])
+
+    if args.json:
+        print(json.dumps({"threads": args.threads, "queries": len(queries), "texts": len(texts), "results": results}, indent=2))
+    else:
+        print(f"{len(queries)} queries one at a time, {len(texts)} chunks in batches of {args.batch_size}, threads {args.threads or 'default'}")
+        print(f"{'backend':<10} {'load':>9} {'query p50':>10} {'query p95':>10} {'bulk':>13} {'speedup q/bulk':>15} {'min cos':>8} {'mean cos':>9}")
+        for r in results:
+            speedup = f"{r['query_speedup']:.2f}x/{r['bulk_speedup']:.2f}x" if "query_speedup" in r else "-"
+            min_cos = f"{r['min_cosine']:.5f}" if "min_cosine" in r else "-"
+            mean_cos = f"{r['mean_cosine']:.5f}" if "mean_cosine" in r else "-"
+            print(
+                f"{r['backend']:<10} {r['load_ms']:7.0f}ms {r['query_p50_ms']:8.2f}ms {r['query_p95_ms']:8.2f}ms "
+                f"{r['bulk_texts_per_sec']:7.0f} txt/s {speedup:>15} {min_cos:>8} {mean_cos:>9}"
+            )
+
+    if failed:
+        raise SystemExit(f"Embeddings of {', '.join(failed)} are below cosine {args.min_cosine} of the torch model's")
+
+
+if __name__ == "__main__":
+    main()
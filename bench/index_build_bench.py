@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Times InvertedIndex.build with 1, 2, 4 and 8 worker processes on
+# data/movies.json (repeated --copies times with fresh ids) and checks
+# every parallel build is byte-for-byte equal to the serial one. Run from
+# the repository root:
+#   python bench/index_build_bench.py --copies 4
+
+import argparse
+import os
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli"))
+
+import numpy as np
+
+from lib.index_segment import SEGMENT_ARRAYS
+from lib.keyword_search import InvertedIndex
+from lib.movie import Movie, load_movies
+
+
+def corpus(copies: int) -> List[Movie]:
+    movies = load_movies()
+    step = max(m.id for m in movies) + 1
+    return [Movie(m.id + c * step, m.title, m.description) for c in range(copies) for m in movies]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Parallel index build benchmark")
+    parser.add_argument("--copies", type=int, default=4, help="Times the sample catalog is repeated")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--batch-size", type=int, default=1024, help="Movies per partial segment")
+    args = parser.parse_args()
+
+    movies = corpus(args.copies)
+    print(f"Indexing {len(movies)} documents, {os.cpu_count()} CPU(s) available")
+
+    baseline = None
+    base_time = None
+    for workers in args.workers:
+        index = InvertedIndex()
+        start = time.perf_counter()
+        index.build(movies, args.batch_size, workers)
+        elapsed = time.perf_counter() - start
+        base_time = base_time or elapsed
+
+        segment = index.segments[0]
+        if baseline is None:
+            baseline = segment
+        elif not all(
+            getattr(segment, name).dtype == getattr(baseline, name).dtype
+            and np.array_equal(getattr(segment, name), getattr(baseline, name))
+            for name in SEGMENT_ARRAYS
+        ):
+            raise SystemExit(f"Build with {workers} workers differs from the serial build")
+
+        print(f"{workers} worker(s): {elapsed:7.2f}s  {len(movies) / elapsed:9.0f} docs/sec  {base_time / elapsed:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Compares tokens.Analyzer against the original per-call preprocess pipeline
+# on data/movies.json. Run from the repository root:
+#   python bench/preprocess_bench.py
+
+import argparse
+import os
+import sys
+import time
+from typing import Callable, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli"))
+
+from nltk.stem import PorterStemmer
+
+from lib.movie import load_movies
+from tokens import Analyzer, load_stopwords, strip_punctuation, tokenize
+
+
+def legacy_preprocess(d: str) -> List[str]:
+    # The pipeline as it was before Analyzer: a fresh stemmer and a stopword
+    # file read (checked as a list) on every call.
+    stemmer = PorterStemmer()
+    stopwords = load_stopwords()
+    tokens = tokenize(strip_punctuation(d.lower()))
+    return [stemmer.stem(t) for t in tokens if t not in stopwords]
+
+
+def run(name: str, fn: Callable[[List[str]], List[List[str]]], texts: List[str], repeat: int) -> tuple[float, List[List[str]]]:
+    best = float("inf")
+    result: List[List[str]] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(texts)
+        best = min(best, time.perf_counter() - start)
+
+    print(f"{name:<24} {best:8.3f}s  {len(texts) / best:10.0f} docs/sec")
+    return best, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Preprocess micro-benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant, the best one is reported")
+    args = parser.parse_args()
+
+    texts = [f"{m.title} {m.description}" for m in load_movies()]
+    print(f"Preprocessing {len(texts)} documents, best of {args.repeat}")
+
+    legacy_time, expected = run("legacy preprocess", lambda ts: [legacy_preprocess(t) for t in ts], texts, args.repeat)
+    # A fresh Analyzer per run so the cold stem cache is part of the measurement.
+    cold_time, cold = run("Analyzer (cold cache)", lambda ts: list(Analyzer().preprocess_many(ts)), texts, args.repeat)
+    analyzer = Analyzer()
+    warm_time, warm = run("Analyzer (warm cache)", lambda ts: list(analyzer.preprocess_many(ts)), texts, args.repeat)
+
+    if cold != expected or warm != expected:
+        raise SystemExit("Analyzer output differs from the legacy preprocess")
+
+    print(f"Speedup: {legacy_time / cold_time:.1f}x cold, {legacy_time / warm_time:.1f}x warm")
+
+
+if __name__ == "__main__":
+    main()
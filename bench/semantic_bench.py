@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Compares the matrix-product SemanticSearch.search / search_chunks against
+# the original per-row cosine_similarity loops on synthetic corpora. Runs
+# offline: embeddings are random and queries go through a stub encoder.
+#   python bench/semantic_bench.py --docs 5000 50000 500000
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli"))
+
+import numpy as np
+
+from lib.movie import Movie
+from lib.semantic_search import ChunkedSemanticSearch, SemanticSearch, cosine_similarity
+from synthetic import StubEncoder
+
+
+def legacy_search(q: np.ndarray, embeddings: np.ndarray, documents: List[Movie], limit: int):
+    scores = [cosine_similarity(q, e) for e in embeddings]
+    return sorted(zip(scores, documents), key=lambda item: item[0], reverse=True)[:limit]
+
+
+def legacy_search_chunks(q: np.ndarray, embeddings: np.ndarray, metadata: List[Dict], limit: int):
+    score_map: Dict[int, float] = {}
+    for i in range(len(embeddings)):
+        movie_idx = metadata[i]["movie_idx"]
+        score = cosine_similarity(q, embeddings[i])
+        if movie_idx not in score_map or score > score_map[movie_idx]:
+            score_map[movie_idx] = score
+
+    return sorted(score_map.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+def timed(fn, queries: List[str]) -> tuple[float, list]:
+    results = []
+    start = time.perf_counter()
+    for q in queries:
+        results.append(fn(q))
+    return (time.perf_counter() - start) / len(queries), results
+
+
+def bench_size(n_docs: int, dim: int, n_queries: int, n_legacy_queries: int, limit: int) -> None:
+    rng = np.random.default_rng(n_docs)
+    documents = [Movie(id=i + 1, title=f"Movie {i + 1}", description="") for i in range(n_docs)]
+    chunks_per_doc = rng.integers(1, 6, size=n_docs)
+    metadata = [
+        {"movie_idx": movie_idx, "chunk_idx": chunk_idx, "total_chunks": int(total)}
+        for movie_idx, total in enumerate(chunks_per_doc)
+        for chunk_idx in range(total)
+    ]
+    embeddings = rng.standard_normal((n_docs, dim), dtype=np.float32)
+    chunk_embeddings = rng.standard_normal((len(metadata), dim), dtype=np.float32)
+
+    encoder = StubEncoder(dim)
+    queries = [f"query {i}" for i in range(n_queries)]
+    legacy_queries = queries[:n_legacy_queries]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.makedirs("cache")
+        np.save("cache/movie_embeddings.npy", embeddings)
+        np.save("cache/chunk_embeddings.npy", chunk_embeddings)
+        with open("cache/chunk_metadata.json", "w") as f:
+            json.dump({"chunks": metadata, "total_chunks": len(metadata)}, f)
+
+        s = SemanticSearch(model=encoder)
+        s.load_or_create_embeddings(documents)
+        cs = ChunkedSemanticSearch(model=encoder)
+        cs.load_or_create_chunk_embeddings(documents)
+
+    print(f"\n{n_docs} docs, {len(metadata)} chunks, dim {dim}")
+    embed = lambda q: encoder.encode([q])[0]
+
+    new_time, new_results = timed(lambda q: s.search(q, limit), queries)
+    old_time, old_results = timed(lambda q: legacy_search(embed(q), embeddings, documents, limit), legacy_queries)
+    same = all(
+        [m.id for _, m in new] == [m.id for _, m in old] for new, old in zip(new_results, old_results)
+    )
+    print(f"  search         legacy {old_time * 1000:10.2f} ms  matmul {new_time * 1000:8.2f} ms  "
+          f"{old_time / new_time:7.1f}x  same ranking: {same}")
+
+    new_time, new_results = timed(lambda q: cs.search_chunks(q, limit), queries)
+    old_time, old_results = timed(lambda q: legacy_search_chunks(embed(q), chunk_embeddings, metadata, limit), legacy_queries)
+    same = all(
+        [r["id"] for r in new] == [documents[movie_idx].id for movie_idx, _ in old]
+        for new, old in zip(new_results, old_results)
+    )
+    print(f"  search_chunks  legacy {old_time * 1000:10.2f} ms  matmul {new_time * 1000:8.2f} ms  "
+          f"{old_time / new_time:7.1f}x  same ranking: {same}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Semantic search benchmark")
+    parser.add_argument("--docs", type=int, nargs="+", default=[5000, 50000, 500000], help="Corpus sizes to run")
+    parser.add_argument("--dim", type=int, default=384, help="Embedding dimensions")
+    parser.add_argument("--queries", type=int, default=20, help="Queries timed per size")
+    parser.add_argument("--legacy-queries", type=int, default=3, help="Queries timed on the slow legacy path")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    try:
+        for n_docs in args.docs:
+            bench_size(n_docs, args.dim, args.queries, min(args.legacy_queries, args.queries), args.limit)
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
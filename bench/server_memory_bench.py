@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Measures what each worker of a multi-process search server costs in
+# memory. Starts search_server_cli.py once per --processes count, sends the
+# queries from as many clients as there are workers so every worker serves
+# some, then reads the memory of the parent and of each worker (see
+# lib/memory.py; the shared/private split needs Linux). Run from the
+# repository root after building the caches:
+#   python bench/server_memory_bench.py --processes 1 2 4
+
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+CLI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli")
+sys.path.insert(0, CLI_DIR)
+
+from lib.encoders import DEFAULT_ENCODER_BACKEND, ENCODER_BACKENDS
+from lib.memory import process_memory
+from lib.movie import load_movies
+from lib.search_client import query_server
+
+OPS = ("keyword", "semantic", "chunked", "weighted", "rrf")
+
+
+def child_pids(pid: int) -> List[int]:
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name in parentheses may contain spaces; the parent pid
+        # is the second field after it.
+        if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def wait_until_serving(proc: subprocess.Popen, socket_path: str, log_path: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            with open(log_path) as f:
+                raise SystemExit(f"The server exited with status {proc.returncode}:\n{f.read()}")
+        try:
+            query_server({"op": "stats"}, socket_path)
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.2)
+    proc.kill()
+    raise SystemExit(f"The server was not serving after {timeout}s")
+
+
+def bench_processes(processes: int, args: argparse.Namespace, queries: List[str]) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp:
+        socket_path = os.path.join(tmp, "search.sock")
+        log_path = os.path.join(tmp, "server.log")
+        command = [
+            sys.executable, os.path.join(CLI_DIR, "search_server_cli.py"),
+            "--socket", socket_path,
+            "--processes", str(processes),
+            "--encoder", args.encoder,
+        ]
+        if args.threads:
+            command += ["--threads", str(args.threads)]
+        with open(log_path, "w") as log:
+            proc = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_until_serving(proc, socket_path, log_path, args.timeout)
+
+            def send(query: str) -> None:
+                query_server({"op": args.op, "query": query, "limit": 10}, socket_path)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=2 * processes) as clients:
+                list(clients.map(send, queries))
+            elapsed = time.perf_counter() - start
+
+            # A single-process server is its own worker.
+            workers = child_pids(proc.pid) if processes > 1 else [proc.pid]
+            parent = process_memory(proc.pid) if processes > 1 else {}
+            worker_memory = [process_memory(pid) for pid in workers]
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(timeout=30)
+
+    def mean(field: str) -> float | None:
+        values = [m[field] for m in worker_memory if field in m]
+        return round(statistics.mean(values), 1) if values else None
+
+    return {
+        "processes": processes,
+        "queries_per_sec": round(len(queries) / elapsed, 1),
+        "total_pss_mb": round(sum(m.get("pss", 0) for m in [parent, *worker_memory]), 1),
+        "parent_mb": parent,
+        "worker_rss_mb": mean("rss"),
+        "worker_pss_mb": mean("pss"),
+        "worker_private_mb": mean("private"),
+        "workers_mb": worker_memory,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Multi-process search server memory benchmark")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to measure")
+    parser.add_argument("--queries", type=int, default=200, help="Queries sent to each server")
+    parser.add_argument("--op", choices=OPS, default="rrf", help="Search every query runs")
+    parser.add_argument("--encoder", choices=ENCODER_BACKENDS, default=DEFAULT_ENCODER_BACKEND)
+    parser.add_argument("--threads", type=int, help="Threads per encode call, the server's default otherwise")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for a server to load")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    queries = [m.title for m in load_movies()[:args.queries] if m.title.strip()]
+    results = [bench_processes(n, args, queries) for n in args.processes]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    def mb(value: float | None) -> str:
+        return f"{value:.1f}" if value is not None else "-"
+
+    print(f"{len(queries)} {args.op} queries, memory in MiB")
+    print(f"{'processes':>9} {'total pss':>10} {'parent rss':>11} {'worker rss':>11} {'worker pss':>11} {'worker private':>15} {'q/s':>8}")
+    for r in results:
+        print(
+            f"{r['processes']:>9} {r['total_pss_mb']:>10.1f} {mb(r['parent_mb'].get('rss')):>11} {mb(r['worker_rss_mb']):>11} "
+            f"{mb(r['worker_pss_mb']):>11} {mb(r['worker_private_mb']):>15} {r['queries_per_sec']:>8.1f}"
+        )
+    # A host runs one parent plus N workers; the parent's pages are what
+    # the workers share.
+    forked = [r for r in results if r["processes"] > 1 and r["worker_private_mb"] is not None]
+    if forked:
+        r = forked[-1]
+        print(
+            f"Each worker adds about {r['worker_private_mb']:.1f} MiB on top of the parent's "
+            f"{r['parent_mb'].get('rss', 0):.1f} MiB (measured with {r['processes']} processes)"
+        )
+
+
+if __name__ == "__main__":
+    main()
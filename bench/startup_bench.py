@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Times each CLI subcommand end to end in a fresh interpreter and reports
+# whether it imported torch / sentence-transformers or nltk. Run from the
+# repository root after building the caches (keyword_search_cli.py build,
+# semantic_search_cli.py embed_chunks and one search to warm the query
+# cache):
+#   python bench/startup_bench.py --runs 5
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+CLI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli")
+
+# Runs the CLI as __main__ and reports which heavy modules ended up loaded.
+RUNNER = """
+import json, runpy, sys
+cli, sys.argv = sys.argv[1], sys.argv[1:]
+sys.path.insert(0, __import__("os").path.dirname(cli))
+try:
+    runpy.run_path(cli, run_name="__main__")
+finally:
+    loaded = {m: m in sys.modules for m in ("torch", "sentence_transformers", "nltk")}
+    print("STARTUP_MODULES " + json.dumps(loaded), file=sys.stderr)
+"""
+
+QUERY = "space pirate adventure"
+COMMANDS: List[Tuple[str, List[str]]] = [
+    ("hybrid_search_cli.py", ["normalize", "0.5", "2.3", "1.2"]),
+    ("semantic_search_cli.py", ["chunk", "A long text to chunk into words " * 20]),
+    ("semantic_search_cli.py", ["semantic_chunk", "One sentence. Another one! And a third? Done."]),
+    ("keyword_search_cli.py", ["bm25search", QUERY]),
+    ("semantic_search_cli.py", ["search", QUERY]),
+    ("semantic_search_cli.py", ["search_chunked", QUERY]),
+    ("hybrid_search_cli.py", ["weighted-search", QUERY, "--alpha", "1.0"]),
+    ("hybrid_search_cli.py", ["weighted-search", QUERY]),
+    ("hybrid_search_cli.py", ["rrf-search", QUERY]),
+]
+
+
+def run_once(cli: str, args: List[str]) -> Tuple[float, Dict[str, bool]]:
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", RUNNER, os.path.join(CLI_DIR, cli), *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    elapsed = time.perf_counter() - start
+    line = next(l for l in out.stderr.splitlines() if l.startswith("STARTUP_MODULES "))
+    return elapsed, json.loads(line.split(" ", 1)[1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="CLI startup benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per subcommand, the median is reported")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for cli, cli_args in COMMANDS:
+        # The first run warms the page cache and the query cache.
+        run_once(cli, cli_args)
+        times = []
+        for _ in range(args.runs):
+            elapsed, loaded = run_once(cli, cli_args)
+            times.append(elapsed)
+        label = f"{cli.removesuffix('_cli.py')} {' '.join(a for a in cli_args if a != QUERY)[:28]}"
+        results.append({"command": label, "median_ms": round(statistics.median(times) * 1000, 1), **loaded})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'command':<44} {'median':>9}  torch  sentence_transformers  nltk")
+    for r in results:
+        print(
+            f"{r['command']:<44} {r['median_ms']:7.1f}ms  {'yes' if r['torch'] else 'no':<5}  "
+            f"{'yes' if r['sentence_transformers'] else 'no':<21}  {'yes' if r['nltk'] else 'no'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
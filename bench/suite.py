@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# Benchmarks the keyword, semantic and hybrid hot paths on synthetic
+# catalogs (see synthetic.py) with a stub encoder, so it runs offline on
+# CPU. Each corpus size runs in its own process so peak RSS is per size.
+# Results are JSON: one record per (size, benchmark) with p50/p95/p99
+# latency, throughput and the process's peak RSS once the benchmark is done.
+# Run from the repository root and compare two commits with --baseline:
+#   python bench/suite.py --sizes 1000 10000 --output before.json
+#   python bench/suite.py --sizes 1000 10000 --baseline before.json
+# 1M documents works too (--sizes 1000000) but needs several GB of RAM for
+# the chunk embeddings at the default --dim.
+
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli"))
+
+import numpy as np
+
+from lib.hybrid_search import HybridSearch
+from lib.keyword_search import InvertedIndex
+from lib.movie import Movie
+from lib.semantic_search import ChunkedSemanticSearch, SemanticSearch
+from synthetic import StubEncoder, synthetic_movies, vocabulary
+from tokens import Analyzer
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+BENCHMARKS = [
+    "preprocess",
+    "index_build",
+    "index_save",
+    "index_load",
+    "bm25_search",
+    "bm25_search_frequent",
+    "boolean_and_search",
+    "semantic_search",
+    "chunked_search",
+    "hybrid_weighted_search",
+    "hybrid_rrf_search",
+]
+# Untimed calls before each query benchmark, to warm caches and the page cache.
+WARMUP_CALLS = 3
+# bm25_search_frequent queries mix words from this many of the most frequent
+# vocabulary words, whose posting lists span much of the corpus.
+FREQUENT_WORDS = 200
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def record(n_docs: int, name: str, latencies: List[float], items: int, unit: str) -> Dict[str, Any]:
+    ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "docs": n_docs,
+        "benchmark": name,
+        "calls": len(latencies),
+        "p50_ms": round(float(p50), 4),
+        "p95_ms": round(float(p95), 4),
+        "p99_ms": round(float(p99), 4),
+        "throughput": round(items / float(np.sum(latencies)), 2),
+        "unit": unit,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def time_calls(fn: Callable[[Any], Any], inputs: List[Any], warmup: int = 0) -> List[float]:
+    for x in inputs[:warmup]:
+        fn(x)
+    latencies = []
+    for x in inputs:
+        start = time.perf_counter()
+        fn(x)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def make_queries(movies: List[Movie], n: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    described = [m for m in movies if m.description]
+    queries = []
+    while len(queries) < n:
+        words = rng.choice(described).description.rstrip(".").split()
+        start = rng.randrange(max(1, len(words) - 4))
+        queries.append(" ".join(words[start:start + rng.randint(2, 4)]))
+    return queries
+
+
+def make_frequent_queries(n: int, seed: int) -> List[str]:
+    # Multi-term queries where most terms are common, the case where
+    # scoring every matching document is most expensive.
+    rng = random.Random(seed)
+    words = vocabulary(seed=seed)
+    queries = []
+    for _ in range(n):
+        terms = rng.sample(words[:FREQUENT_WORDS], rng.randint(2, 4))
+        terms.append(rng.choice(words[FREQUENT_WORDS:FREQUENT_WORDS * 20]))
+        queries.append(" ".join(terms))
+    return queries
+
+
+def run_size(args: argparse.Namespace, n_docs: int) -> List[Dict[str, Any]]:
+    selected = set(args.only or BENCHMARKS)
+    movies = list(synthetic_movies(n_docs, args.seed))
+    queries = make_queries(movies, args.queries, args.seed)
+    encoder = StubEncoder(args.dim)
+    results = []
+
+    def add(name: str, latencies: List[float], items: int, unit: str) -> None:
+        results.append(record(n_docs, name, latencies, items, unit))
+        print(f"{n_docs:>8} {name:<24} p50 {results[-1]['p50_ms']:10.3f} ms  "
+              f"{results[-1]['throughput']:12.1f} {unit}", file=sys.stderr)
+
+    if "preprocess" in selected:
+        analyzer = Analyzer()
+        texts = [f"{m.title} {m.description}" for m in movies]
+        add("preprocess", time_calls(analyzer.preprocess, texts), len(texts), "docs/sec")
+
+    # Every cache the library writes lands in a scratch directory. The
+    # analyzer reads data/stopwords.txt relative to the working directory.
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "data"))
+        shutil.copy(os.path.join(cwd, "data", "stopwords.txt"), os.path.join(tmp, "data"))
+        os.chdir(tmp)
+        try:
+            index = InvertedIndex(pruning=not args.no_pruning)
+            build = time_calls(lambda _: index.build(movies), list(range(args.repeat)))
+            if "index_build" in selected:
+                add("index_build", build, n_docs * args.repeat, "docs/sec")
+            save = time_calls(lambda _: index.save(), list(range(args.repeat)))
+            if "index_save" in selected:
+                add("index_save", save, n_docs * args.repeat, "docs/sec")
+            if "index_load" in selected:
+                add("index_load", time_calls(lambda _: InvertedIndex().load(), list(range(args.repeat))), n_docs * args.repeat, "docs/sec")
+            if "bm25_search" in selected:
+                lat = time_calls(lambda q: index.bm25_search(q, args.limit), queries, WARMUP_CALLS)
+                add("bm25_search", lat, len(queries), "queries/sec")
+            frequent = make_frequent_queries(args.queries, args.seed)
+            if "bm25_search_frequent" in selected:
+                lat = time_calls(lambda q: index.bm25_search(q, args.limit), frequent, WARMUP_CALLS)
+                add("bm25_search_frequent", lat, len(frequent), "queries/sec")
+            if "boolean_and_search" in selected:
+                lat = time_calls(lambda q: index.boolean_search(q, args.limit, "and"), frequent, WARMUP_CALLS)
+                add("boolean_and_search", lat, len(frequent), "queries/sec")
+
+            if "semantic_search" in selected:
+                s = SemanticSearch(model=encoder)
+                s.load_or_create_embeddings(movies)
+                lat = time_calls(lambda q: s.search(q, args.limit), queries, WARMUP_CALLS)
+                add("semantic_search", lat, len(queries), "queries/sec")
+                del s
+
+            if "chunked_search" in selected:
+                cs = ChunkedSemanticSearch(model=encoder)
+                cs.load_or_create_chunk_embeddings(movies)
+                lat = time_calls(lambda q: cs.search_chunks(q, args.limit), queries, WARMUP_CALLS)
+                add("chunked_search", lat, len(queries), "queries/sec")
+                del cs
+
+            if selected & {"hybrid_weighted_search", "hybrid_rrf_search"}:
+                hs = HybridSearch(movies, model=encoder)
+                if "hybrid_weighted_search" in selected:
+                    lat = time_calls(lambda q: hs.weighted_search(q, 0.5, args.limit), queries, WARMUP_CALLS)
+                    add("hybrid_weighted_search", lat, len(queries), "queries/sec")
+                if "hybrid_rrf_search" in selected:
+                    lat = time_calls(lambda q: hs.rrf_search(q, limit=args.limit), queries, WARMUP_CALLS)
+                    add("hybrid_rrf_search", lat, len(queries), "queries/sec")
+                hs.executor.shutdown()
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str) -> None:
+    with open(baseline_path) as f:
+        baseline = {(r["docs"], r["benchmark"]): r for r in json.load(f)["results"]}
+
+    print(f"\n{'docs':>8} {'benchmark':<24} {'p50 before':>12} {'p50 after':>12} {'change':>8}", file=sys.stderr)
+    for r in results:
+        before = baseline.get((r["docs"], r["benchmark"]))
+        if before is None:
+            continue
+        change = (r["p50_ms"] / before["p50_ms"] - 1) * 100 if before["p50_ms"] else 0.0
+        print(f"{r['docs']:>8} {r['benchmark']:<24} {before['p50_ms']:10.3f}ms {r['p50_ms']:10.3f}ms {change:+7.1f}%", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Keyword, semantic and hybrid search benchmark suite")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Synthetic corpus sizes")
+    parser.add_argument("--only", choices=BENCHMARKS, nargs="+", help="Run only these benchmarks")
+    parser.add_argument("--queries", type=int, default=100, help="Queries timed per search benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each index build/save/load")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=384, help="Stub encoder dimensions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-pruning", action="store_true", help="Score every matching document in the BM25 benchmarks")
+    parser.add_argument("--output", type=str, help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", type=str, help="Earlier JSON report to compare p50 latencies against")
+    parser.add_argument("--single-size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single_size is not None:
+        # The library's status messages go to stderr; stdout is the report.
+        with redirect_stdout(sys.stderr):
+            results = run_size(args, args.single_size)
+        json.dump(results, sys.stdout)
+        return
+
+    # One child process per size: peak RSS is a high-water mark and would
+    # otherwise carry over from the previous size.
+    child_args = sys.argv[1:]
+    results: List[Dict[str, Any]] = []
+    for n_docs in args.sizes:
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *child_args, "--single-size", str(n_docs)],
+            stdout=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+        results.extend(json.loads(out.stdout))
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+            "queries": args.queries,
+            "repeat": args.repeat,
+            "limit": args.limit,
+            "dim": args.dim,
+            "pruning": not args.no_pruning,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Deterministic synthetic movie catalogs shaped like data/movies.json, and a
+# stub sentence encoder, so benchmarks run offline at any corpus size.
+# Write a catalog to disk with:
+#   python bench/synthetic.py --docs 100000 --output data/movies_100k.json
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from typing import Iterator, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli"))
+
+import numpy as np
+
+from lib.movie import Movie
+
+VOCABULARY_SIZE = 20000
+# Words per description: about normal(90, 35) clipped to [5, 210], like the
+# sample catalog, with this share of movies left without a description.
+DESCRIPTION_WORDS_MEAN = 90
+DESCRIPTION_WORDS_STD = 35
+DESCRIPTION_WORDS_MAX = 210
+EMPTY_DESCRIPTION_RATE = 0.01
+SENTENCE_WORDS = (6, 22)
+# Function words make up roughly this share of running text.
+FUNCTION_WORD_RATE = 0.4
+FUNCTION_WORDS = (
+    "the a an and of to in is his her their with for on as by at from who "
+    "when that but into after while he she they it this must"
+).split()
+SYLLABLES = (
+    "ka ro mi ta ne lo ve sa ri do an el or un is ar en th st ch br gr tr "
+    "pl qu zo xi fa gu ha be"
+).split()
+
+
+def vocabulary(size: int = VOCABULARY_SIZE, seed: int = 0) -> List[str]:
+    rng = np.random.default_rng(seed)
+    words: List[str] = []
+    seen = set(FUNCTION_WORDS)
+    while len(words) < size:
+        word = "".join(SYLLABLES[i] for i in rng.integers(0, len(SYLLABLES), size=rng.integers(2, 5)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def synthetic_movies(n: int, seed: int = 0) -> Iterator[Movie]:
+    # Content words follow a Zipf distribution over the vocabulary, so term
+    # frequencies and posting list lengths look like natural text.
+    rng = np.random.default_rng(seed)
+    words = vocabulary(seed=seed)
+    cdf = np.cumsum(1 / np.arange(1, len(words) + 1))
+    cdf /= cdf[-1]
+
+    def draw(size: int) -> np.ndarray:
+        return np.minimum(np.searchsorted(cdf, rng.random(size)), len(words) - 1)
+
+    for i in range(n):
+        title_words = draw(int(rng.integers(1, 5)))
+        title = " ".join(words[w].capitalize() for w in title_words)
+        if rng.random() < EMPTY_DESCRIPTION_RATE:
+            yield Movie(i + 1, title, "")
+            continue
+
+        n_words = int(np.clip(rng.normal(DESCRIPTION_WORDS_MEAN, DESCRIPTION_WORDS_STD), 5, DESCRIPTION_WORDS_MAX))
+        content = draw(n_words)
+        function = rng.integers(0, len(FUNCTION_WORDS), size=n_words)
+        is_function = rng.random(n_words) < FUNCTION_WORD_RATE
+        tokens = [FUNCTION_WORDS[f] if s else words[c] for c, f, s in zip(content, function, is_function)]
+
+        sentences = []
+        start = 0
+        while start < n_words:
+            end = start + int(rng.integers(*SENTENCE_WORDS))
+            sentence = " ".join(tokens[start:end])
+            sentences.append(sentence[0].upper() + sentence[1:] + ".")
+            start = end
+        yield Movie(i + 1, title, " ".join(sentences))
+
+
+class StubEncoder:
+    # Stands in for a SentenceTransformer: each text maps to a fixed random
+    # vector seeded by its hash, so results are reproducible and encoding
+    # costs next to nothing.
+    def __init__(self, dim: int = 384) -> None:
+        self.dim = dim
+
+    def encode(self, texts: List[str], **kwargs) -> np.ndarray:
+        seeds = [int.from_bytes(hashlib.sha256(t.encode()).digest()[:8], "little") for t in texts]
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, s in enumerate(seeds):
+            out[i] = np.random.default_rng(s).standard_normal(self.dim, dtype=np.float32)
+        return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Write a synthetic movie catalog")
+    parser.add_argument("--docs", type=int, default=10000, help="Number of movies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, required=True, help="Path of the .json (or .jsonl) file to write")
+    args = parser.parse_args()
+
+    with open(args.output, "w") as f:
+        if args.output.endswith(".jsonl"):
+            for m in synthetic_movies(args.docs, args.seed):
+                f.write(json.dumps(m.__dict__) + "\n")
+        else:
+            f.write('{"movies": [')
+            for i, m in enumerate(synthetic_movies(args.docs, args.seed)):
+                f.write(("," if i else "") + json.dumps(m.__dict__))
+            f.write("]}")
+    print(f"Wrote {args.docs} movies to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,57 @@
 import argparse
+import sys
+import time
+from contextlib import redirect_stdout
+from itertools import batched
 
-from lib.movie import load_movies
-from lib.hybrid_search import HybridSearch
+from lib.hybrid_search import RRF_K, HybridSearch
 from lib.hybrid_search import normalize
+from lib.search_client import DEFAULT_SOCKET_PATH, query_server
+from lib.encoders import DEFAULT_ENCODER_BACKEND, ENCODER_BACKENDS
+from lib.query_cache import DEFAULT_QUERY_CACHE_SIZE, QueryEmbeddingCache
+from lib.tracing import instrument
+from search_utils import read_queries, write_jsonl
+
+
+def print_hybrid_results(results) -> None:
+    for i, r in enumerate(results, 1):
+        print(f"{i}. {r['title']}")
+        print(f"   Hybrid Score: {r['score']:.4f}")
+        print(f"   BM25: {r['bm25_score']:.4f}, Semantic: {r['semantic_score']:.4f}")
+        print(f"   {r['document']}...")
+
+
+def print_rrf_results(results) -> None:
+    for i, r in enumerate(results, 1):
+        bm25_rank = r["bm25_rank"] or "-"
+        semantic_rank = r["semantic_rank"] or "-"
+        print(f"{i}. {r['title']}")
+        print(f"   RRF Score: {r['score']:.4f}")
+        print(f"   BM25 Rank: {bm25_rank}, Semantic Rank: {semantic_rank}")
+        print(f"   {r['document']}...")
+
+
+def print_timings(timings) -> None:
+    stages = ", ".join(f"{stage} {seconds * 1000:.1f}ms" for stage, seconds in timings.items())
+    print(f"Timings: {stages}")
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Hybrid Search CLI")
+    parser.add_argument("--server", action="store_true", help="Forward searches to a running search_server_cli.py")
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET_PATH, help="Search server socket path")
+    parser.add_argument("--trace", action="store_true", help="Print a per-stage timing breakdown to stderr")
+    parser.add_argument(
+        "--query-cache-size",
+        type=int,
+        default=DEFAULT_QUERY_CACHE_SIZE,
+        help="Query embeddings kept in cache/query_embeddings.npz between runs, 0 disables",
+    )
+    parser.add_argument("--cache-ttl", type=float, help="Seconds a cached query embedding stays valid, forever by default")
+    parser.add_argument("--profile", metavar="PATH", help="Run under cProfile and write the stats to PATH, or print the top functions with -")
+    parser.add_argument("--encoder", choices=ENCODER_BACKENDS, default=DEFAULT_ENCODER_BACKEND, help="Encoder backend, onnx/onnx-int8 need semantic_search_cli.py export_encoder first")
+    parser.add_argument("--encoder-path", type=str, help="Directory of the exported ONNX model, cache/encoders/<model>-onnx by default")
+    parser.add_argument("--threads", type=int, help="Threads per encode call, one per core by default")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     normalize_cmd = subparsers.add_parser("normalize")
@@ -16,19 +61,80 @@ def main() -> None:
     weighted_search_cmd.add_argument("query", type=str)
     weighted_search_cmd.add_argument("--alpha", type=float, default=0.5)
     weighted_search_cmd.add_argument("--limit", type=int, default=5)
+    weighted_search_cmd.add_argument("--candidates", type=int, help="Candidates fetched from each retriever, limit * 500 by default")
+
+    rrf_search_cmd = subparsers.add_parser("rrf-search")
+    rrf_search_cmd.add_argument("query", type=str)
+    rrf_search_cmd.add_argument("--k", type=float, default=RRF_K, help="RRF rank constant")
+    rrf_search_cmd.add_argument("--limit", type=int, default=5)
+    rrf_search_cmd.add_argument("--candidates", type=int, help="Candidates fetched from each retriever, limit * 500 by default")
+
+    subparsers.add_parser(
+        "sync", help="Update the index and chunk embeddings to data/movies.json, only re-indexing and encoding the changes"
+    )
+
+    batch_search_cmd = subparsers.add_parser("batch-search", help="Weighted search for many queries, one JSON line per query")
+    batch_search_cmd.add_argument("--input", type=str, default="-", help="File with one query per line, stdin by default")
+    batch_search_cmd.add_argument("--alpha", type=float, default=0.5)
+    batch_search_cmd.add_argument("--limit", type=int, default=5)
+    batch_search_cmd.add_argument("--candidates", type=int, help="Candidates fetched from each retriever, limit * 500 by default")
+    batch_search_cmd.add_argument("--batch-size", type=int, default=256, help="Queries encoded and scored per batch")
 
     args = parser.parse_args()
-    print(args)
+    query_cache = QueryEmbeddingCache(args.query_cache_size, args.cache_ttl)
+    query_cache.load()
+    with instrument(args.trace, args.profile):
+        run(args, parser, query_cache)
+    query_cache.save()
+
+
+def encoder_options(args: argparse.Namespace) -> dict:
+    return {"backend": args.encoder, "encoder_path": args.encoder_path, "threads": args.threads}
+
 
+def run(args: argparse.Namespace, parser: argparse.ArgumentParser, query_cache: QueryEmbeddingCache) -> None:
     match args.command:
         case "normalize":
             values = normalize(args.values)
             for score in values:
                 print(f"* {score:.4f}")
+        case "weighted-search" if args.server:
+            request = {
+                "op": "weighted",
+                "query": args.query,
+                "alpha": args.alpha,
+                "limit": args.limit,
+                "candidates": args.candidates,
+            }
+            print_hybrid_results(query_server(request, args.socket))
         case "weighted-search":
-            movies = load_movies()
-            hs = HybridSearch(movies)
-            hs.weighted_search(args.query, args.alpha, args.limit)
+            hs = HybridSearch(query_cache=query_cache, **encoder_options(args))
+            print_hybrid_results(hs.weighted_search(args.query, args.alpha, args.limit, args.candidates))
+        case "rrf-search" if args.server:
+            request = {"op": "rrf", "query": args.query, "k": args.k, "limit": args.limit, "candidates": args.candidates}
+            start = time.perf_counter()
+            results = query_server(request, args.socket)
+            print_rrf_results(results)
+            print_timings({"total": time.perf_counter() - start})
+        case "rrf-search":
+            hs = HybridSearch(query_cache=query_cache, **encoder_options(args))
+            timings = {}
+            start = time.perf_counter()
+            results = hs.rrf_search(args.query, args.k, args.limit, args.candidates, timings)
+            timings["total"] = time.perf_counter() - start
+            print_rrf_results(results)
+            print_timings(timings)
+        case "sync":
+            hs = HybridSearch(query_cache=query_cache, **encoder_options(args))
+            hs.sync()
+            print(f"Synced {len(hs.semantic_search.doc_ids)} movies")
+        case "batch-search":
+            with redirect_stdout(sys.stderr):
+                hs = HybridSearch(query_cache=query_cache, **encoder_options(args))
+            for queries in batched(read_queries(args.input), args.batch_size):
+                results = hs.weighted_search_batch(list(queries), args.alpha, args.limit, args.candidates)
+                for query, res in zip(queries, results):
+                    write_jsonl({"query": query, "results": res})
         case _:
             parser.print_help()
 
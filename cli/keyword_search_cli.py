@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
+import time
+from itertools import batched
 from typing import List
-from search_utils import BM25_B, BM25_K1
-from lib.keyword_search import InvertedIndex
-from tokens import Movie, preprocess
+from search_utils import BM25_B, BM25_K1, read_queries, write_jsonl
+from lib.keyword_search import BOOLEAN_MODES, BUILD_BATCH_SIZE, DEFAULT_BOOLEAN_MODE, InvertedIndex
+from lib.search_client import DEFAULT_SOCKET_PATH, query_server
+from lib.tracing import instrument
+from lib.movie import MOVIES_PATH, iter_movies
+from tokens import Movie
 
 
 # def keyword_search(query: str, index: InvertedIndex):
@@ -28,30 +34,31 @@ from tokens import Movie, preprocess
 #
 
 
-def keyword_search(query: str, index: InvertedIndex):
-    q = preprocess(query)
-    result: List[Movie] = []
-    for qtoken in q:
-        ids = index.get_documents(qtoken)
-        for id in ids:
-            result.append(index.docmap[id])
-
-        if len(result) >= 5:
-            break
-
-    f_result = sorted(result, key=lambda item: item.id)[:5]
-    for i, r in enumerate(f_result):
-        print(f"{i+1}. {r.title}")
+def keyword_search(query: str, index: InvertedIndex, mode: str, limit: int):
+    for i, (m, _) in enumerate(index.boolean_search(query, limit, mode), 1):
+        print(f"{i}. {m.title}")
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
+    parser.add_argument("--server", action="store_true", help="Forward searches to a running search_server_cli.py")
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET_PATH, help="Search server socket path")
+    parser.add_argument("--trace", action="store_true", help="Print a per-stage timing breakdown to stderr")
+    parser.add_argument("--profile", metavar="PATH", help="Run under cProfile and write the stats to PATH, or print the top functions with -")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
-    search_parser = subparsers.add_parser("search", help="Search movies using BM25")
+    search_parser = subparsers.add_parser("search", help="Movies with all (and) or any (or) of the query terms, ranked by BM25")
     search_parser.add_argument("query", type=str, help="Search query")
+    search_parser.add_argument("--mode", choices=BOOLEAN_MODES, default=DEFAULT_BOOLEAN_MODE, help="Match all query terms or any of them")
+    search_parser.add_argument("--limit", type=int, default=5)
 
     build_parser = subparsers.add_parser("build", help="Build index")
+    build_parser.add_argument("--workers", type=int, default=1, help="Processes tokenizing the corpus in parallel")
+    build_parser.add_argument("--batch-size", type=int, default=BUILD_BATCH_SIZE, help="Movies per partial index segment")
+    build_parser.add_argument("--data", type=str, default=MOVIES_PATH, help="Movies file, {\"movies\": [...]} JSON or JSON Lines")
+    build_parser.add_argument(
+        "--convert", action="store_true", help="Convert an existing pickled index to the array format instead of rebuilding"
+    )
 
     tf_parser = subparsers.add_parser(
         "tf", help="Get term frequency for specified term in the specified document"
@@ -81,22 +88,49 @@ def main() -> None:
 
     bm25_search = subparsers.add_parser("bm25search", help="Performs BM25 search for a given doc_id and term")
     bm25_search.add_argument("query", type=str, help="Search query")
-    
+
+    batch_search = subparsers.add_parser("batch-search", help="BM25 search for many queries, one JSON line per query")
+    batch_search.add_argument("--input", type=str, default="-", help="File with one query per line, stdin by default")
+    batch_search.add_argument("--limit", type=int, default=5)
+    batch_search.add_argument("--batch-size", type=int, default=256, help="Queries searched per batch")
+
+    add_parser = subparsers.add_parser("add", help="Add or replace documents in the index without a rebuild")
+    add_parser.add_argument("path", type=str, help='JSON file with a list of movies or {"movies": [...]}')
+
+    delete_parser = subparsers.add_parser("delete", help="Delete a document from the index without a rebuild")
+    delete_parser.add_argument("doc_id", type=int, help="Document ID")
+
+    subparsers.add_parser("merge", help="Merge incremental index segments into one")
+
     args = parser.parse_args()
+    with instrument(args.trace, args.profile):
+        run(args, parser)
 
+
+def run(args: argparse.Namespace, parser: argparse.ArgumentParser) -> None:
     match args.command:
+        case "search" if args.server:
+            request = {"op": "boolean", "query": args.query, "mode": args.mode, "limit": args.limit}
+            for i, r in enumerate(query_server(request, args.socket), 1):
+                print(f"{i}. {r['title']}")
         case "search":
             try:
                 index = InvertedIndex()
                 index.load()
-                keyword_search(args.query, index)
+                keyword_search(args.query, index, args.mode, args.limit)
             except Exception as e:
                 print(e)
                 exit()
         case "build":
             index = InvertedIndex()
-            index.build()
-            index.save()
+            if args.convert:
+                index.convert_legacy()
+            else:
+                start = time.perf_counter()
+                index.build(iter_movies(args.data), args.batch_size, args.workers)
+                elapsed = time.perf_counter() - start
+                print(f"Indexed {len(index.doc_locations)} documents in {elapsed:.2f}s ({len(index.doc_locations) / elapsed:.0f} docs/sec, {args.workers} worker(s))")
+                index.save()
         case "tf":
             index = InvertedIndex()
             index.load()
@@ -123,12 +157,46 @@ def main() -> None:
             index.load()
             bm25tf = index.get_bm25_tf(args.doc_id, args.term, args.k1, args.b)
             print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf:.2f}")
+        case "bm25search" if args.server:
+            for r in query_server({"op": "keyword", "query": args.query, "limit": 5}, args.socket):
+                print(f"({r['id']}) {r['title']} - Score: {r['score']:.2f}")
         case "bm25search":
             index = InvertedIndex()
             index.load()
             items = index.bm25_search(args.query, 5)
             for m, score in items:
                 print(f"({m.id}) {m.title} - Score: {score:.2f}")
+        case "batch-search":
+            index = InvertedIndex()
+            index.load()
+            for queries in batched(read_queries(args.input), args.batch_size):
+                for query, items in zip(queries, index.search_batch(list(queries), args.limit)):
+                    results = [{"id": m.id, "title": m.title, "score": score} for m, score in items]
+                    write_jsonl({"query": query, "results": results})
+        case "add":
+            with open(args.path) as f:
+                data = json.load(f)
+            movies = [Movie(**m) for m in (data["movies"] if isinstance(data, dict) else data)]
+            index = InvertedIndex()
+            index.load()
+            index.add_documents(movies)
+            index.wait_for_merge()
+            print(f"Indexed {len(movies)} documents, {len(index.doc_locations)} in the index")
+        case "delete":
+            index = InvertedIndex()
+            index.load()
+            try:
+                index.delete_document(args.doc_id)
+            except ValueError as e:
+                print(e)
+                exit(1)
+            index.wait_for_merge()
+            print(f"Deleted document {args.doc_id}, {len(index.doc_locations)} in the index")
+        case "merge":
+            index = InvertedIndex()
+            index.load()
+            index.merge()
+            print(f"Merged index into {len(index.segments)} segment(s)")
 
         case _:
             parser.print_help()
@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+
+IVF_FORMAT_VERSION = 1
+DEFAULT_NPROBE = 16
+KMEANS_ITERATIONS = 10
+# k-means is trained on at most this many points per list; the rest are
+# only assigned once at the end.
+KMEANS_SAMPLE_PER_LIST = 64
+# Upper bound on the point-by-centroid score matrix materialized at once.
+ASSIGN_BLOCK_ELEMENTS = 1 << 24
+
+
+def default_n_lists(n: int) -> int:
+    return max(1, min(n, int(4 * np.sqrt(n))))
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # Nearest centroid by dot product, which is cosine for unit vectors.
+    step = max(1, ASSIGN_BLOCK_ELEMENTS // max(1, len(centroids)))
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), step):
+        out[start:start + step] = np.argmax(vectors[start:start + step] @ centroids.T, axis=1)
+    return out
+
+
+def spherical_kmeans(vectors: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        labels = assign(vectors, centroids)
+        counts = np.bincount(labels, minlength=k)
+        order = np.argsort(labels, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        nonempty = counts > 0
+        sums[nonempty] = np.add.reduceat(vectors[order], starts[nonempty], axis=0)
+
+        # Lists that lost every point restart from a random point.
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), size=len(empty))]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = np.divide(sums, norms, out=np.zeros_like(sums), where=norms != 0)
+
+    return centroids
+
+
+class IVFIndex:
+    # Inverted-file index over unit-length embeddings. Vectors are grouped
+    # by their nearest k-means centroid; a query only scans the lists of its
+    # `nprobe` nearest centroids. The ids of list i are the slice
+    # `list_offsets[i]:list_offsets[i + 1]` of `list_ids`, in ascending order.
+    centroids: np.ndarray
+    list_offsets: np.ndarray
+    list_ids: np.ndarray
+    fingerprint: str
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_ids: np.ndarray, fingerprint: str) -> None:
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, fingerprint: str, n_lists: int | None = None, seed: int = 0) -> "IVFIndex":
+        n = len(embeddings)
+        if n == 0:
+            # No lists; every probe comes back empty.
+            dim = embeddings.shape[1] if embeddings.ndim == 2 else 0
+            return cls(np.empty((0, dim), dtype=np.float32), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64), fingerprint)
+
+        # k-means can't have more lists than points.
+        k = min(n_lists or default_n_lists(n), n)
+        rng = np.random.default_rng(seed)
+        sample_size = min(n, k * KMEANS_SAMPLE_PER_LIST)
+        sample = embeddings[np.sort(rng.choice(n, size=sample_size, replace=False))] if sample_size < n else embeddings
+        centroids = spherical_kmeans(sample, k, seed=seed)
+
+        labels = assign(embeddings, centroids)
+        list_ids = np.argsort(labels, kind="stable")
+        list_offsets = np.zeros(k + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=k), out=list_offsets[1:])
+        return cls(centroids, list_offsets, list_ids, fingerprint)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path)
+
+    def save(self, path: str) -> None:
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(
+                f,
+                version=IVF_FORMAT_VERSION,
+                fingerprint=self.fingerprint,
+                centroids=self.centroids,
+                list_offsets=self.list_offsets,
+                list_ids=self.list_ids,
+            )
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            if int(data["version"]) != IVF_FORMAT_VERSION:
+                raise ValueError(f"Unsupported IVF index version {int(data['version'])} in {path}")
+
+            return cls(data["centroids"], data["list_offsets"], data["list_ids"], str(data["fingerprint"]))
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    def candidates(self, q: np.ndarray, nprobe: int = DEFAULT_NPROBE) -> np.ndarray:
+        # Ids in the `nprobe` lists closest to `q`, ascending.
+        if self.n_lists == 0:
+            return self.list_ids
+        nprobe = max(1, min(nprobe, self.n_lists))
+        centroid_scores = self.centroids @ q
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        ids = np.concatenate([self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probe])
+        ids.sort()
+        return ids
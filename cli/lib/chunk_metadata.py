@@ -0,0 +1,96 @@
+import json
+import os
+from typing import Any, Dict, List
+
+import numpy as np
+
+CHUNK_METADATA_VERSION = 1
+CHUNK_METADATA_COLUMNS = ("movie_idx", "chunk_idx", "total_chunks")
+
+
+class ChunkMetadata:
+    # Where every chunk embedding came from, as aligned int32 columns: row i
+    # is chunk `chunk_idx[i]` of the `total_chunks[i]` chunks of movie
+    # `movie_idx[i]`, and describes row i of the chunk embeddings matrix
+    # identified by `fingerprint`.
+    movie_idx: np.ndarray
+    chunk_idx: np.ndarray
+    total_chunks: np.ndarray
+    fingerprint: str
+
+    def __init__(self, movie_idx: np.ndarray, chunk_idx: np.ndarray, total_chunks: np.ndarray, fingerprint: str) -> None:
+        if not len(movie_idx) == len(chunk_idx) == len(total_chunks):
+            raise ValueError("Chunk metadata columns must have the same length")
+
+        self.movie_idx = movie_idx
+        self.chunk_idx = chunk_idx
+        self.total_chunks = total_chunks
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_chunk_counts(cls, counts: List[int], fingerprint: str) -> "ChunkMetadata":
+        # `counts[m]` is the number of chunks of movie m; its chunks are
+        # rows sum(counts[:m]) onwards, in order.
+        counts_array = np.asarray(counts, dtype=np.int32)
+        movie_idx = np.repeat(np.arange(len(counts_array), dtype=np.int32), counts_array)
+        starts = np.cumsum(counts_array) - counts_array
+        chunk_idx = (np.arange(len(movie_idx)) - np.repeat(starts, counts_array)).astype(np.int32)
+        return cls(movie_idx, chunk_idx, np.repeat(counts_array, counts_array), fingerprint)
+
+    def __len__(self) -> int:
+        return len(self.movie_idx)
+
+    def take(self, rows: np.ndarray) -> "ChunkMetadata":
+        return ChunkMetadata(self.movie_idx[rows], self.chunk_idx[rows], self.total_chunks[rows], self.fingerprint)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path)
+
+    def save(self, path: str) -> None:
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(
+                f,
+                version=CHUNK_METADATA_VERSION,
+                fingerprint=self.fingerprint,
+                movie_idx=self.movie_idx,
+                chunk_idx=self.chunk_idx,
+                total_chunks=self.total_chunks,
+            )
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def saved_fingerprint(path: str) -> str | None:
+        # Fingerprint of the embeddings the saved metadata describes; None
+        # when there is no file or it is of another version.
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if int(data["version"]) != CHUNK_METADATA_VERSION:
+                return None
+            return str(data["fingerprint"])
+
+    @classmethod
+    def load(cls, path: str, rows: int | None = None, fingerprint: str | None = None) -> "ChunkMetadata":
+        # With `rows` and `fingerprint`, the number and the fingerprint of
+        # the chunk embeddings the metadata has to describe.
+        with np.load(path) as data:
+            if int(data["version"]) != CHUNK_METADATA_VERSION:
+                raise ValueError(f"Unsupported chunk metadata version {int(data['version'])} in {path}")
+
+            metadata = cls(data["movie_idx"], data["chunk_idx"], data["total_chunks"], str(data["fingerprint"]))
+        if fingerprint is not None and metadata.fingerprint != fingerprint:
+            raise ValueError(f"{path} describes other chunk embeddings than the saved ones, run embed_chunks")
+        if rows is not None and len(metadata) != rows:
+            raise ValueError(f"{path} describes {len(metadata)} chunks, the embeddings have {rows}")
+        return metadata
+
+    def export_json(self, path: str) -> None:
+        # Same layout as the chunk_metadata.json written by older versions,
+        # for debugging.
+        chunks: List[Dict[str, Any]] = [
+            dict(zip(CHUNK_METADATA_COLUMNS, values))
+            for values in zip(self.movie_idx.tolist(), self.chunk_idx.tolist(), self.total_chunks.tolist())
+        ]
+        with open(path, "w") as f:
+            json.dump({"chunks": chunks, "total_chunks": len(chunks)}, f, indent=2)
@@ -0,0 +1,290 @@
+import hashlib
+from itertools import batched
+import json
+import mmap
+import os
+import shutil
+from typing import Iterable, List
+
+import numpy as np
+
+from lib.movie import Movie
+
+DOC_STORE_VERSION = 1
+# Movies hashed and appended per write by `update`.
+DOC_STORE_BATCH_SIZE = 4096
+# Characters of the description shown with a search result.
+SNIPPET_LENGTH = 100
+# Once the store holds this many times more rows than movies, `update` and
+# `delete` rewrite it with only the latest row of every movie.
+COMPACT_RATIO = 2
+# Hash of the row that marks a movie as deleted; `content_hash` never
+# returns it.
+TOMBSTONE_HASH = 0
+# UTF-8 takes at most this many bytes per character.
+MAX_CHAR_BYTES = 4
+
+
+def content_hash(m: Movie) -> int:
+    # Changes whenever the title or the description does.
+    digest = hashlib.blake2b(f"{m.title}\0{m.description}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+class StoredMovie:
+    # A movie in a DocStore. Only the id is held; the title and the
+    # description are decoded from the store when read.
+    __slots__ = ("id", "_store", "_row")
+
+    def __init__(self, store: "DocStore", row: int, doc_id: int) -> None:
+        self.id = doc_id
+        self._store = store
+        self._row = row
+
+    @property
+    def title(self) -> str:
+        return self._store.text(self._row, 0)
+
+    @property
+    def description(self) -> str:
+        return self._store.text(self._row, 1)
+
+    def snippet(self, length: int = SNIPPET_LENGTH) -> str:
+        return self._store.snippet(self._row, length)
+
+    def to_movie(self) -> Movie:
+        return Movie(self.id, self.title, self.description)
+
+    def __repr__(self) -> str:
+        return f"StoredMovie(id={self.id!r}, title={self.title!r})"
+
+
+class DocStore:
+    # Movie titles and descriptions on disk under `path`, read through mmap
+    # so only the rows a search returns are ever decoded:
+    #   blob.bin     UTF-8 title then description of every row, back to back
+    #   offsets.bin  int64 (title start, description start, end) per row
+    #   ids.bin      int64 movie id per row
+    #   hashes.bin   uint64 content_hash per row
+    #   meta.json    row, movie and blob byte counts, written last
+    # Rows are only appended: an edited movie gets a new row and the latest
+    # row of an id wins. A deleted movie gets an empty row with
+    # TOMBSTONE_HASH, and the id reads as missing. Bytes past the sizes in
+    # meta.json, left by a writer that died half way, are cut off before
+    # the next append.
+    def __init__(self, path: str | None = None) -> None:
+        self.path = path or os.path.join(os.getcwd(), "cache", "docstore")
+        self.meta_path = os.path.join(self.path, "meta.json")
+        self.rows = 0
+        self.movies = 0
+        self.blob_size = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.offsets = np.empty((0, 3), dtype=np.int64)
+        self._blob: mmap.mmap | bytes = b""
+        self._sorted_ids: np.ndarray | None = None
+        self._order: np.ndarray | None = None
+        self._loaded = False
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _recover(self) -> None:
+        # `compact` moves the store to .old only once .tmp is complete, and
+        # .tmp into place before deleting .old. A crash in between leaves
+        # no store but both of them; the compacted one is the newer.
+        old, tmp = f"{self.path}.old", f"{self.path}.tmp"
+        if os.path.exists(self.path) or not os.path.exists(old):
+            return
+        os.rename(tmp if os.path.exists(tmp) else old, self.path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def _load(self) -> None:
+        self._recover()
+        meta = {"version": DOC_STORE_VERSION, "rows": 0, "movies": 0, "blob_size": 0}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        if meta["version"] != DOC_STORE_VERSION:
+            raise ValueError(f"Unsupported document store version {meta['version']} in {self.path}")
+
+        self.rows = meta["rows"]
+        self.movies = meta["movies"]
+        self.blob_size = meta["blob_size"]
+        if self.rows:
+            # Plain ndarray views of the maps: indexing an np.memmap is
+            # several times slower, and `text` does it for every field read.
+            self.ids = np.asarray(np.memmap(self._file("ids.bin"), dtype=np.int64, mode="r", shape=(self.rows,)))
+            self.hashes = np.asarray(np.memmap(self._file("hashes.bin"), dtype=np.uint64, mode="r", shape=(self.rows,)))
+            self.offsets = np.asarray(np.memmap(self._file("offsets.bin"), dtype=np.int64, mode="r", shape=(self.rows, 3)))
+        else:
+            self.ids = np.empty(0, dtype=np.int64)
+            self.hashes = np.empty(0, dtype=np.uint64)
+            self.offsets = np.empty((0, 3), dtype=np.int64)
+        if self.blob_size:
+            with open(self._file("blob.bin"), "rb") as f:
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._blob = b""
+        self._sorted_ids = None
+        self._order = None
+        self._loaded = True
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self._load()
+
+    def latest_rows(self, ids: np.ndarray) -> np.ndarray:
+        # Latest row of every id in `ids`, -1 where the store doesn't have it.
+        self._ensure_loaded()
+        ids = np.asarray(ids, dtype=np.int64)
+        if not self.rows:
+            return np.full(len(ids), -1, dtype=np.int64)
+
+        if self._sorted_ids is None:
+            if np.all(self.ids[1:] > self.ids[:-1]):
+                # One row per id, written in id order: the usual shape after
+                # a build or a compaction, searchable without a copy.
+                self._sorted_ids, self._order = self.ids, None
+            else:
+                # Stable, so the last of equal ids is the newest row.
+                self._order = np.argsort(self.ids, kind="stable")
+                self._sorted_ids = self.ids[self._order]
+        j = np.searchsorted(self._sorted_ids, ids, side="right") - 1
+        clipped = np.maximum(j, 0)
+        found = (j >= 0) & (self._sorted_ids[clipped] == ids)
+        rows = clipped if self._order is None else self._order[clipped]
+        found &= self.hashes[rows] != TOMBSTONE_HASH
+        return np.where(found, rows, -1)
+
+    def row(self, doc_id: int) -> int:
+        row = int(self.latest_rows(np.array([doc_id]))[0])
+        if row < 0:
+            # Another DocStore object may have appended it since we loaded.
+            self._load()
+            row = int(self.latest_rows(np.array([doc_id]))[0])
+            if row < 0:
+                raise KeyError(doc_id)
+        return row
+
+    def __contains__(self, doc_id: int) -> bool:
+        return int(self.latest_rows(np.array([doc_id]))[0]) >= 0
+
+    def __getitem__(self, doc_id: int) -> StoredMovie:
+        return StoredMovie(self, self.row(doc_id), doc_id)
+
+    def get_many(self, doc_ids: List[int]) -> List[StoredMovie]:
+        rows = self.latest_rows(np.array(doc_ids, dtype=np.int64))
+        if np.any(rows < 0):
+            return [self[doc_id] for doc_id in doc_ids]
+        return [StoredMovie(self, row, doc_id) for row, doc_id in zip(rows.tolist(), doc_ids)]
+
+    def text(self, row: int, field: int) -> str:
+        # field 0 is the title, 1 the description.
+        start, end = self.offsets.item(row, field), self.offsets.item(row, field + 1)
+        return self._blob[start:end].decode()
+
+    def snippet(self, row: int, length: int = SNIPPET_LENGTH) -> str:
+        # The first `length` characters of the description, decoding only
+        # the bytes that can hold them.
+        start, end = self.offsets.item(row, 1), self.offsets.item(row, 2)
+        return self._blob[start:min(end, start + length * MAX_CHAR_BYTES)].decode(errors="ignore")[:length]
+
+    def update(self, movies: Iterable[Movie]) -> int:
+        # Appends the movies that are new or changed since their latest row
+        # and returns how many were written.
+        self._ensure_loaded()
+        written = 0
+        for batch in batched(movies, DOC_STORE_BATCH_SIZE):
+            ids = np.fromiter((m.id for m in batch), dtype=np.int64, count=len(batch))
+            # Only the last of repeated ids in the batch counts.
+            _, last = np.unique(ids[::-1], return_index=True)
+            keep = np.sort(len(ids) - 1 - last)
+            hashes = np.fromiter((content_hash(batch[i]) for i in keep.tolist()), dtype=np.uint64, count=len(keep))
+            rows = self.latest_rows(ids[keep])
+            known = rows >= 0
+            changed = ~known
+            changed[known] = self.hashes[rows[known]] != hashes[known]
+            if changed.any():
+                new = int(np.count_nonzero(~known))
+                self._append([batch[i] for i in keep[changed].tolist()], ids[keep][changed], hashes[changed], new)
+                written += int(changed.sum())
+
+        if written and self.rows > COMPACT_RATIO * self.movies:
+            self.compact()
+        return written
+
+    def delete(self, doc_ids: Iterable[int]) -> int:
+        # Tombstones the movies the store has and returns how many that was.
+        # Their rows are dropped by the next compaction.
+        self._ensure_loaded()
+        ids = np.unique(np.fromiter(doc_ids, dtype=np.int64))
+        ids = ids[self.latest_rows(ids) >= 0]
+        if not len(ids):
+            return 0
+
+        tombstones = [Movie(doc_id, "", "") for doc_id in ids.tolist()]
+        self._append(tombstones, ids, np.full(len(ids), TOMBSTONE_HASH, dtype=np.uint64), -len(ids))
+        if self.rows > COMPACT_RATIO * self.movies:
+            self.compact()
+        return len(ids)
+
+    def _append(self, movies: List[Movie], ids: np.ndarray, hashes: np.ndarray, new: int) -> None:
+        # `new` is the change in the number of live movies: how many of
+        # `movies` have no live row yet, or minus the number of tombstones.
+        os.makedirs(self.path, exist_ok=True)
+        parts = []
+        lengths = np.empty(2 * len(movies), dtype=np.int64)
+        for i, m in enumerate(movies):
+            title, description = m.title.encode(), m.description.encode()
+            parts += (title, description)
+            lengths[2 * i] = len(title)
+            lengths[2 * i + 1] = len(description)
+        ends = self.blob_size + np.cumsum(lengths)
+        starts = ends - lengths
+        offsets = np.stack([starts[0::2], starts[1::2], ends[1::2]], axis=1)
+
+        sizes = {"blob.bin": self.blob_size, "ids.bin": 8 * self.rows, "hashes.bin": 8 * self.rows, "offsets.bin": 24 * self.rows}
+        for name, size in sizes.items():
+            if os.path.exists(self._file(name)) and os.path.getsize(self._file(name)) > size:
+                os.truncate(self._file(name), size)
+
+        with open(self._file("blob.bin"), "ab") as f:
+            f.write(b"".join(parts))
+        for name, array in (("ids.bin", ids), ("hashes.bin", hashes), ("offsets.bin", offsets)):
+            with open(self._file(name), "ab") as f:
+                array.tofile(f)
+
+        self._write_meta(self.rows + len(movies), self.movies + new, int(ends[-1]))
+
+    def _write_meta(self, rows: int, movies: int, blob_size: int) -> None:
+        meta = {"version": DOC_STORE_VERSION, "rows": rows, "movies": movies, "blob_size": blob_size}
+        with open(f"{self.meta_path}.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(f"{self.meta_path}.tmp", self.meta_path)
+        self._load()
+
+    def compact(self) -> None:
+        # Rewrites the store with only the latest row of every movie that
+        # isn't deleted. Open memory maps keep reading the old files until
+        # they are reloaded.
+        self._ensure_loaded()
+        # In id order, so lookups in the compacted store need no sort.
+        latest = self.latest_rows(np.unique(self.ids))
+        latest = latest[latest >= 0]
+        tmp, old = DocStore(f"{self.path}.tmp"), f"{self.path}.old"
+        shutil.rmtree(tmp.path, ignore_errors=True)
+        shutil.rmtree(old, ignore_errors=True)
+        os.makedirs(tmp.path)
+        # Every movie deleted still leaves a valid, empty store.
+        tmp._write_meta(0, 0, 0)
+        for rows in batched(latest.tolist(), DOC_STORE_BATCH_SIZE):
+            movies = [Movie(int(self.ids[r]), self.text(r, 0), self.text(r, 1)) for r in rows]
+            tmp._append(movies, self.ids[list(rows)], self.hashes[list(rows)], len(movies))
+
+        # Two renames, so a crash at any point leaves a complete store that
+        # `_recover` finds.
+        os.rename(self.path, old)
+        os.rename(tmp.path, self.path)
+        shutil.rmtree(old)
+        self._load()
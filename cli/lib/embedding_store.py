@@ -0,0 +1,279 @@
+import hashlib
+import json
+import os
+import time
+from itertools import batched
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+EMBEDDING_STORE_VERSION = 1
+EMBEDDING_CHECKPOINT_VERSION = 1
+# Texts read from the stream at a time; their new ones are sorted by length
+# before batching.
+ENCODE_WINDOW = 1 << 14
+# Texts per encode call, and so per checkpoint.
+ENCODE_BATCH_SIZE = 256
+# Rows the checkpoint file is first allocated for; it doubles when full.
+CHECKPOINT_INITIAL_ROWS = 1 << 12
+# Rows copied into the rewritten embeddings file at a time.
+COPY_BLOCK_ROWS = 1 << 16
+
+
+class EmbeddingStore:
+    # Content-addressed cache around an embeddings .npy file. Row i of the
+    # matrix is stored next to the sha256 of (model name, settings, text i),
+    # so when the texts change only new or edited ones are re-encoded and
+    # rows whose text is gone are dropped on the next save.
+    def __init__(self, embeddings_path: str, model_name: str, settings: Dict[str, Any]) -> None:
+        base, _ = os.path.splitext(embeddings_path)
+        self.embeddings_path = embeddings_path
+        self.keys_path = f"{base}_keys.npy"
+        self.manifest_path = f"{base}_manifest.json"
+        self.model_name = model_name
+        self.settings = settings
+        self.keys: np.ndarray | None = None
+        # Texts encoded by the last `load_or_encode` and the time spent in
+        # `encode`, for throughput reporting.
+        self.encoded = 0
+        self.encode_seconds = 0.0
+        self.key_prefix = json.dumps({"model": model_name, "settings": settings}, sort_keys=True).encode()
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(self.key_prefix + b"\0" + text.encode()).digest()
+
+    def fingerprint(self) -> str:
+        # Identifies the exact rows returned by the last `load_or_encode`.
+        if self.keys is None:
+            raise ValueError("No embeddings loaded. Call `load_or_encode` first.")
+        return hashlib.sha256(self.keys.tobytes()).hexdigest()
+
+    def stored_fingerprint(self) -> str | None:
+        # `fingerprint` of the saved embeddings, read without the texts;
+        # None when there are none.
+        stored = self._load()
+        if stored is None:
+            return None
+        return hashlib.sha256(stored[0].tobytes()).hexdigest()
+
+    def load(self) -> np.ndarray | None:
+        # The saved embeddings, memory-mapped, read without the texts; after
+        # it `fingerprint` identifies them. None when there are none or they
+        # are of another model or settings.
+        stored = self._load()
+        if stored is None:
+            return None
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["model"] != self.model_name or manifest["settings"] != self.settings:
+            return None
+
+        self.keys, embeddings = stored
+        return embeddings
+
+    def _load(self) -> Tuple[np.ndarray, np.ndarray] | None:
+        if not all(os.path.exists(p) for p in (self.manifest_path, self.keys_path, self.embeddings_path)):
+            return None
+
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+
+        keys = np.load(self.keys_path)
+        embeddings = np.load(self.embeddings_path, mmap_mode="r")
+        if manifest.get("version") != EMBEDDING_STORE_VERSION or not manifest["count"] == len(keys) == len(embeddings):
+            return None
+
+        return keys, embeddings
+
+    def _save(self, keys: np.ndarray, dim: int) -> None:
+        # The embeddings file is already in place; the keys and the manifest
+        # are written after it.
+        with open(f"{self.keys_path}.tmp", "wb") as f:
+            np.save(f, keys)
+        os.replace(f"{self.keys_path}.tmp", self.keys_path)
+
+        manifest = {
+            "version": EMBEDDING_STORE_VERSION,
+            "model": self.model_name,
+            "settings": self.settings,
+            "count": len(keys),
+            "dim": dim,
+        }
+        with open(f"{self.manifest_path}.tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+    def load_or_encode(
+        self,
+        texts: Iterable[str],
+        encode: Callable[[List[str]], np.ndarray],
+        window: int = ENCODE_WINDOW,
+        batch_size: int = ENCODE_BATCH_SIZE,
+    ) -> Tuple[np.ndarray, bool]:
+        # Returns the embeddings aligned with `texts` and whether anything
+        # had to be encoded or evicted. `texts` is consumed once, `window`
+        # texts at a time. The new texts of a window are sorted by length
+        # so each encode batch pads little, and every encoded batch is
+        # checkpointed, so an interrupted build resumes where it stopped.
+        # The result is memory-mapped from the embeddings file.
+        stored = self._load()
+        stored_keys, stored_embeddings = stored if stored is not None else (np.empty(0, dtype="S32"), None)
+        stored_rows = {k: i for i, k in enumerate(stored_keys.tolist())}
+
+        os.makedirs(os.path.dirname(self.embeddings_path) or ".", exist_ok=True)
+        checkpoint = EmbeddingCheckpoint(self.embeddings_path, self.key_prefix)
+        resumed = checkpoint.resume()
+        if resumed:
+            print(f"Resuming from checkpoint with {resumed} encoded texts")
+
+        self.encoded = 0
+        self.encode_seconds = 0.0
+        key_blocks: List[np.ndarray] = []
+        for window_texts in batched(texts, window):
+            key_block = np.array([self.key(t) for t in window_texts], dtype="S32")
+            key_blocks.append(key_block)
+            # Read back from the array so the dict keys match `.tolist()`
+            # of stored keys, which drops trailing NUL bytes.
+            todo: Dict[bytes, str] = {}
+            for k, t in zip(key_block.tolist(), window_texts):
+                if k not in stored_rows and k not in checkpoint.rows:
+                    todo.setdefault(k, t)
+
+            for batch in batched(sorted(todo.items(), key=lambda item: len(item[1])), batch_size):
+                start = time.perf_counter()
+                encoded = np.asarray(encode([t for _, t in batch]))
+                self.encode_seconds += time.perf_counter() - start
+                self.encoded += len(batch)
+                checkpoint.append([k for k, _ in batch], encoded)
+
+        keys = np.concatenate(key_blocks) if key_blocks else np.empty(0, dtype="S32")
+        self.keys = keys
+        if stored_embeddings is not None and np.array_equal(stored_keys, keys):
+            checkpoint.discard()
+            return stored_embeddings, False
+
+        key_list = keys.tolist()
+        reused = sum(1 for k in key_list if k in stored_rows)
+        evicted = len(set(stored_rows) - set(key_list))
+        # Duplicate texts share a key and are encoded once: `encoded` counts
+        # the unique texts sent to the model in this run.
+        print(f"Embedding cache: {reused} reused, {self.encoded} encoded, {evicted} evicted")
+
+        if stored_embeddings is not None:
+            dtype, dim = stored_embeddings.dtype, stored_embeddings.shape[1]
+        elif checkpoint.embeddings is not None:
+            dtype, dim = checkpoint.embeddings.dtype, checkpoint.embeddings.shape[1]
+        else:
+            dtype, dim = np.dtype(np.float32), 0
+        self._write_embeddings(keys, stored_rows, stored_embeddings, checkpoint.rows, checkpoint.embeddings, dtype, dim)
+        checkpoint.discard()
+
+        self._save(keys, dim)
+        return np.load(self.embeddings_path, mmap_mode="r"), True
+
+    def _write_embeddings(
+        self,
+        keys: np.ndarray,
+        stored_rows: Dict[bytes, int],
+        stored_embeddings: np.ndarray | None,
+        new_rows: Dict[bytes, int],
+        new_embeddings: np.ndarray | None,
+        dtype: Any,
+        dim: int,
+    ) -> None:
+        # Fills the new embeddings file in blocks of rows, each row copied
+        # from the old file or from the freshly encoded ones.
+        out = np.lib.format.open_memmap(f"{self.embeddings_path}.tmp", mode="w+", dtype=dtype, shape=(len(keys), dim))
+        for start in range(0, len(keys), COPY_BLOCK_ROWS):
+            block = keys[start:start + COPY_BLOCK_ROWS].tolist()
+            source = np.array([stored_rows.get(k, -1) for k in block], dtype=np.int64)
+            is_stored = source >= 0
+            if is_stored.any():
+                out[start:start + len(block)][is_stored] = stored_embeddings[source[is_stored]]  # type: ignore[index]
+            if not is_stored.all():
+                new = np.array([new_rows[k] for k, s in zip(block, is_stored.tolist()) if not s], dtype=np.int64)
+                out[start:start + len(block)][~is_stored] = new_embeddings[new]  # type: ignore[index]
+        out.flush()
+        del out
+        os.replace(f"{self.embeddings_path}.tmp", self.embeddings_path)
+
+
+class EmbeddingCheckpoint:
+    # Encoded rows that are not merged into the store yet, in a
+    # preallocated memory-mapped .npy (and a matching keys .npy) that
+    # doubles in size when full. The JSON sidecar records how many rows are
+    # complete and is rewritten after every batch is flushed, so after a
+    # crash everything up to the last completed batch is reused.
+    def __init__(self, embeddings_path: str, key_prefix: bytes) -> None:
+        base, _ = os.path.splitext(embeddings_path)
+        self.rows_path = f"{base}_checkpoint.npy"
+        self.keys_path = f"{base}_checkpoint_keys.npy"
+        self.meta_path = f"{base}_checkpoint.json"
+        self.tag = hashlib.sha256(key_prefix).hexdigest()
+        self.rows: Dict[bytes, int] = {}
+        self.count = 0
+        self.capacity = 0
+        self._embeddings: np.ndarray | None = None
+        self._keys: np.ndarray | None = None
+
+    @property
+    def embeddings(self) -> np.ndarray | None:
+        return self._embeddings[:self.count] if self._embeddings is not None else None
+
+    def resume(self) -> int:
+        if not os.path.exists(self.meta_path):
+            return 0
+
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        stale = meta.get("version") != EMBEDDING_CHECKPOINT_VERSION or meta.get("tag") != self.tag
+        if stale or not (os.path.exists(self.rows_path) and os.path.exists(self.keys_path)):
+            self.discard()
+            return 0
+
+        self._embeddings = np.lib.format.open_memmap(self.rows_path, mode="r+")
+        self._keys = np.lib.format.open_memmap(self.keys_path, mode="r+")
+        self.capacity = len(self._keys)
+        self.count = meta["count"]
+        self.rows = {k: i for i, k in enumerate(self._keys[:self.count].tolist())}
+        return self.count
+
+    def _allocate(self, capacity: int, dtype: Any, dim: int) -> None:
+        embeddings = np.lib.format.open_memmap(f"{self.rows_path}.tmp", mode="w+", dtype=dtype, shape=(capacity, dim))
+        keys = np.lib.format.open_memmap(f"{self.keys_path}.tmp", mode="w+", dtype="S32", shape=(capacity,))
+        if self._embeddings is not None and self._keys is not None:
+            embeddings[:self.count] = self._embeddings[:self.count]
+            keys[:self.count] = self._keys[:self.count]
+        embeddings.flush()
+        keys.flush()
+        os.replace(f"{self.rows_path}.tmp", self.rows_path)
+        os.replace(f"{self.keys_path}.tmp", self.keys_path)
+        self._embeddings, self._keys, self.capacity = embeddings, keys, capacity
+
+    def append(self, keys: List[bytes], embeddings: np.ndarray) -> None:
+        n = len(keys)
+        if self._embeddings is None:
+            self._allocate(max(n, CHECKPOINT_INITIAL_ROWS), embeddings.dtype, embeddings.shape[1])
+        elif self.count + n > self.capacity:
+            self._allocate(max(self.count + n, 2 * self.capacity), self._embeddings.dtype, self._embeddings.shape[1])
+
+        self._embeddings[self.count:self.count + n] = embeddings  # type: ignore[index]
+        self._keys[self.count:self.count + n] = keys  # type: ignore[index]
+        self._embeddings.flush()  # type: ignore[union-attr]
+        self._keys.flush()  # type: ignore[union-attr]
+        for i, k in enumerate(np.array(keys, dtype="S32").tolist()):
+            self.rows[k] = self.count + i
+        self.count += n
+
+        with open(f"{self.meta_path}.tmp", "w") as f:
+            json.dump({"version": EMBEDDING_CHECKPOINT_VERSION, "tag": self.tag, "count": self.count}, f)
+        os.replace(f"{self.meta_path}.tmp", self.meta_path)
+
+    def discard(self) -> None:
+        self._embeddings = self._keys = None
+        self.rows = {}
+        self.count = self.capacity = 0
+        # The sidecar goes first so a half-removed checkpoint is never resumed.
+        for path in (self.meta_path, self.rows_path, self.keys_path):
+            if os.path.exists(path):
+                os.remove(path)
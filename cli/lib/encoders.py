@@ -0,0 +1,162 @@
+import glob
+import os
+import platform
+from typing import Dict, List
+
+import numpy as np
+
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
+# "torch" is the sentence-transformers PyTorch model. The others run an
+# ONNX export of it with onnxruntime, from a local directory written by
+# `export_encoder`; "onnx-int8" is that export with its weights dynamically
+# quantized to int8.
+ENCODER_BACKENDS = ("torch", "onnx", "onnx-int8")
+DEFAULT_ENCODER_BACKEND = "torch"
+# Instruction sets the int8 weights can be quantized for. A model
+# quantized for one the CPU lacks runs slowly, or not at all.
+QUANTIZATION_CONFIGS = ("arm64", "avx2", "avx512", "avx512_vnni")
+# For x86 CPUs whose flags can't be read: every x86 server of the last
+# decade has AVX2.
+PORTABLE_QUANTIZATION_CONFIG = "avx2"
+ONNX_FILE = os.path.join("onnx", "model.onnx")
+# Lowest per-text cosine similarity to the torch model's embedding that
+# `embedding_parity` callers accept for another backend.
+MIN_PARITY_COSINE = 0.99
+ONNX_EXTRA_HINT = "install the onnx extra: uv sync --extra onnx, or pip install -e '.[onnx]'"
+
+
+def check_backend(backend: str) -> None:
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {', '.join(ENCODER_BACKENDS)}")
+
+
+def require_onnx(backend: str) -> None:
+    # onnxruntime and optimum, which sentence-transformers runs and exports
+    # ONNX models with, are optional dependencies.
+    try:
+        import onnxruntime  # noqa: F401
+        import optimum.onnxruntime  # noqa: F401
+    except ImportError as e:
+        raise ImportError(f"The {backend} encoder backend needs onnxruntime and optimum; {ONNX_EXTRA_HINT}") from e
+
+
+def encoder_id(model_name: str, backend: str) -> str:
+    # Names the embeddings a backend produces in the embedding and query
+    # caches. Backends don't give bit-identical vectors, so each gets its
+    # own entries; torch keeps the bare model name so existing caches stay
+    # valid.
+    return model_name if backend == DEFAULT_ENCODER_BACKEND else f"{model_name}+{backend}"
+
+
+def default_encoder_path(model_name: str) -> str:
+    name = os.path.basename(os.path.normpath(model_name))
+    return os.path.join(os.getcwd(), "cache", "encoders", f"{name}-onnx")
+
+
+def host_quantization_config() -> str:
+    # The fastest of QUANTIZATION_CONFIGS this CPU runs.
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = next((line.split(":", 1)[1].split() for line in f if line.startswith("flags")), [])
+    except OSError:
+        return PORTABLE_QUANTIZATION_CONFIG
+    if "avx512_vnni" in flags:
+        return "avx512_vnni"
+    if "avx512f" in flags and "avx512bw" in flags:
+        return "avx512"
+    return PORTABLE_QUANTIZATION_CONFIG
+
+
+def int8_files(path: str, config: str = "*") -> List[str]:
+    # sentence-transformers names a quantized export after its weights'
+    # dtype and config: model_qint8_avx512_vnni.onnx, model_quint8_avx2.onnx.
+    return sorted(glob.glob(os.path.join(path, "onnx", f"model_q*int8_{config}.onnx")))
+
+
+def onnx_file(backend: str, path: str) -> str:
+    # The model file `backend` runs, relative to `path`. For "onnx-int8",
+    # the export quantized for this CPU, else whichever one was exported.
+    if backend == "onnx":
+        return ONNX_FILE
+
+    exported = int8_files(path, host_quantization_config()) or int8_files(path)
+    if not exported:
+        return os.path.join("onnx", f"model_qint8_{host_quantization_config()}.onnx")
+    return os.path.relpath(exported[0], path)
+
+
+def load_encoder(model_name: str, backend: str = DEFAULT_ENCODER_BACKEND, path: str | None = None, threads: int | None = None):
+    # `threads` caps the threads one encode call uses; None leaves the
+    # runtime's default of one per core.
+    check_backend(backend)
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            set_torch_threads(threads)
+        return SentenceTransformer(model_name)
+
+    path = path or default_encoder_path(model_name)
+    file_name = onnx_file(backend, path)
+    if not os.path.exists(os.path.join(path, file_name)):
+        raise FileNotFoundError(
+            f"{os.path.join(path, file_name)} doesn't exist, run semantic_search_cli.py export_encoder --backend {backend}"
+        )
+
+    require_onnx(backend)
+    import onnxruntime
+    from sentence_transformers import SentenceTransformer
+
+    model_kwargs = {"file_name": file_name, "provider": "CPUExecutionProvider"}
+    if threads:
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        model_kwargs["session_options"] = options
+    return SentenceTransformer(path, backend="onnx", model_kwargs=model_kwargs)
+
+
+def set_torch_threads(threads: int) -> None:
+    import torch
+
+    torch.set_num_threads(threads)
+
+
+def export_encoder(
+    model_name: str, backend: str, path: str | None = None, quantization_config: str | None = None
+) -> str:
+    # Writes the ONNX model (and for "onnx-int8" its copy quantized for
+    # `quantization_config`, this CPU's by default) to `path` and returns
+    # the file `load_encoder` will run.
+    check_backend(backend)
+    if backend == "torch":
+        raise ValueError("The torch backend loads the model directly, there is nothing to export")
+    config = quantization_config or host_quantization_config()
+    if config not in QUANTIZATION_CONFIGS:
+        raise ValueError(f"Unknown quantization config {config!r}, expected one of {', '.join(QUANTIZATION_CONFIGS)}")
+
+    require_onnx(backend)
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    path = path or default_encoder_path(model_name)
+    model = SentenceTransformer(model_name, backend="onnx")
+    model.save_pretrained(path)
+    if backend == "onnx":
+        return os.path.join(path, ONNX_FILE)
+
+    export_dynamic_quantized_onnx_model(model, config, path)
+    return int8_files(path, config)[0]
+
+
+def embedding_parity(reference: np.ndarray, candidate: np.ndarray) -> Dict[str, float]:
+    # Cosine similarity between two encoders' embeddings of the same texts,
+    # row by row.
+    if reference.shape != candidate.shape:
+        raise ValueError(f"Embedding shapes differ: {reference.shape} and {candidate.shape}")
+
+    ref = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    cand = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    cosines = np.sum(ref * cand, axis=1)
+    return {"min_cosine": float(cosines.min()), "mean_cosine": float(cosines.mean())}
@@ -1,11 +1,24 @@
 import os
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, TypedDict
 
-from .movie import Movie
+import numpy as np
+
+from .doc_store import SNIPPET_LENGTH, DocStore, StoredMovie
+from .encoders import DEFAULT_ENCODER_BACKEND
+from .movie import Movie, iter_movies, load_movies
 from .keyword_search import InvertedIndex
-from .semantic_search import ChunkedSemanticSearch
+from .query_cache import LRUCache, QueryEmbeddingCache
+from .semantic_search import ChunkedSemanticSearch, SemanticSearchResult, top_k_indices
+from .tracing import propagate, span
 import itertools
 
+# Candidates fetched from each retriever per requested result.
+WEIGHTED_CANDIDATE_MULTIPLIER = 500
+RRF_CANDIDATE_MULTIPLIER = 500
+RRF_K = 60
+
 def normalize(values: list[float]) -> list[float]:
     if len(values) == 0:
         return []
@@ -28,53 +41,267 @@ def normalize2(values: list[float], low:float, high:float) -> list[float]:
     result = [(score - low) / k for score in values]
     return result
 
+def normalize_array(values: np.ndarray) -> np.ndarray:
+    # Vectorized `normalize`.
+    if len(values) == 0:
+        return values.astype(float)
+    high = values.max()
+    low = values.min()
+    if high == low:
+        return np.ones(len(values))
+
+    return (values - low) / (high - low)
+
+
+class HybridSearchResult(TypedDict):
+    id: int
+    title: str
+    document: str
+    score: float
+    bm25_score: float
+    semantic_score: float
+
+
+class RRFSearchResult(TypedDict):
+    id: int
+    title: str
+    document: str
+    score: float
+    bm25_rank: int | None
+    semantic_rank: int | None
+
+
+def timed(fn: Callable, *args) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
 
 class HybridSearch():
-    def __init__(self, documents: List[Movie]) -> None:
-        self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
-        self.semantic_search.load_or_create_chunk_embeddings(documents)
+    def __init__(
+        self,
+        documents: List[Movie] | None = None,
+        model=None,
+        query_cache: QueryEmbeddingCache | None = None,
+        result_cache: LRUCache | None = None,
+        backend: str = DEFAULT_ENCODER_BACKEND,
+        encoder_path: str | None = None,
+        threads: int | None = None,
+    ) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="retriever")
+        # Fused results are cached here, keyed on the versions of both
+        # retrievers; the retrievers themselves only share the query cache.
+        self.result_cache = result_cache
+        # One store for both retrievers, so each movie is stored and hashed
+        # once per build and the results of either read the same files.
+        self.docs = DocStore()
+        # `documents`, data/movies.json by default, are only read to build
+        # chunk embeddings or an index that isn't saved yet; `sync` picks up
+        # later changes to them.
+        with span("hybrid.load"):
+            self.semantic_search = ChunkedSemanticSearch(
+                model=model,
+                query_cache=query_cache,
+                docs=self.docs,
+                backend=backend,
+                encoder_path=encoder_path,
+                threads=threads,
+            )
+            self.semantic_search.load_or_create_chunk_embeddings(iter_movies() if documents is None else documents)
 
-        self.idx = InvertedIndex()
-        if not os.path.exists(self.idx.index_path):
-            self.idx.build()
-            self.idx.save()
+            self.idx = InvertedIndex(docs=self.docs)
+            if not self.idx.exists():
+                self.idx.build(documents)
+                self.idx.save()
+            else:
+                self.idx.load()
+
+    def sync(self, documents: List[Movie] | None = None) -> None:
+        # Brings the chunk embeddings and the index in line with
+        # `documents`, only encoding and re-indexing the movies that were
+        # added, edited or removed.
+        documents = load_movies() if documents is None else documents
+        self.semantic_search.build_chunk_embeddings(documents)
+        self.idx.sync_documents(documents)
+
+    def version(self) -> str:
+        return f"{self.idx.version()}|{self.semantic_search.version()}"
 
     def _bm_25_search(self, query:str, limit:int):
-        self.idx.load()
         return self.idx.bm25_search(query, limit)
 
     def _semantic_search(self, query:str, limit:int):
         return self.semantic_search.search_chunks(query, limit)
 
-    def weighted_search(self, query:str, alpha:float, limit:int=5):
-        print("Running weighted search...")
-        search_limit = limit * 500
-        bm25 = self._bm_25_search(query, search_limit)
-        semantic = self._semantic_search(query, search_limit)
-        bm25_scores = [score for _, score in bm25]
-        maxbm25 = max(bm25_scores)
-        minbm25 = min(bm25_scores)
-        semantic_scores = [i["score"] for i in semantic]
-        max_semantic_score = max(semantic_scores)
-        min_semantic_score = min(semantic_scores)
-        max_score = max(maxbm25, max_semantic_score)
-        min_score = min(minbm25, min_semantic_score)
-        # for i in range(len(bm25)):
-        for i in range(5):
-            keyword_item = bm25[i]
-            item_id = keyword_item[0].id 
-            semantic_item = next((i for i in semantic if i["id"] == keyword_item[0].id), None)
-            if semantic_item is None:
-                print(f"Item with id: {item_id} not found in semantic search results.")
-                continue
-
-            
-
-            
-            # print(keyword_item[0].id)
-            # print(semantic_item["id"])
-
-    def rrf_search(self, query:str, k:float, limit:int=10):
-        raise NotImplementedError("RRF hybrid search is not implemented yet.")
+    def _retrieve(
+        self, query: str, depth: int, timings: Dict[str, float] | None = None, semantic: bool = True
+    ) -> Tuple[List[Tuple[StoredMovie, float]], List[SemanticSearchResult]]:
+        # BM25 and the semantic encode + scan are independent, and torch and
+        # numpy release the GIL, so latency is about the slower of the two.
+        if not semantic:
+            # BM25 only: the model is never loaded.
+            bm25, bm25_time = timed(self._bm_25_search, query, depth)
+            if timings is not None:
+                timings["bm25"] = bm25_time
+            return bm25, []
+
+        bm25_future = self.executor.submit(propagate(timed), self._bm_25_search, query, depth)
+        semantic_future = self.executor.submit(propagate(timed), self._semantic_search, query, depth)
+        bm25, bm25_time = bm25_future.result()
+        semantic, semantic_time = semantic_future.result()
+        if timings is not None:
+            timings["bm25"] = bm25_time
+            timings["semantic"] = semantic_time
+
+        return bm25, semantic
+
+    def weighted_search(
+        self,
+        query:str,
+        alpha:float,
+        limit:int=5,
+        candidates:int | None = None,
+        timings: Dict[str, float] | None = None,
+    ) -> List[HybridSearchResult]:
+        depth = candidates or limit * WEIGHTED_CANDIDATE_MULTIPLIER
+        with span("hybrid.weighted_search"):
+            key = ("weighted", query, alpha, limit, depth, self.version())
+            cached = self.result_cache.get(key) if self.result_cache is not None else None
+            if cached is not None:
+                return cached
+
+            # With alpha 1 the semantic scores carry no weight.
+            bm25, semantic = self._retrieve(query, depth, timings, semantic=alpha < 1)
+            with span("fusion"):
+                results, fusion_time = timed(self.weighted_fusion, bm25, semantic, alpha, limit)
+        if timings is not None:
+            timings["fusion"] = fusion_time
+        if self.result_cache is not None:
+            self.result_cache.put(key, results)
+        return results
+
+    def weighted_search_batch(
+        self, queries: List[str], alpha: float, limit: int = 5, candidates: int | None = None
+    ) -> List[List[HybridSearchResult]]:
+        depth = candidates or limit * WEIGHTED_CANDIDATE_MULTIPLIER
+        with span("hybrid.weighted_search_batch"):
+            if alpha < 1:
+                semantic = self.semantic_search.search_chunks_batch(queries, depth)
+            else:
+                semantic = [[] for _ in queries]
+            results = []
+            for q, s in zip(queries, semantic):
+                bm25 = self._bm_25_search(q, depth)
+                with span("fusion"):
+                    results.append(self.weighted_fusion(bm25, s, alpha, limit))
+            return results
+
+    def _join_candidates(
+        self, bm25: List[Tuple[StoredMovie, float]], semantic: List[SemanticSearchResult]
+    ) -> Tuple[List[Tuple[StoredMovie, float]], List[StoredMovie], np.ndarray]:
+        # bm25_search pads with zero-score documents when few match; those
+        # are not keyword hits.
+        bm25 = [(m, score) for m, score in bm25 if score > 0]
+
+        # Each candidate gets a slot on first sight, so the join is one pass
+        # over both lists. BM25 hits take slots 0..len(bm25) in rank order.
+        slots: Dict[int, int] = {}
+        movies: List[StoredMovie] = []
+        for m, _ in bm25:
+            slots[m.id] = len(movies)
+            movies.append(m)
+        semantic_only = []
+        for item in semantic:
+            if item["id"] not in slots:
+                slots[item["id"]] = len(movies) + len(semantic_only)
+                semantic_only.append(item["id"])
+        movies.extend(self.docs.get_many(semantic_only))
+
+        semantic_slots = np.fromiter((slots[item["id"]] for item in semantic), dtype=np.int64, count=len(semantic))
+        return bm25, movies, semantic_slots
+
+    def weighted_fusion(
+        self,
+        bm25: List[Tuple[StoredMovie, float]],
+        semantic: List[SemanticSearchResult],
+        alpha: float,
+        limit: int,
+    ) -> List[HybridSearchResult]:
+        bm25, movies, semantic_slots = self._join_candidates(bm25, semantic)
+        bm25_scores = np.zeros(len(movies))
+        semantic_scores = np.zeros(len(movies))
+        bm25_scores[: len(bm25)] = normalize_array(np.array([score for _, score in bm25]))
+        semantic_scores[semantic_slots] = normalize_array(np.array([item["score"] for item in semantic]))
+
+        hybrid_scores = alpha * bm25_scores + (1 - alpha) * semantic_scores
+        results: List[HybridSearchResult] = []
+        for i in top_k_indices(hybrid_scores, limit).tolist():
+            m = movies[i]
+            results.append({
+                "id": m.id,
+                "title": m.title,
+                "document": m.snippet(SNIPPET_LENGTH),
+                "score": float(hybrid_scores[i]),
+                "bm25_score": float(bm25_scores[i]),
+                "semantic_score": float(semantic_scores[i]),
+            })
+
+        return results
+
+    def rrf_search(
+        self,
+        query:str,
+        k:float = RRF_K,
+        limit:int=10,
+        candidates:int | None = None,
+        timings: Dict[str, float] | None = None,
+    ) -> List[RRFSearchResult]:
+        depth = candidates or limit * RRF_CANDIDATE_MULTIPLIER
+        with span("hybrid.rrf_search"):
+            key = ("rrf", query, k, limit, depth, self.version())
+            cached = self.result_cache.get(key) if self.result_cache is not None else None
+            if cached is not None:
+                return cached
+
+            bm25, semantic = self._retrieve(query, depth, timings)
+            with span("fusion"):
+                results, fusion_time = timed(self.rrf_fusion, bm25, semantic, k, limit)
+        if timings is not None:
+            timings["fusion"] = fusion_time
+        if self.result_cache is not None:
+            self.result_cache.put(key, results)
+        return results
+
+    def rrf_fusion(
+        self,
+        bm25: List[Tuple[StoredMovie, float]],
+        semantic: List[SemanticSearchResult],
+        k: float,
+        limit: int,
+    ) -> List[RRFSearchResult]:
+        bm25, movies, semantic_slots = self._join_candidates(bm25, semantic)
+        # 0 marks a document the retriever did not return.
+        bm25_ranks = np.zeros(len(movies), dtype=np.int64)
+        semantic_ranks = np.zeros(len(movies), dtype=np.int64)
+        bm25_ranks[: len(bm25)] = np.arange(1, len(bm25) + 1)
+        semantic_ranks[semantic_slots] = np.arange(1, len(semantic) + 1)
+
+        rrf_scores = np.zeros(len(movies))
+        for ranks in (bm25_ranks, semantic_ranks):
+            found = ranks > 0
+            rrf_scores[found] += 1 / (k + ranks[found])
+
+        results: List[RRFSearchResult] = []
+        for i in top_k_indices(rrf_scores, limit).tolist():
+            m = movies[i]
+            results.append({
+                "id": m.id,
+                "title": m.title,
+                "document": m.snippet(SNIPPET_LENGTH),
+                "score": float(rrf_scores[i]),
+                "bm25_rank": int(bm25_ranks[i]) or None,
+                "semantic_rank": int(semantic_ranks[i]) or None,
+            })
+
+        return results
 
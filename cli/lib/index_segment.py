@@ -0,0 +1,270 @@
+import itertools
+import json
+import os
+import shutil
+from collections import defaultdict
+from typing import Counter as CounterType, Dict, List, Tuple
+
+import numpy as np
+
+SEGMENT_FORMAT_VERSION = 3
+POSTING_ARRAYS = ("terms", "term_offsets", "postings", "frequencies", "doc_ids", "doc_lengths")
+# Added in version 2; a version 1 segment gets them computed when loaded.
+BLOCK_ARRAYS = ("block_offsets", "block_max_tfs", "block_min_lengths")
+# Added in version 3: the content hash of every document as indexed, 0 for
+# a document indexed by an older version.
+HASH_ARRAYS = ("doc_hashes",)
+SEGMENT_ARRAYS = POSTING_ARRAYS + BLOCK_ARRAYS + HASH_ARRAYS
+VERSION_ARRAYS = {1: POSTING_ARRAYS, 2: POSTING_ARRAYS + BLOCK_ARRAYS, 3: SEGMENT_ARRAYS}
+# Postings per block of the block-max score bounds.
+POSTING_BLOCK_SIZE = 128
+
+
+def block_bounds(
+    term_offsets: np.ndarray, postings: np.ndarray, frequencies: np.ndarray, doc_lengths: np.ndarray, block_size: int
+) -> Dict[str, np.ndarray]:
+    # Every posting list is cut into blocks of `block_size` postings. Per
+    # block, the highest term frequency and the shortest document bound
+    # the BM25 score of any posting in it, whatever k1, b and the average
+    # document length are at query time.
+    counts = np.diff(term_offsets)
+    n_blocks = -(-counts // block_size)
+    block_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(n_blocks, out=block_offsets[1:])
+    term_of_block = np.repeat(np.arange(len(counts)), n_blocks)
+    block_starts = term_offsets[:-1][term_of_block] + (
+        np.arange(block_offsets[-1]) - block_offsets[:-1][term_of_block]
+    ) * block_size
+
+    if len(block_starts):
+        max_tfs = np.maximum.reduceat(np.asarray(frequencies), block_starts).astype(np.int32)
+        min_lengths = np.minimum.reduceat(np.asarray(doc_lengths)[postings], block_starts).astype(np.int32)
+    else:
+        max_tfs = np.empty(0, dtype=np.int32)
+        min_lengths = np.empty(0, dtype=np.int32)
+    return {"block_offsets": block_offsets, "block_max_tfs": max_tfs, "block_min_lengths": min_lengths}
+
+
+class IndexSegment:
+    # Flat, array-backed inverted index. Documents are addressed by their
+    # position in `doc_ids`; the postings of `terms[i]` are the slice
+    # `term_offsets[i]:term_offsets[i + 1]` of `postings` (sorted positions)
+    # and `frequencies` (term frequency per posting). Its blocks are
+    # `block_offsets[i]:block_offsets[i + 1]` of the block arrays.
+    terms: np.ndarray
+    term_offsets: np.ndarray
+    postings: np.ndarray
+    frequencies: np.ndarray
+    doc_ids: np.ndarray
+    doc_lengths: np.ndarray
+    block_offsets: np.ndarray
+    block_max_tfs: np.ndarray
+    block_min_lengths: np.ndarray
+    doc_hashes: np.ndarray
+    total_length: int
+    block_size: int
+
+    def __init__(self, arrays: Dict[str, np.ndarray], total_length: int, block_size: int = POSTING_BLOCK_SIZE) -> None:
+        if "block_offsets" not in arrays:
+            arrays = {
+                **arrays,
+                **block_bounds(
+                    arrays["term_offsets"], arrays["postings"], arrays["frequencies"], arrays["doc_lengths"], block_size
+                ),
+            }
+        if "doc_hashes" not in arrays:
+            arrays = {**arrays, "doc_hashes": np.zeros(len(arrays["doc_ids"]), dtype=np.uint64)}
+        for name in SEGMENT_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.total_length = total_length
+        self.block_size = block_size
+
+    @classmethod
+    def from_term_frequencies(
+        cls, term_frequencies: Dict[int, CounterType], doc_hashes: Dict[int, int] | None = None
+    ) -> "IndexSegment":
+        postings: Dict[str, List[int]] = defaultdict(list)
+        frequencies: Dict[str, List[int]] = defaultdict(list)
+        doc_lengths: List[int] = []
+        for pos, counts in enumerate(term_frequencies.values()):
+            for t, tf in counts.items():
+                postings[t].append(pos)
+                frequencies[t].append(tf)
+            doc_lengths.append(sum(counts.values()))
+
+        terms = sorted(postings)
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(postings[t]) for t in terms], out=term_offsets[1:])
+        n_postings = int(term_offsets[-1])
+
+        arrays = {
+            "terms": np.array(terms, dtype=str) if terms else np.array([], dtype="<U1"),
+            "term_offsets": term_offsets,
+            "postings": np.fromiter(
+                itertools.chain.from_iterable(postings[t] for t in terms), dtype=np.int32, count=n_postings
+            ),
+            "frequencies": np.fromiter(
+                itertools.chain.from_iterable(frequencies[t] for t in terms), dtype=np.int32, count=n_postings
+            ),
+            "doc_ids": np.fromiter(term_frequencies.keys(), dtype=np.int64, count=len(term_frequencies)),
+            "doc_lengths": np.array(doc_lengths, dtype=np.int32),
+        }
+        if doc_hashes is not None:
+            arrays["doc_hashes"] = np.fromiter(
+                (doc_hashes[doc_id] for doc_id in term_frequencies), dtype=np.uint64, count=len(term_frequencies)
+            )
+        return cls(arrays, sum(doc_lengths))
+
+    @classmethod
+    def merge(cls, segments: List["IndexSegment"], live: List[np.ndarray | None]) -> "IndexSegment":
+        # The live documents of `segments`, in segment then position order,
+        # as one segment. The arrays are the same as `from_term_frequencies`
+        # over those documents would build.
+        remaps: List[np.ndarray] = []
+        doc_ids: List[np.ndarray] = []
+        doc_lengths: List[np.ndarray] = []
+        doc_hashes: List[np.ndarray] = []
+        offset = 0
+        for seg, mask in zip(segments, live):
+            if mask is None:
+                mask = np.ones(seg.num_docs, dtype=bool)
+            remap = np.full(seg.num_docs, -1, dtype=np.int64)
+            n_live = int(mask.sum())
+            remap[mask] = np.arange(offset, offset + n_live)
+            offset += n_live
+            remaps.append(remap)
+            doc_ids.append(np.asarray(seg.doc_ids)[mask])
+            doc_lengths.append(np.asarray(seg.doc_lengths)[mask])
+            doc_hashes.append(np.asarray(seg.doc_hashes)[mask])
+
+        all_terms = np.unique(np.concatenate([seg.terms for seg in segments])) if segments else np.array([], dtype="<U1")
+        term_ids: List[np.ndarray] = []
+        positions: List[np.ndarray] = []
+        frequencies: List[np.ndarray] = []
+        for seg, remap in zip(segments, remaps):
+            seg_term_ids = np.repeat(np.searchsorted(all_terms, seg.terms), np.diff(seg.term_offsets))
+            seg_positions = remap[seg.postings]
+            keep = seg_positions >= 0
+            term_ids.append(seg_term_ids[keep])
+            positions.append(seg_positions[keep])
+            frequencies.append(np.asarray(seg.frequencies)[keep])
+
+        term_id = np.concatenate(term_ids) if term_ids else np.empty(0, dtype=np.int64)
+        # Segments are concatenated in order and each one's postings are
+        # sorted, so a stable sort by term leaves every posting list sorted.
+        order = np.argsort(term_id, kind="stable")
+        counts = np.bincount(term_id, minlength=len(all_terms))
+        present = counts > 0
+        terms = all_terms[present]
+        width = int(np.char.str_len(terms).max()) if len(terms) else 1
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(counts[present], out=term_offsets[1:])
+
+        merged_doc_lengths = np.concatenate(doc_lengths).astype(np.int32) if doc_lengths else np.empty(0, dtype=np.int32)
+        arrays = {
+            "terms": terms.astype(f"<U{width}"),
+            "term_offsets": term_offsets,
+            "postings": np.concatenate(positions)[order].astype(np.int32) if positions else np.empty(0, dtype=np.int32),
+            "frequencies": np.concatenate(frequencies)[order].astype(np.int32) if frequencies else np.empty(0, dtype=np.int32),
+            "doc_ids": np.concatenate(doc_ids).astype(np.int64) if doc_ids else np.empty(0, dtype=np.int64),
+            "doc_lengths": merged_doc_lengths,
+            "doc_hashes": np.concatenate(doc_hashes).astype(np.uint64) if doc_hashes else np.empty(0, dtype=np.uint64),
+        }
+        return cls(arrays, int(merged_doc_lengths.sum()))
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, "meta.json"))
+
+    def save(self, path: str) -> None:
+        # Written next to `path` and swapped in, so a segment memory-mapped
+        # from `path` (possibly this one) is never truncated under a reader.
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in SEGMENT_ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(self, name))
+
+        # meta.json is written last so a half-written segment is never picked up.
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "version": SEGMENT_FORMAT_VERSION,
+                    "num_docs": len(self.doc_ids),
+                    "num_terms": len(self.terms),
+                    "total_length": self.total_length,
+                    "block_size": self.block_size,
+                },
+                f,
+            )
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "IndexSegment":
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        if meta["version"] not in VERSION_ARRAYS:
+            raise ValueError(f"Unsupported index format version {meta['version']} in {path}")
+
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in VERSION_ARRAYS[meta["version"]]
+        }
+        return cls(arrays, meta["total_length"], meta.get("block_size", POSTING_BLOCK_SIZE))
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_ids)
+
+    def term_range(self, term: str) -> Tuple[int, int]:
+        i = int(np.searchsorted(self.terms, term))
+        if i == len(self.terms) or self.terms[i] != term:
+            return 0, 0
+
+        return int(self.term_offsets[i]), int(self.term_offsets[i + 1])
+
+    def doc_freq(self, term: str) -> int:
+        start, end = self.term_range(term)
+        return end - start
+
+    def get_postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.term_range(term)
+        return self.postings[start:end], self.frequencies[start:end]
+
+    def find_postings(self, start: int, end: int, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Looks the sorted `positions` up in postings[start:end]: which ones
+        # are there, and the index in the range of each one found. A binary
+        # search per position, each starting where the previous one ended,
+        # so the cost follows len(positions), not the list length. The keys
+        # take the postings' dtype, otherwise numpy copies the whole list
+        # to a common dtype before searching.
+        postings = self.postings[start:end]
+        if not len(postings):
+            return np.zeros(len(positions), dtype=bool), np.empty(0, dtype=np.int64)
+
+        positions = positions.astype(postings.dtype, copy=False)
+        i = np.minimum(np.searchsorted(postings, positions), len(postings) - 1)
+        hit = postings[i] == positions
+        return hit, i[hit]
+
+    def get_block_bounds(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        # Highest term frequency and shortest document length per block of
+        # the term's postings.
+        i = int(np.searchsorted(self.terms, term))
+        if i == len(self.terms) or self.terms[i] != term:
+            return self.block_max_tfs[:0], self.block_min_lengths[:0]
+
+        start, end = int(self.block_offsets[i]), int(self.block_offsets[i + 1])
+        return self.block_max_tfs[start:end], self.block_min_lengths[start:end]
+
+    def get_tf(self, pos: int, term: str) -> int:
+        positions, tfs = self.get_postings(term)
+        i = int(np.searchsorted(positions, pos))
+        if i == len(positions) or positions[i] != pos:
+            return 0
+
+        return int(tfs[i])
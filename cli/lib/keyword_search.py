@@ -1,131 +1,533 @@
-from collections import defaultdict, Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+from itertools import batched
+import json
 import math
 import os
-from typing import Counter as CounterType, Dict, List, Set, Tuple
+import shutil
+import threading
+from typing import Any, Counter as CounterType, Dict, Iterable, List, Tuple
 import pickle
 
+import numpy as np
+
 from search_utils import BM25_B, BM25_K1
-from tokens import Movie, load_movies, preprocess
-from functools import reduce
+from tokens import Analyzer, Movie, get_analyzer
+from lib.doc_store import DocStore, StoredMovie, content_hash
+from lib.movie import iter_movies
+from lib.index_segment import IndexSegment
+from lib.query_cache import LRUCache, file_stamp
+from lib.tracing import span
+
+# Version 1 kept a pickled docmap per segment; the movies now live in the
+# DocStore and a version 1 manifest is migrated when loaded.
+INDEX_MANIFEST_VERSION = 2
+# Incremental updates append segments; past this many a background merge
+# folds them back into one.
+MERGE_SEGMENT_THRESHOLD = 8
+# Movies tokenized per segment by `build`.
+BUILD_BATCH_SIZE = 4096
+# Relative slack on the top-k pruning threshold, so rounding in the score
+# upper bounds can never drop a document that belongs in the results.
+PRUNING_SLACK = 1e-9
+# Below this many postings over all query terms, scoring them all is
+# cheaper than working out what to skip.
+PRUNING_MIN_POSTINGS = 4096
+# Query modes of `boolean_search`: documents with every query term, or any.
+BOOLEAN_MODES = ("and", "or")
+# The mode of a query that doesn't name one, locally and over the server.
+DEFAULT_BOOLEAN_MODE = "or"
+
+
+def build_segment(movies: Iterable[Movie], analyzer: Analyzer | None = None) -> IndexSegment:
+    # Module level so it can run in a worker process.
+    analyzer = analyzer or get_analyzer()
+    movies = list(movies)
+    contents = (f"{m.title} {m.description}" for m in movies)
+    term_frequencies: Dict[int, CounterType] = {
+        m.id: Counter(tokens) for m, tokens in zip(movies, analyzer.preprocess_many(contents))
+    }
+    return IndexSegment.from_term_frequencies(term_frequencies, {m.id: content_hash(m) for m in movies})
 
 
 class InvertedIndex:
-    index: Dict[str, Set[int]]
-    docmap: Dict[int, Movie]
-    term_frequencies: Dict[int, CounterType]
-    doc_lengths: Dict[int, int]
-
-    def __init__(self) -> None:
-        self.index = defaultdict(set)
-        self.term_frequencies = defaultdict(Counter)
-        self.docmap = {}
-        self.doc_lengths = {}
+    segments: List[IndexSegment]
+    segment_entries: List[Dict[str, Any]]
+    live_masks: List[np.ndarray | None]
+    doc_locations: Dict[int, Tuple[int, int]]
+    total_length: int
+    avg_doc_length: float
+    doc_freqs: Dict[str, int]
+    bm25_idfs: Dict[str, float]
+
+    def __init__(
+        self,
+        analyzer: Analyzer | None = None,
+        result_cache: LRUCache | None = None,
+        pruning: bool = True,
+        docs: DocStore | None = None,
+    ) -> None:
+        self.analyzer = analyzer or get_analyzer()
+        # Skip documents that can't make the top k in `bm25_search`; the
+        # results are the same either way.
+        self.pruning = pruning
+        # (query, parameters, version) -> results. Every change to the
+        # indexed documents bumps `generation`, and a rebuild by another
+        # process changes the manifest's stamp.
+        self.result_cache = result_cache
+        self.generation = 0
+        self.segments = []
+        self.segment_entries = []
+        self.live_masks = []
+        self.doc_locations = {}
+        self.total_length = 0
+        self.avg_doc_length = 0.0
+        self.doc_freqs = {}
+        self.bm25_idfs = {}
+        self._lock = threading.RLock()
+        self._merge_thread: threading.Thread | None = None
         self.cache_path = os.path.join(os.getcwd(), "cache")
-        self.index_path = os.path.join(self.cache_path, "index.pkl")
+        self.index_dir = os.path.join(self.cache_path, "index")
+        # Titles and descriptions of the results; shared with the semantic
+        # search when passed in.
+        self.docs = docs if docs is not None else DocStore(os.path.join(self.cache_path, "docstore"))
+        self.manifest_path = os.path.join(self.cache_path, "index_manifest.json")
+        self.segments_dir = os.path.join(self.cache_path, "index_segments")
+        # Legacy pickle format, only read by `load` and `convert_legacy`.
         self.docmap_path = os.path.join(self.cache_path, "docmap.pkl")
+        self.index_path = os.path.join(self.cache_path, "index.pkl")
         self.term_frequencies_path = os.path.join(self.cache_path, "term_frequencies.pkl")
         self.doc_lengths_path = os.path.join(self.cache_path, "doc_lengths.pkl")
 
-    def __add_document(self, doc_id:int, text:str) -> None:
-        tokens = preprocess(text)
-        for t in tokens:
-            self.index[t].add(doc_id)
-            self.term_frequencies[doc_id][t] += 1
-
-        self.doc_lengths[doc_id] = len(tokens)
+    def __live_postings(self, term: str) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+        result = []
+        for s, (seg, live) in enumerate(zip(self.segments, self.live_masks)):
+            positions, tfs = seg.get_postings(term)
+            if live is not None and len(positions):
+                keep = live[positions]
+                positions, tfs = positions[keep], tfs[keep]
+            if len(positions):
+                result.append((s, positions, tfs))
+        return result
 
     def get_documents(self, term:str) -> List[int]:
-        t = preprocess(term)[0]
-        if t not in self.index:
+        t = self.analyzer.preprocess(term)[0]
+        with self._lock:
+            ids = [self.segments[s].doc_ids[positions] for s, positions, _ in self.__live_postings(t)]
+        if not ids:
             return []
 
-        result = sorted(list(self.index[t]))
+        result = sorted(np.concatenate(ids).tolist())
         return result
 
-    def build(self) -> None:
-        movies = load_movies()
-        for m in movies:
-            content = f"{m.title} {m.description}"
-            self.__add_document(m.id, content)
-            self.docmap[m.id] = m
+    def build(
+        self, movies: Iterable[Movie] | None = None, batch_size: int = BUILD_BATCH_SIZE, workers: int = 1
+    ) -> None:
+        # Movies are tokenized a batch at a time into small segments that
+        # are merged at the end, so only one batch of token counts is ever
+        # held as Python objects. With `workers` > 1 the batches are
+        # tokenized in that many processes; the merged index is the same.
+        if workers > 1 and self.analyzer is not get_analyzer():
+            raise ValueError("A parallel build uses the default analyzer in every worker")
+
+        # A background merge finishing after the build would write a
+        # manifest of the segments it replaces.
+        self.wait_for_merge()
+        with span("keyword.build"):
+            self.__build(movies, batch_size, workers)
+
+    def __build(self, movies: Iterable[Movie] | None, batch_size: int, workers: int) -> None:
+        batches = batched(iter_movies() if movies is None else movies, batch_size)
+        segments: List[IndexSegment] = []
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # At most two batches per worker are in flight, so the stream
+                # is still read incrementally.
+                pending: deque = deque()
+                for batch in batches:
+                    self.docs.update(batch)
+                    pending.append(executor.submit(build_segment, batch))
+                    if len(pending) >= 2 * workers:
+                        segments.append(pending.popleft().result())
+                segments.extend(f.result() for f in pending)
+        else:
+            for batch in batches:
+                self.docs.update(batch)
+                segments.append(build_segment(batch, self.analyzer))
+
+        if len(segments) == 1:
+            segment = segments[0]
+        elif segments:
+            segment = IndexSegment.merge(segments, [None] * len(segments))
+        else:
+            segment = IndexSegment.from_term_frequencies({})
+        self.__set_segments([segment], [self.__base_entry()], [None])
+
+    def __base_entry(self) -> Dict[str, Any]:
+        return {"path": "index", "deleted": []}
+
+    def __segment_entry(self, name: str) -> Dict[str, Any]:
+        return {"path": os.path.join("index_segments", name), "deleted": []}
+
+    def __set_segments(
+        self, segments: List[IndexSegment], entries: List[Dict[str, Any]], live_masks: List[np.ndarray | None]
+    ) -> None:
+        self.segments = segments
+        self.segment_entries = entries
+        self.live_masks = live_masks
+        self.__compute_stats()
+
+    def __compute_stats(self) -> None:
+        # N and the total document length are kept up to date by the
+        # incremental updates; document frequencies and IDFs are filled in
+        # lazily so a query only touches its own terms.
+        self.doc_locations = {}
+        self.total_length = 0
+        for s, (seg, live) in enumerate(zip(self.segments, self.live_masks)):
+            self.total_length += seg.total_length
+            for pos, doc_id in enumerate(seg.doc_ids.tolist()):
+                if live is None or live[pos]:
+                    self.doc_locations[doc_id] = (s, pos)
+                else:
+                    self.total_length -= int(seg.doc_lengths[pos])
+        self.__reset_term_stats()
+
+    def __reset_term_stats(self) -> None:
+        self.generation += 1
+        self.avg_doc_length = self.total_length / len(self.doc_locations) if self.doc_locations else 0.0
+        self.doc_freqs = {}
+        self.bm25_idfs = {}
+
+    def exists(self) -> bool:
+        return (
+            os.path.exists(self.manifest_path)
+            or IndexSegment.exists(self.index_dir)
+            or os.path.exists(self.index_path)
+        )
 
     def save(self) -> None:
-        os.makedirs(self.cache_path, exist_ok=True)
-        with open(self.index_path, "wb") as f:
-            pickle.dump(self.index, f)
-
-        with open(self.docmap_path, "wb") as f:
-            pickle.dump(self.docmap, f)
-
-        with open(self.term_frequencies_path, "wb") as f:
-            pickle.dump(self.term_frequencies, f)
-
-        with open(self.doc_lengths_path, "wb") as f:
-            pickle.dump(self.doc_lengths, f)
-            # self.doc_lengths = pickle.load(f)
+        self.wait_for_merge()
+        with self._lock, span("keyword.save"):
+            if len(self.segments) != 1 or self.live_masks[0] is not None:
+                self.__set_segments([IndexSegment.merge(self.segments, self.live_masks)], [self.__base_entry()], [None])
+
+            os.makedirs(self.cache_path, exist_ok=True)
+            self.segments[0].save(self.index_dir)
+            self.segment_entries = [self.__base_entry()]
+            self.__write_manifest()
+            shutil.rmtree(self.segments_dir, ignore_errors=True)
+            # Left by an index saved before the DocStore.
+            if os.path.exists(self.docmap_path):
+                os.remove(self.docmap_path)
+
+    def __write_manifest(self) -> None:
+        manifest = {
+            "version": INDEX_MANIFEST_VERSION,
+            "segments": self.segment_entries,
+        }
+        with open(f"{self.manifest_path}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
 
     def load(self) ->None:
+        with span("keyword.load"):
+            self.__load()
+
+    def __load(self) -> None:
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            version = manifest["version"]
+            if version not in (1, INDEX_MANIFEST_VERSION):
+                raise ValueError(f"Unsupported index manifest version {version}")
+            entries = manifest["segments"]
+        elif IndexSegment.exists(self.index_dir):
+            version = 1
+            entries = [{**self.__base_entry(), "docmap": "docmap.pkl"}]
+        else:
+            self.__load_legacy()
+            return
+
+        segments = []
+        live_masks: List[np.ndarray | None] = []
+        for entry in entries:
+            seg = IndexSegment.load(os.path.join(self.cache_path, entry["path"]))
+            live = None
+            if entry["deleted"]:
+                live = np.ones(seg.num_docs, dtype=bool)
+                live[entry["deleted"]] = False
+
+            if version == 1:
+                self.__migrate_docmap(seg, live, os.path.join(self.cache_path, entry["docmap"]))
+            segments.append(seg)
+            live_masks.append(live)
+
+        if any(seg.num_docs for seg in segments) and not os.path.exists(self.docs.meta_path):
+            raise FileNotFoundError(f"{self.docs.meta_path} doesn't exist")
+
+        self.__set_segments(segments, entries, live_masks)
+        if version == 1:
+            self.save()
+
+    def __migrate_docmap(self, seg: IndexSegment, live: np.ndarray | None, docmap_path: str) -> None:
+        # Moves a version 1 segment's pickled movies into the DocStore and
+        # records their content hashes in the segment.
+        if not os.path.exists(docmap_path):
+            raise FileNotFoundError(f"{docmap_path} doesn't exist")
+
+        with open(docmap_path, "rb") as f:
+            seg_docmap: Dict[int, Movie] = pickle.load(f)
+        doc_ids = seg.doc_ids.tolist()
+        self.docs.update(seg_docmap[doc_id] for pos, doc_id in enumerate(doc_ids) if live is None or live[pos])
+        seg.doc_hashes = np.fromiter(
+            (content_hash(seg_docmap[doc_id]) if doc_id in seg_docmap else 0 for doc_id in doc_ids),
+            dtype=np.uint64,
+            count=len(doc_ids),
+        )
+
+    def __load_legacy(self) -> None:
         if not os.path.exists(self.index_path):
             raise FileNotFoundError(f"{self.index_path} doesn't exist")
 
         if not os.path.exists(self.docmap_path):
             raise FileNotFoundError(f"{self.docmap_path} doesn't exist")
 
-        with open(self.index_path, "rb") as f:
-            self.index = pickle.load(f)
-
         with open(self.docmap_path, "rb") as f:
-            self.docmap = pickle.load(f)
+            docmap: Dict[int, Movie] = pickle.load(f)
 
         with open(self.term_frequencies_path, "rb") as f:
-            self.term_frequencies = pickle.load(f)
-
-        with open(self.doc_lengths_path, "rb") as f:
-            self.doc_lengths = pickle.load(f)
+            term_frequencies: Dict[int, CounterType] = pickle.load(f)
+
+        self.docs.update(docmap.values())
+        # index.pkl and doc_lengths.pkl are both derivable from the term
+        # frequencies, so they are not read back.
+        segment = IndexSegment.from_term_frequencies(
+            {doc_id: term_frequencies.get(doc_id, Counter()) for doc_id in docmap},
+            {doc_id: content_hash(m) for doc_id, m in docmap.items()},
+        )
+        self.__set_segments([segment], [self.__base_entry()], [None])
+
+    def convert_legacy(self) -> None:
+        self.__load_legacy()
+        self.save()
+
+    def __ensure_persisted(self) -> None:
+        # Incremental updates are appended to the on-disk index, so the base
+        # has to be there first.
+        if not os.path.exists(self.manifest_path):
+            self.save()
+
+    def add_documents(self, movies: Iterable[Movie]) -> None:
+        # New ids are added, existing ids are replaced. Costs a tokenization
+        # of `movies` and one small segment write, whatever the corpus size.
+        latest = {m.id: m for m in movies}
+        if not latest:
+            return
+
+        segment = build_segment(latest.values(), self.analyzer)
+
+        with self._lock:
+            self.__ensure_persisted()
+            # Stored before the segment that makes them searchable.
+            self.docs.update(latest.values())
+            name = self.__next_segment_name()
+            segment.save(os.path.join(self.segments_dir, name))
+
+            for doc_id in latest:
+                if doc_id in self.doc_locations:
+                    self.__tombstone(doc_id)
+
+            s = len(self.segments)
+            self.segments.append(segment)
+            self.live_masks.append(None)
+            self.segment_entries.append(self.__segment_entry(name))
+            for pos, doc_id in enumerate(latest):
+                self.doc_locations[doc_id] = (s, pos)
+            self.total_length += segment.total_length
+            self.__reset_term_stats()
+            self.__write_manifest()
+            self.__maybe_merge()
+
+    def update_document(self, movie: Movie) -> None:
+        self.add_documents([movie])
+
+    def delete_documents(self, doc_ids: Iterable[int]) -> None:
+        with self._lock:
+            doc_ids = list(doc_ids)
+            for doc_id in doc_ids:
+                if doc_id not in self.doc_locations:
+                    raise ValueError(f"Document {doc_id} is not in the index")
+
+            self.__ensure_persisted()
+            for doc_id in doc_ids:
+                self.__tombstone(doc_id)
+            # Deleted movies stop being readable by id, and their rows go
+            # at the store's next compaction.
+            self.docs.delete(doc_ids)
+            self.__reset_term_stats()
+            self.__write_manifest()
+            self.__maybe_merge()
+
+    def delete_document(self, doc_id: int) -> None:
+        self.delete_documents([doc_id])
+
+    def sync_documents(self, documents: List[Movie]) -> None:
+        # Brings the index in line with `documents`, only re-indexing the
+        # movies that were added, edited or removed.
+        current = {m.id for m in documents}
+        deleted = [doc_id for doc_id in self.doc_locations if doc_id not in current]
+        changed = [m for m in documents if self.__indexed_hash(m.id) != content_hash(m)]
+        if deleted:
+            self.delete_documents(deleted)
+        if changed:
+            self.add_documents(changed)
+
+    def __indexed_hash(self, doc_id: int) -> int | None:
+        location = self.doc_locations.get(doc_id)
+        if location is None:
+            return None
+        s, pos = location
+        return int(self.segments[s].doc_hashes[pos])
+
+    def __tombstone(self, doc_id: int) -> None:
+        s, pos = self.doc_locations.pop(doc_id)
+        if self.live_masks[s] is None:
+            self.live_masks[s] = np.ones(self.segments[s].num_docs, dtype=bool)
+        self.live_masks[s][pos] = False  # type: ignore[index]
+        self.segment_entries[s]["deleted"].append(pos)
+        self.total_length -= int(self.segments[s].doc_lengths[pos])
+
+    def __next_segment_name(self) -> str:
+        os.makedirs(self.segments_dir, exist_ok=True)
+        existing = [int(name[4:10]) for name in os.listdir(self.segments_dir) if name.startswith("seg_")]
+        return f"seg_{max(existing, default=0) + 1:06d}"
+
+    def __maybe_merge(self) -> None:
+        if len(self.segments) > MERGE_SEGMENT_THRESHOLD:
+            self.merge(background=True)
+
+    def merge(self, background: bool = False) -> None:
+        with self._lock:
+            if self._merge_thread is not None and self._merge_thread.is_alive():
+                return
+            if len(self.segments) <= 1 and all(live is None for live in self.live_masks):
+                return
+
+            snapshot = (
+                list(self.segments),
+                [None if live is None else live.copy() for live in self.live_masks],
+            )
+
+        if not background:
+            self.__merge(*snapshot)
+            return
+
+        # Not a daemon thread, so a CLI process finishes the merge before exiting.
+        self._merge_thread = threading.Thread(target=self.__merge, args=snapshot, name="index-merge")
+        self._merge_thread.start()
+
+    def wait_for_merge(self) -> None:
+        if self._merge_thread is not None:
+            self._merge_thread.join()
+
+    def __merge(self, segments: List[IndexSegment], live_masks: List[np.ndarray | None]) -> None:
+        merged = IndexSegment.merge(segments, live_masks)
+
+        with self._lock:
+            k = len(segments)
+            if len(self.segments) < k or any(a is not b for a, b in zip(self.segments, segments)):
+                # The segments were replaced (rebuilt or reloaded) while the
+                # merge ran; its result describes an index that is gone.
+                return
+
+            name = self.__next_segment_name()
+            merged.save(os.path.join(self.segments_dir, name))
+
+            # Documents deleted or replaced while the merge was running are
+            # still live in `merged`; carry their tombstones over.
+            merged_live = np.ones(merged.num_docs, dtype=bool)
+            offset = 0
+            for s in range(k):
+                was_live = live_masks[s]
+                if was_live is None:
+                    was_live = np.ones(segments[s].num_docs, dtype=bool)
+                now_live = self.live_masks[s] if self.live_masks[s] is not None else was_live
+                merged_positions = offset + np.cumsum(was_live) - 1
+                merged_live[merged_positions[was_live & ~now_live]] = False
+                offset += int(was_live.sum())
+
+            entry = self.__segment_entry(name)
+            entry["deleted"] = np.flatnonzero(~merged_live).tolist()
+            old_entries = self.segment_entries[:k]
+            self.__set_segments(
+                [merged] + self.segments[k:],
+                [entry] + self.segment_entries[k:],
+                [None if merged_live.all() else merged_live] + self.live_masks[k:],
+            )
+            self.__write_manifest()
+
+            for old in old_entries:
+                if old["path"] == "index":
+                    shutil.rmtree(self.index_dir, ignore_errors=True)
+                else:
+                    shutil.rmtree(os.path.join(self.cache_path, old["path"]), ignore_errors=True)
 
     def get_tf(self, doc_id:int, term:str) -> int:
-        token = preprocess(term)
+        token = self.analyzer.preprocess(term)
         if len(token) > 1:
             raise ValueError(f"Provided term must have exactly 1 token, actual term: {token}")
 
-        return self.term_frequencies[doc_id][token[0]]
+        if doc_id not in self.doc_locations:
+            return 0
+
+        s, pos = self.doc_locations[doc_id]
+        return self.segments[s].get_tf(pos, token[0])
+
+    def __get_doc_freq(self, term: str) -> int:
+        df = self.doc_freqs.get(term)
+        if df is None:
+            df = sum(len(positions) for _, positions, _ in self.__live_postings(term))
+            self.doc_freqs[term] = df
+
+        return df
 
     def get_idf(self, term:str) -> float:
-        query = preprocess(term)
-        doc_count = len(self.docmap)
-        term_doc_count = len(self.index[query[0]])
+        query = self.analyzer.preprocess(term)
+        doc_count = len(self.doc_locations)
+        term_doc_count = self.__get_doc_freq(query[0])
         return math.log((doc_count + 1) / (term_doc_count + 1))
 
     def get_bm25_idf(self, term: str) -> float:
-        t = preprocess(term)
+        t = self.analyzer.preprocess(term)
         if len(t) != 1:
             raise ValueError("Term must be a single token")
 
         q = t[0]
-        df = len(self.index.get(q, set()))
-        N = len(self.docmap)
-        if term == "grizzly":
-            print(df)
-            print(self.index[q])
-            print(N)
-            print(t)
+        df = self.__get_doc_freq(q)
+        N = len(self.doc_locations)
         bm25 = math.log((N - df + 0.5) / (df + 0.5) + 1)
 
         return bm25
 
-    def __get_average_doc_length(self) -> float:
-        if len(self.doc_lengths) == 0:
-            return 0.0
+    def __get_term_bm25_idf(self, term: str) -> float:
+        idf = self.bm25_idfs.get(term)
+        if idf is None:
+            N = len(self.doc_locations)
+            df = self.__get_doc_freq(term)
+            idf = math.log((N - df + 0.5) / (df + 0.5) + 1)
+            self.bm25_idfs[term] = idf
 
-        return sum(self.doc_lengths.values()) / len(self.doc_lengths)
+        return idf
 
     def get_bm25_tf(self, doc_id:int, term:str, k1: float = BM25_K1, b: float = BM25_B) -> float:
         base_tf = self.get_tf(doc_id, term)
-        doc_length = self.doc_lengths[doc_id]
-        avg_doc_length = self.__get_average_doc_length()
+        s, pos = self.doc_locations[doc_id]
+        doc_length = int(self.segments[s].doc_lengths[pos])
+        avg_doc_length = self.avg_doc_length
         length_norm = 1 - b + b * (doc_length / avg_doc_length)
         bm25_tf = (base_tf * (k1 + 1)) / (base_tf + k1 * length_norm)
-        
+
         return bm25_tf
 
     def bm25(self, doc_id: int, term: str) -> float:
@@ -134,17 +536,259 @@ class InvertedIndex:
 
         return tf * idf
 
-    def bm25_search(self, query: str, limit: int) -> List[Tuple[Movie, float]]:
-        q = preprocess(query)
-        scores:Dict[int, float] = {}
-
-        for doc_id, m in self.docmap.items():
-            score = reduce(lambda accumulator, term: accumulator + self.bm25(doc_id, term), q, 0.0)
-            scores[doc_id] = score
-
-        result = sorted(scores.items(), reverse=True, key=lambda i: i[1])[:limit]
-        # print(result)
-        r = [(self.docmap[d[0]], d[1]) for d in result]
-        # print(r)
-        return r
-
+    def bm25_search(self, query: str, limit: int, k1: float = BM25_K1, b: float = BM25_B) -> List[Tuple[StoredMovie, float]]:
+        with span("keyword.bm25_search"):
+            if self.result_cache is None:
+                return self.__analyze_and_search(query, limit, k1, b)
+            key = ("bm25", query, limit, k1, b, self.version())
+            return self.result_cache.get_or_compute(key, lambda: self.__analyze_and_search(query, limit, k1, b))
+
+    def version(self) -> str:
+        return f"{self.generation}:{file_stamp(self.manifest_path)}"
+
+    def __analyze_and_search(self, query: str, limit: int, k1: float, b: float) -> List[Tuple[StoredMovie, float]]:
+        with span("analyze"):
+            q = self.analyzer.preprocess(query)
+        with self._lock:
+            return self.__bm25_search(q, limit, k1, b)
+
+    def __bm25_search(self, q: List[str], limit: int, k1: float, b: float) -> List[Tuple[StoredMovie, float]]:
+        # Documents are numbered by segment offset + position, which is also
+        # index order.
+        seg_offsets = np.cumsum([0] + [seg.num_docs for seg in self.segments])
+        candidates, scores = self.__score_any(q, limit, k1, b, seg_offsets)
+        return self.__top_results(candidates, scores, limit, seg_offsets, pad=True)
+
+    def boolean_search(
+        self, query: str, limit: int, mode: str = DEFAULT_BOOLEAN_MODE, k1: float = BM25_K1, b: float = BM25_B
+    ) -> List[Tuple[StoredMovie, float]]:
+        # Documents that contain all ("and") or any ("or") of the query
+        # terms, best BM25 score first. Unlike `bm25_search`, fewer than
+        # `limit` matches are not padded with other documents.
+        if mode not in BOOLEAN_MODES:
+            raise ValueError(f"Unknown boolean mode {mode!r}, expected one of {', '.join(BOOLEAN_MODES)}")
+
+        with span("keyword.boolean_search"):
+            if self.result_cache is None:
+                return self.__boolean_search(query, limit, mode, k1, b)
+            key = ("boolean", mode, query, limit, k1, b, self.version())
+            return self.result_cache.get_or_compute(key, lambda: self.__boolean_search(query, limit, mode, k1, b))
+
+    def __boolean_search(self, query: str, limit: int, mode: str, k1: float, b: float) -> List[Tuple[StoredMovie, float]]:
+        with span("analyze"):
+            q = self.analyzer.preprocess(query)
+        with self._lock:
+            seg_offsets = np.cumsum([0] + [seg.num_docs for seg in self.segments])
+            if mode == "or":
+                candidates, scores = self.__score_any(q, limit, k1, b, seg_offsets)
+            else:
+                with span("intersect"):
+                    candidates = self.__match_all(q, seg_offsets)
+                with span("score"):
+                    scores = self.__score_candidates(q, candidates, k1, b, seg_offsets)
+            return self.__top_results(candidates, scores, limit, seg_offsets, pad=False)
+
+    def __score_any(
+        self, q: List[str], limit: int, k1: float, b: float, seg_offsets: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Sorted ordinals and exact scores of the documents with any query
+        # term, or of a superset of the top `limit` of them when pruning.
+        prune = self.pruning and limit > 0 and k1 > 0 and 0 <= b <= 1 and self.avg_doc_length > 0
+        if prune and sum(seg.doc_freq(t) for seg in self.segments for t in q) >= PRUNING_MIN_POSTINGS:
+            with span("prune"):
+                candidates = self.__top_k_candidates(q, limit, k1, b, seg_offsets)
+            with span("score"):
+                return candidates, self.__score_candidates(q, candidates, k1, b, seg_offsets)
+
+        with span("score"):
+            return self.__score_all(q, k1, b, seg_offsets)
+
+    def __match_all(self, q: List[str], seg_offsets: np.ndarray) -> np.ndarray:
+        # Sorted ordinals of the live documents that contain every term of
+        # `q`. Each segment starts from its rarest term's postings and keeps
+        # the positions also found in the next rarest term's, so the work is
+        # bounded by the shortest posting list, not by the union.
+        if not q:
+            return np.empty(0, dtype=np.int64)
+
+        matches = []
+        for s, (seg, live) in enumerate(zip(self.segments, self.live_masks)):
+            ranges = sorted((seg.term_range(t) for t in set(q)), key=lambda r: r[1] - r[0])
+            start, end = ranges[0]
+            if start == end:
+                continue
+
+            positions = np.asarray(seg.postings[start:end])
+            if live is not None:
+                positions = positions[live[positions]]
+            for start, end in ranges[1:]:
+                if not len(positions):
+                    break
+                hit, _ = seg.find_postings(start, end, positions)
+                positions = positions[hit]
+            matches.append(positions + seg_offsets[s])
+
+        return np.concatenate(matches) if matches else np.empty(0, dtype=np.int64)
+
+    def __top_results(
+        self, candidates: np.ndarray, scores: np.ndarray, limit: int, seg_offsets: np.ndarray, pad: bool
+    ) -> List[Tuple[StoredMovie, float]]:
+        with span("top_k"):
+            # Ties are broken by index order, same as a stable sort over the index.
+            top = [
+                (-neg_ordinal, score)
+                for score, neg_ordinal in heapq.nlargest(limit, zip(scores.tolist(), (-candidates).tolist()))
+            ]
+
+            if pad and len(top) < limit:
+                matched = set(candidates.tolist())
+                for s, pos in self.doc_locations.values():
+                    ordinal = int(seg_offsets[s]) + pos
+                    if ordinal not in matched:
+                        top.append((ordinal, 0.0))
+                        if len(top) == limit:
+                            break
+
+        with span("results"):
+            ordinals = np.fromiter((ordinal for ordinal, _ in top), dtype=np.int64, count=len(top))
+            segs = np.searchsorted(seg_offsets, ordinals, side="right") - 1
+            doc_ids = np.empty(len(top), dtype=np.int64)
+            for s in np.unique(segs).tolist():
+                in_seg = segs == s
+                doc_ids[in_seg] = self.segments[s].doc_ids[ordinals[in_seg] - seg_offsets[s]]
+            return list(zip(self.docs.get_many(doc_ids.tolist()), (score for _, score in top)))
+
+    def __score_all(self, q: List[str], k1: float, b: float, seg_offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Term-at-a-time: only documents on a query term's posting list can
+        # score above zero, so those are the only ones we touch.
+        matched_ordinals: List[np.ndarray] = []
+        matched_scores: List[np.ndarray] = []
+        for term in q:
+            postings = self.__live_postings(term)
+            if not postings:
+                continue
+
+            idf = self.__get_term_bm25_idf(term)
+            for s, positions, tfs in postings:
+                length_norm = 1 - b + b * (self.segments[s].doc_lengths[positions] / self.avg_doc_length)
+                bm25_tf = (tfs * (k1 + 1)) / (tfs + k1 * length_norm)
+                matched_ordinals.append(positions + seg_offsets[s])
+                matched_scores.append(bm25_tf * idf)
+
+        if not matched_ordinals:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        # bincount adds the weights in input order, so every document's
+        # score is summed in query term order starting from 0.0.
+        candidates, inverse = np.unique(np.concatenate(matched_ordinals), return_inverse=True)
+        return candidates, np.bincount(inverse, weights=np.concatenate(matched_scores), minlength=len(candidates))
+
+    def __top_k_candidates(self, q: List[str], limit: int, k1: float, b: float, seg_offsets: np.ndarray) -> np.ndarray:
+        # Block-max MaxScore, a term at a time. Terms are visited from the
+        # highest score upper bound down. Once `limit` documents are known,
+        # the limit-th best partial score is a lower bound on the final
+        # cut-off: documents whose partial score plus the bounds of the
+        # terms still to come fall below it are dropped, and the blocks of a
+        # posting list that can't lift a new document past it are only
+        # probed for documents already in the running. Returns the sorted
+        # ordinals of a superset of the top `limit` documents; their
+        # partial scores are not summed in query order, so they are
+        # rescored exactly afterwards.
+        terms = []
+        for term, count in Counter(q).items():
+            idf = self.__get_term_bm25_idf(term)
+            lists = []
+            for s, seg in enumerate(self.segments):
+                start, end = seg.term_range(term)
+                if start == end:
+                    continue
+                max_tfs, min_lengths = seg.get_block_bounds(term)
+                length_norm = 1 - b + b * (min_lengths / self.avg_doc_length)
+                block_ub = count * idf * (max_tfs * (k1 + 1)) / (max_tfs + k1 * length_norm)
+                lists.append((s, start, end, block_ub))
+            if lists:
+                terms.append((max(float(ub.max()) for *_, ub in lists), count * idf, lists))
+        terms.sort(key=lambda t: -t[0])
+        # Highest score the terms after the i-th can still add.
+        remaining = np.cumsum([ub for ub, *_ in terms][::-1])[::-1].tolist()[1:] + [0.0]
+
+        candidates = np.empty(0, dtype=np.int64)
+        partial = np.empty(0)
+        cutoff = -math.inf
+        for (_, weight, lists), rest in zip(terms, remaining):
+            ordinals = [candidates]
+            scores = [partial]
+            for s, start, end, block_ub in lists:
+                seg, live, offset = self.segments[s], self.live_masks[s], int(seg_offsets[s])
+                block_size = seg.block_size
+                positions = seg.postings[start:end]
+                tfs = seg.frequencies[start:end]
+                open_blocks = block_ub + rest >= cutoff
+
+                if open_blocks.all():
+                    selected = np.arange(end - start)
+                else:
+                    starts = np.flatnonzero(open_blocks) * block_size
+                    selected = (starts[:, None] + np.arange(block_size)).ravel()
+                    selected = selected[selected < end - start]
+                    # Documents already in the running are looked up in the
+                    # closed blocks; they are live, so no tombstone check.
+                    lo, hi = np.searchsorted(candidates, [offset, offset + seg.num_docs])
+                    local = candidates[lo:hi] - offset
+                    if len(local):
+                        hit, i = seg.find_postings(start, end, local)
+                        closed = ~open_blocks[i // block_size]
+                        i = i[closed]
+                        ordinals.append(local[hit][closed] + offset)
+                        scores.append(self.__term_scores(seg, positions[i], tfs[i], weight, k1, b))
+
+                if len(selected):
+                    sel_positions, sel_tfs = positions[selected], tfs[selected]
+                    if live is not None:
+                        keep = live[sel_positions]
+                        sel_positions, sel_tfs = sel_positions[keep], sel_tfs[keep]
+                    ordinals.append(sel_positions + offset)
+                    scores.append(self.__term_scores(seg, sel_positions, sel_tfs, weight, k1, b))
+
+            candidates, inverse = np.unique(np.concatenate(ordinals), return_inverse=True)
+            partial = np.bincount(inverse, weights=np.concatenate(scores), minlength=len(candidates))
+            if len(candidates) >= limit:
+                threshold = float(np.partition(partial, len(partial) - limit)[len(partial) - limit])
+                cutoff = max(cutoff, threshold * (1 - PRUNING_SLACK))
+                keep = partial + rest >= cutoff
+                candidates, partial = candidates[keep], partial[keep]
+
+        return candidates
+
+    def __term_scores(
+        self, seg: IndexSegment, positions: np.ndarray, tfs: np.ndarray, weight: float, k1: float, b: float
+    ) -> np.ndarray:
+        length_norm = 1 - b + b * (seg.doc_lengths[positions] / self.avg_doc_length)
+        return weight * (tfs * (k1 + 1)) / (tfs + k1 * length_norm)
+
+    def __score_candidates(self, q: List[str], candidates: np.ndarray, k1: float, b: float, seg_offsets: np.ndarray) -> np.ndarray:
+        # The same arithmetic as `__score_all`, restricted to `candidates`,
+        # so the scores match exhaustive scoring bit for bit.
+        scores = np.zeros(len(candidates))
+        bounds = np.searchsorted(candidates, seg_offsets)
+        for term in q:
+            idf = self.__get_term_bm25_idf(term)
+            for s, seg in enumerate(self.segments):
+                lo, hi = int(bounds[s]), int(bounds[s + 1])
+                start, end = seg.term_range(term)
+                if lo == hi or start == end:
+                    continue
+
+                local = candidates[lo:hi] - seg_offsets[s]
+                hit, i = seg.find_postings(start, end, local)
+                tfs = seg.frequencies[start:end][i]
+                length_norm = 1 - b + b * (seg.doc_lengths[local[hit]] / self.avg_doc_length)
+                bm25_tf = (tfs * (k1 + 1)) / (tfs + k1 * length_norm)
+                view = scores[lo:hi]
+                view[hit] += bm25_tf * idf
+        return scores
+
+    def search_batch(self, queries: List[str], limit: int, k1: float = BM25_K1, b: float = BM25_B) -> List[List[Tuple[StoredMovie, float]]]:
+        # BM25 has no shared work across queries beyond the analyzer's stem
+        # cache and the memoized IDFs, so this is a plain loop.
+        return [self.bm25_search(q, limit, k1, b) for q in queries]
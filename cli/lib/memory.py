@@ -0,0 +1,38 @@
+import os
+import resource
+from typing import Dict
+
+# /proc/<pid>/smaps_rollup fields, in kB, and the names they are reported
+# under.
+SMAPS_FIELDS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Shared_Clean": "shared",
+    "Shared_Dirty": "shared",
+    "Private_Clean": "private",
+    "Private_Dirty": "private",
+}
+
+
+def process_memory(pid: int | None = None) -> Dict[str, float]:
+    # Memory of a process in MiB. `rss` counts every resident page, shared
+    # or not; `pss` splits each shared page between the processes mapping
+    # it, so the `pss` of a server's processes adds up to what they use
+    # together; `private` is what only this process uses, i.e. what one
+    # more forked worker costs.
+    path = f"/proc/{pid or 'self'}/smaps_rollup"
+    if not os.path.exists(path):
+        if pid is not None and pid != os.getpid():
+            return {}
+        # No per-page accounting outside Linux: peak RSS only, which
+        # ru_maxrss gives in kilobytes on Linux and bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {"rss": round(peak / (1024 if os.uname().sysname == "Linux" else 1024 * 1024), 1)}
+
+    kb = dict.fromkeys(SMAPS_FIELDS.values(), 0)
+    with open(path) as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in SMAPS_FIELDS:
+                kb[SMAPS_FIELDS[name]] += int(value.split()[0])
+    return {name: round(value / 1024, 1) for name, value in kb.items()}
@@ -1,6 +1,10 @@
 from dataclasses import dataclass
 import json
-from typing import List
+from typing import IO, Any, Iterator, List
+
+MOVIES_PATH = "data/movies.json"
+# Characters read from the movies file at a time while streaming.
+READ_CHUNK_SIZE = 1 << 16
 
 
 @dataclass
@@ -10,8 +14,97 @@ class Movie:
     description: str
 
 
-def load_movies() -> List[Movie]:
-    with open("data/movies.json") as f:
-        data = json.load(f)
-        movies = [Movie(**movie_dict) for movie_dict in data.get("movies", [])]
-        return movies
+def load_movies(path: str = MOVIES_PATH) -> List[Movie]:
+    return list(iter_movies(path))
+
+
+def iter_movies(path: str = MOVIES_PATH) -> Iterator[Movie]:
+    # Streams movies from either a JSON Lines file (one movie per line) or
+    # the {"movies": [...]} document, without reading the whole file.
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield Movie(**json.loads(line))
+        else:
+            for movie_dict in iter_json_array(f, "movies"):
+                yield Movie(**movie_dict)
+
+
+def iter_json_array(f: IO[str], key: str) -> Iterator[Any]:
+    # Yields the elements of the array under top-level `key` of the JSON
+    # object in `f` one at a time. Only one element plus one read chunk is
+    # held in memory.
+    reader = _JsonReader(f)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+
+    while True:
+        name = reader.value()
+        reader.expect(":")
+        if name == key:
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(",", "]") == "]":
+                        break
+        else:
+            reader.value()
+
+        if reader.expect(",", "}") == "}":
+            return
+
+
+class _JsonReader:
+    def __init__(self, f: IO[str]) -> None:
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON input")
+
+    def expect(self, *chars: str) -> str:
+        c = self.peek()
+        if c not in chars:
+            raise ValueError(f"Expected one of {chars!r} in JSON input, found {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number cut off at the end of the buffer still decodes.
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
@@ -0,0 +1,90 @@
+import os
+from typing import Dict
+
+import numpy as np
+
+QUANTIZATION_FORMAT_VERSION = 1
+PRECISIONS = ("float32", "float16", "int8")
+# Rows dequantized to float32 at once while scoring; small enough that the
+# float32 block stays in cache.
+DEQUANTIZE_BLOCK_ROWS = 256
+
+
+class QuantizedMatrix:
+    # Reduced-precision copy of a matrix of unit-length embeddings, used for
+    # a cheap first scoring pass. float16 stores the rows as is; int8 stores
+    # round(x / scales) per dimension with symmetric scales = max|x| / 127,
+    # so a row's dot product with q is codes @ (scales * q).
+    codes: np.ndarray
+    scales: np.ndarray | None
+    fingerprint: str
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray | None, fingerprint: str) -> None:
+        self.codes = codes
+        self.scales = scales
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_matrix(cls, x: np.ndarray, precision: str, fingerprint: str) -> "QuantizedMatrix":
+        if precision == "float16":
+            return cls(x.astype(np.float16), None, fingerprint)
+
+        if precision != "int8":
+            raise ValueError(f"Unsupported precision: {precision}")
+
+        if len(x) == 0:
+            return cls(np.empty(x.shape, dtype=np.int8), np.ones(x.shape[1:], dtype=np.float32), fingerprint)
+
+        scales = (np.abs(x).max(axis=0) / 127).astype(np.float32)
+        scales[scales == 0] = 1
+        codes = np.empty(x.shape, dtype=np.int8)
+        for start in range(0, len(x), DEQUANTIZE_BLOCK_ROWS):
+            block = x[start:start + DEQUANTIZE_BLOCK_ROWS] / scales
+            codes[start:start + DEQUANTIZE_BLOCK_ROWS] = np.clip(np.rint(block), -127, 127)
+        return cls(codes, scales, fingerprint)
+
+    @property
+    def precision(self) -> str:
+        return "float16" if self.codes.dtype == np.float16 else "int8"
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def params(self) -> Dict[str, np.ndarray]:
+        params = {
+            "version": np.array(QUANTIZATION_FORMAT_VERSION),
+            "fingerprint": np.array(self.fingerprint),
+            "codes": self.codes,
+        }
+        if self.scales is not None:
+            params["scales"] = self.scales
+        return params
+
+    def save(self, path: str) -> None:
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(f, **self.params())
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "QuantizedMatrix":
+        with np.load(path) as data:
+            if int(data["version"]) != QUANTIZATION_FORMAT_VERSION:
+                raise ValueError(f"Unsupported quantized embeddings version {int(data['version'])} in {path}")
+
+            scales = data["scales"] if "scales" in data else None
+            return cls(data["codes"], scales, str(data["fingerprint"]))
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        # Approximate dot products of one query vector or a matrix of them
+        # with every row, dequantizing a block of rows at a time.
+        q = (queries * self.scales if self.scales is not None else queries).astype(np.float32)
+        out = np.empty(q.shape[:-1] + (len(self.codes),), dtype=np.float32)
+        for start in range(0, len(self.codes), DEQUANTIZE_BLOCK_ROWS):
+            block = self.codes[start:start + DEQUANTIZE_BLOCK_ROWS].astype(np.float32)
+            out[..., start:start + DEQUANTIZE_BLOCK_ROWS] = q @ block.T
+        return out
+
+
+def quantized_path(embeddings_path: str, precision: str) -> str:
+    base, _ = os.path.splitext(embeddings_path)
+    return f"{base}_{precision}.npz"
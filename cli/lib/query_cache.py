@@ -0,0 +1,143 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+import numpy as np
+
+QUERY_CACHE_VERSION = 1
+DEFAULT_QUERY_CACHE_SIZE = 4096
+DEFAULT_RESULT_CACHE_SIZE = 1024
+
+_MISSING = object()
+
+
+def file_stamp(*paths: str) -> str:
+    # Changes whenever one of `paths` is rewritten: the caches replace files
+    # atomically, so the inode changes even when mtime and size do not.
+    parts = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            parts.append("-")
+            continue
+        parts.append(f"{st.st_ino:x}.{st.st_mtime_ns:x}.{st.st_size:x}")
+    return "/".join(parts)
+
+
+class LRUCache:
+    # Least-recently-used map with an optional time-to-live in seconds,
+    # safe to share between threads. Values are returned as stored, so
+    # callers must not mutate them. A max_size of 0 disables the cache.
+    def __init__(self, max_size: int = DEFAULT_RESULT_CACHE_SIZE, ttl: float | None = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self.ttl is None or time.time() - entry[0] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any, created: float | None = None) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() if created is None else created, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+        }
+
+
+class QueryEmbeddingCache(LRUCache):
+    # (model name, query text) -> query embedding, saved to
+    # cache/query_embeddings.npz so repeated queries skip the model even
+    # across runs. Entries keep their creation time through a save, so the
+    # TTL still applies after a reload.
+    def __init__(self, max_size: int = DEFAULT_QUERY_CACHE_SIZE, ttl: float | None = None, path: str | None = None) -> None:
+        super().__init__(max_size, ttl)
+        self.path = path or os.path.join(os.getcwd(), "cache", "query_embeddings.npz")
+        self.dirty = False
+
+    def put(self, key: Hashable, value: Any, created: float | None = None) -> None:
+        super().put(key, value, created)
+        self.dirty = True
+
+    def load(self) -> None:
+        if self.max_size <= 0 or not os.path.exists(self.path):
+            return
+
+        with np.load(self.path) as data:
+            if int(data["version"]) != QUERY_CACHE_VERSION:
+                return
+            now = time.time()
+            entries = zip(data["models"].tolist(), data["queries"].tolist(), data["created"].tolist(), data["embeddings"])
+            for model, query, created, embedding in entries:
+                if self.ttl is None or now - created <= self.ttl:
+                    super().put((model, query), embedding, created)
+        self.dirty = False
+
+    def save(self) -> None:
+        if self.max_size <= 0 or not self.dirty:
+            return
+
+        with self._lock:
+            items = [(key, created, value) for key, (created, value) in self._entries.items()]
+        if not items:
+            return
+        # One matrix per file: entries of a model with another dimension
+        # than the most recently used one are not saved.
+        shape = np.shape(items[-1][2])
+        items = [item for item in items if np.shape(item[2]) == shape]
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # The workers of a multi-process server save on exit at the same
+        # time; each writes its own temporary file and the last one wins.
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=QUERY_CACHE_VERSION,
+                models=np.array([model for (model, _), _, _ in items]),
+                queries=np.array([query for (_, query), _, _ in items]),
+                created=np.array([created for _, created, _ in items]),
+                embeddings=np.stack([value for _, _, value in items]),
+            )
+        os.replace(tmp_path, self.path)
+        self.dirty = False
@@ -0,0 +1,22 @@
+import json
+import os
+import socket
+from typing import Any, Dict, List
+
+DEFAULT_SOCKET_PATH = os.path.join("cache", "search.sock")
+
+
+def query_server(request: Dict[str, Any], socket_path: str = DEFAULT_SOCKET_PATH) -> List[Dict[str, Any]]:
+    # One newline-delimited JSON request/response round trip with a running
+    # search_server_cli.py. Kept free of numpy/torch imports so forwarding
+    # CLIs start fast.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + "\n").encode())
+        with sock.makefile("r") as f:
+            response = json.loads(f.readline())
+
+    if "error" in response:
+        raise RuntimeError(f"Search server error: {response['error']}")
+
+    return response["results"]
@@ -0,0 +1,358 @@
+import asyncio
+import gc
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Tuple
+
+import numpy as np
+
+from lib.ann_index import DEFAULT_NPROBE
+from lib.keyword_search import DEFAULT_BOOLEAN_MODE
+from lib.hybrid_search import RRF_CANDIDATE_MULTIPLIER, RRF_K, WEIGHTED_CANDIDATE_MULTIPLIER, HybridSearch
+from lib.doc_store import StoredMovie
+from lib.encoders import DEFAULT_ENCODER_BACKEND, set_torch_threads
+from lib.memory import process_memory
+from lib.movie import iter_movies
+from lib.query_cache import DEFAULT_QUERY_CACHE_SIZE, DEFAULT_RESULT_CACHE_SIZE, LRUCache, QueryEmbeddingCache
+from lib.search_client import DEFAULT_SOCKET_PATH
+from lib.semantic_search import SemanticSearch
+
+
+def movie_result(m: StoredMovie, score: float) -> Dict[str, Any]:
+    return {"id": m.id, "title": m.title, "description": m.description, "score": score}
+
+
+class MicroBatcher:
+    # Queues query encodes and runs everything that arrived within `max_wait`
+    # seconds of the first request (up to `max_batch`) as one model.encode
+    # call on the inference thread pool. Requests that arrive while a batch
+    # is encoding are picked up by the next one.
+    def __init__(self, model, executor: ThreadPoolExecutor, max_batch: int = 32, max_wait: float = 0.005) -> None:
+        self.model = model
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue[Tuple[str, asyncio.Future]] = asyncio.Queue()
+
+    async def encode(self, text: str) -> np.ndarray:
+        if not text.strip():
+            raise ValueError("Query must not be empty")
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(self.executor, self.model.encode, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+
+class SearchServer:
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        max_batch: int = 32,
+        max_wait: float = 0.005,
+        workers: int = 4,
+        query_cache_size: int = DEFAULT_QUERY_CACHE_SIZE,
+        result_cache_size: int = DEFAULT_RESULT_CACHE_SIZE,
+        cache_ttl: float | None = None,
+        backend: str = DEFAULT_ENCODER_BACKEND,
+        encoder_path: str | None = None,
+        threads: int | None = None,
+        processes: int = 1,
+    ) -> None:
+        if processes < 1:
+            raise ValueError("A server needs at least one process")
+        if processes > 1 and threads is None:
+            # The workers encode at the same time; they split the cores.
+            threads = max(1, (os.cpu_count() or 1) // processes)
+
+        self.socket_path = socket_path
+        self.processes = processes
+        self.threads = threads
+        self.backend = backend
+        # Thread pools don't survive a fork: a torch (OpenMP) or onnxruntime
+        # model that has encoded with several threads hangs in a forked
+        # worker. With several processes the model is loaded here
+        # single-threaded, so the workers can share its weights, and each
+        # worker raises the cap to `threads` (see `_run_worker`).
+        load_threads = threads if processes == 1 else 1
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.query_cache = QueryEmbeddingCache(query_cache_size, cache_ttl)
+        self.query_cache.load()
+        self.result_cache = LRUCache(result_cache_size, cache_ttl)
+
+        # Opens the saved caches; hybrid_search_cli.py sync updates them to
+        # the movies file.
+        self.hybrid = HybridSearch(
+            query_cache=self.query_cache, backend=backend, encoder_path=encoder_path, threads=load_threads
+        )
+        self.chunked = self.hybrid.semantic_search
+        self.index = self.hybrid.idx
+        # Shares the already loaded model instead of loading a second copy.
+        self.semantic = SemanticSearch(
+            model=self.chunked.model,
+            query_cache=self.query_cache,
+            docs=self.hybrid.docs,
+            backend=backend,
+            encoder_path=encoder_path,
+            threads=load_threads,
+        )
+        self.semantic.load_or_create_embeddings(iter_movies())
+
+        self.inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.search_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search")
+
+    async def _run(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.search_executor, fn, *args)
+
+    async def encode(self, query: str) -> np.ndarray:
+        key = (self.chunked.encoder_id, query)
+        embedding = self.query_cache.get(key)
+        if embedding is None:
+            embedding = await self.batcher.encode(query)
+            self.query_cache.put(key, embedding)
+        return embedding
+
+    def version(self, op: str | None) -> str:
+        match op:
+            case "keyword" | "boolean":
+                return self.index.version()
+            case "semantic":
+                return self.semantic.version()
+            case "chunked":
+                return self.chunked.version()
+            case _:
+                return self.hybrid.version()
+
+    async def handle_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        op = request.get("op")
+        if op == "stats":
+            return {
+                "results": {
+                    "query_cache": self.query_cache.stats(),
+                    "result_cache": self.result_cache.stats(),
+                    # Of the process that answered; with several processes
+                    # each worker has its own caches too.
+                    "process": {"pid": os.getpid(), "processes": self.processes, "memory_mb": process_memory()},
+                }
+            }
+
+        # Same request against the same index and embedding files, same
+        # response.
+        key = (json.dumps(request, sort_keys=True), self.version(op))
+        response = self.result_cache.get(key)
+        if response is None:
+            response = await self.search(request)
+            self.result_cache.put(key, response)
+        return response
+
+    async def search(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        op = request.get("op")
+        query = request.get("query", "")
+        limit = int(request.get("limit", 5))
+
+        match op:
+            case "keyword":
+                items = await self._run(self.index.bm25_search, query, limit)
+                return {"results": [movie_result(m, score) for m, score in items]}
+            case "boolean":
+                mode = request.get("mode", DEFAULT_BOOLEAN_MODE)
+                items = await self._run(self.index.boolean_search, query, limit, mode)
+                return {"results": [movie_result(m, score) for m, score in items]}
+            case "semantic":
+                q_embed = await self.encode(query)
+                items = await self._run(self.semantic.search_embedding, q_embed, limit)
+                return {"results": [movie_result(m, score) for score, m in items]}
+            case "chunked":
+                q_embed = await self.encode(query)
+                ann = bool(request.get("ann", False))
+                nprobe = int(request.get("nprobe", DEFAULT_NPROBE))
+                results = await self._run(self.chunked.search_chunks_embedding, q_embed, limit, ann, nprobe)
+                return {"results": results}
+            case "weighted":
+                alpha = float(request.get("alpha", 0.5))
+                depth = request.get("candidates") or limit * WEIGHTED_CANDIDATE_MULTIPLIER
+                if alpha >= 1:
+                    bm25, semantic = await self._run(self.index.bm25_search, query, depth), []
+                else:
+                    q_embed = await self.encode(query)
+                    bm25, semantic = await asyncio.gather(
+                        self._run(self.index.bm25_search, query, depth),
+                        self._run(self.chunked.search_chunks_embedding, q_embed, depth),
+                    )
+                results = await self._run(self.hybrid.weighted_fusion, bm25, semantic, alpha, limit)
+                return {"results": results}
+            case "rrf":
+                k = float(request.get("k", RRF_K))
+                depth = request.get("candidates") or limit * RRF_CANDIDATE_MULTIPLIER
+                q_embed = await self.encode(query)
+                bm25, semantic = await asyncio.gather(
+                    self._run(self.index.bm25_search, query, depth),
+                    self._run(self.chunked.search_chunks_embedding, q_embed, depth),
+                )
+                results = await self._run(self.hybrid.rrf_fusion, bm25, semantic, k, limit)
+                return {"results": results}
+            case _:
+                raise ValueError(f"Unknown op: {op}")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    response = await self.handle_request(json.loads(line))
+                except Exception as e:
+                    response = {"error": str(e)}
+
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, sock: socket.socket | None = None) -> None:
+        # With `sock`, serves on a socket that is already listening: a
+        # worker of `serve_processes`, whose parent owns the socket file.
+        self.batcher = MicroBatcher(self.chunked.model, self.inference_executor, self.max_batch, self.max_wait)
+        batcher_task = asyncio.create_task(self.batcher.run())
+
+        if sock is None:
+            # A socket left behind by a server that was killed.
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            server = await asyncio.start_unix_server(self.handle_connection, path=self.socket_path)
+        else:
+            server = await asyncio.start_unix_server(self.handle_connection, sock=sock)
+        # Stop on SIGTERM the same way as on Ctrl-C, so the socket is removed.
+        main_task = asyncio.current_task()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)  # type: ignore[union-attr]
+        if sock is None:
+            print(f"Serving on {self.socket_path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            # The unix server removes its own socket file when it closes.
+            batcher_task.cancel()
+            self.query_cache.save()
+
+    def serve_processes(self) -> int:
+        # Pre-fork serving: everything is loaded here, once, then
+        # `processes` workers are forked and accept connections on the same
+        # socket. The workers share the loaded pages copy-on-write: the
+        # memory-mapped index, document store and embedding files, and the
+        # arrays and torch model weights built at startup, which nothing
+        # writes to afterwards. Returns the exit status.
+        # A socket left behind by a server that was killed.
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.listen(128)
+
+        # No thread may be running through a fork.
+        self.index.wait_for_merge()
+        if self.backend != "torch":
+            # An onnxruntime session's thread count is fixed when it is
+            # created, so each worker loads its own ONNX model.
+            self.chunked.release_model()
+            self.semantic.release_model()
+            self.chunked.threads = self.threads
+        # Objects the garbage collector never visits again keep their pages
+        # shared: a collection in a worker would otherwise write to the
+        # header of every object it scans.
+        gc.collect()
+        gc.freeze()
+
+        # Output still buffered here would be printed again by every worker.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        workers = set()
+        for _ in range(self.processes):
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker(sock)
+            workers.add(pid)
+        sock.close()
+        print(f"Serving on {self.socket_path} with {self.processes} processes")
+
+        stopping = False
+
+        def stop(signum=None, frame=None) -> None:
+            nonlocal stopping
+            stopping = True
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        status = 0
+        try:
+            while workers:
+                pid, wait_status = os.wait()
+                workers.discard(pid)
+                if not stopping:
+                    # Serving on with fewer workers would hide the failure.
+                    print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(wait_status)}, stopping", file=sys.stderr)
+                    status = 1
+                    stop()
+        finally:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        return status
+
+    def _run_worker(self, sock: socket.socket) -> None:
+        # Ctrl-C reaches the whole process group; the parent turns it into
+        # a SIGTERM for every worker, so the workers leave SIGINT alone.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        status = 0
+        try:
+            if self.backend == "torch":
+                set_torch_threads(self.threads)  # type: ignore[arg-type]
+            else:
+                self.semantic.share_model(self.chunked)
+            # Starts this worker's encode threads (and loads its ONNX model)
+            # before the first query rather than during it.
+            self.chunked.model.encode(["warm up"])
+            asyncio.run(self.serve(sock))
+        except asyncio.CancelledError:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Never returns into the parent's code.
+        os._exit(status)
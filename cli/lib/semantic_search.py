@@ -1,13 +1,29 @@
+import itertools
 import os
 import re
-import json
-from typing import Any, Dict, List, Tuple, TypedDict
-from sentence_transformers import SentenceTransformer
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, TypedDict
 import numpy as np
 
-from lib.movie import Movie, load_movies
+from lib.ann_index import DEFAULT_NPROBE, IVFIndex
+from lib.chunk_metadata import ChunkMetadata
+from lib.doc_store import DOC_STORE_BATCH_SIZE, SNIPPET_LENGTH, DocStore, StoredMovie
+from lib.embedding_store import EmbeddingStore
+from lib.encoders import DEFAULT_ENCODER_BACKEND, DEFAULT_MODEL_NAME, check_backend, encoder_id, load_encoder
+from lib.quantization import PRECISIONS, QuantizedMatrix, quantized_path
+from lib.movie import Movie, iter_movies
+from lib.query_cache import LRUCache, QueryEmbeddingCache, file_stamp
+from lib.tracing import span
 
 SCORE_PRECISION = 4
+CHUNK_SIZE = 4
+CHUNK_OVERLAP = 1
+# Upper bound on the query-by-document score matrix materialized at once
+# by the batch searches.
+SCORE_BLOCK_ELEMENTS = 1 << 24
+# With a quantized store, this many candidates from the first pass are
+# re-scored against the float32 embeddings.
+RESCORE_CANDIDATES = 256
+DOC_IDS_VERSION = 1
 
 class SemanticSearchResult(TypedDict):
     id: int
@@ -17,98 +33,349 @@ class SemanticSearchResult(TypedDict):
     metadata: Dict[str, Any]
 
 class SemanticSearch:
-    def __init__(self, model_name:str = "all-MiniLM-L6-v2") -> None:
-        self.model = SentenceTransformer(model_name)
+    def __init__(
+        self,
+        model_name:str = DEFAULT_MODEL_NAME,
+        model=None,
+        precision: str = "float32",
+        query_cache: QueryEmbeddingCache | None = None,
+        result_cache: LRUCache | None = None,
+        docs: DocStore | None = None,
+        backend: str = DEFAULT_ENCODER_BACKEND,
+        encoder_path: str | None = None,
+        threads: int | None = None,
+    ) -> None:
+        if precision not in PRECISIONS:
+            raise ValueError(f"Precision must be one of {', '.join(PRECISIONS)}")
+        check_backend(backend)
+
+        self.model_name = model_name
+        # See lib/encoders.py. A `model` passed in is taken to be one of
+        # `backend`'s.
+        self.backend = backend
+        self.encoder_path = encoder_path
+        self.threads = threads
+        # Key of this encoder's vectors in the embedding and query caches.
+        self.encoder_id = encoder_id(model_name, backend)
+        # Loaded on first use: a search whose embeddings and query are
+        # cached never imports sentence-transformers (and torch).
+        self._model = model
+        self.precision = precision
         self.embeddings = None
-        self.documents = None
-        self.document_map:Dict[int, Movie] = {}
+        self.encoded_count = 0
+        self.encode_seconds = 0.0
+        # With a float16/int8 precision, the first scoring pass runs on
+        # `quantized` and `full_embeddings` is the memory-mapped float32 file.
+        self.quantized: QuantizedMatrix | None = None
+        self.full_embeddings: np.ndarray | None = None
         self.cache_path = os.path.join(os.getcwd(), "cache")
+        # Movie id of every embedding row; the movies themselves are read
+        # from `docs` for the results only.
+        self.doc_ids = np.empty(0, dtype=np.int64)
+        self.docs = docs if docs is not None else DocStore(os.path.join(self.cache_path, "docstore"))
         self.embeddings_cache_path = os.path.join(
             self.cache_path, "movie_embeddings.npy"
         )
+        self.doc_ids_cache_path = os.path.join(
+            self.cache_path, "movie_embeddings_doc_ids.npz"
+        )
+        # Query text -> embedding, and (query, parameters, version) ->
+        # results. The version changes when the embeddings are rebuilt, here
+        # or by another process, so stale results are never returned.
+        self.query_cache = query_cache
+        self.result_cache = result_cache
+        self.generation = 0
+
+    @property
+    def model(self):
+        if self._model is None:
+            with span("semantic.model_load"):
+                self._model = load_encoder(self.model_name, self.backend, self.encoder_path, self.threads)
+        return self._model
+
+    def release_model(self) -> None:
+        # The next encode loads the model again.
+        self._model = None
+
+    def share_model(self, other: "SemanticSearch") -> None:
+        # Encodes with `other`'s model, loading it if needed, instead of a
+        # copy of its own.
+        self._model = other.model
 
     def generate_embedding(self, text: str):
         if not text.strip():
             raise ValueError("Query must not be empty")
 
-        embedding = self.model.encode([text])
-        return embedding[0]
-
-    def build_embeddings(self, documents: List[Movie]):
-        self.documents = documents
-        data = []
-        for doc in documents:
-            self.document_map[doc.id] = doc
-            data.append(f"{doc.title}: {doc.description}")
-
-        x = self.model.encode(data, show_progress_bar=True)
-        self.embeddings = x
-        with open(self.embeddings_cache_path, "wb") as f:
-            np.save(f, self.embeddings)
-
-        return self.embeddings
-        # print(documents)
-
-    def load_or_create_embeddings(self, documents: List[Movie]): 
-        self.documents = documents
-        for doc in documents:
-            self.document_map[doc.id] = doc
-        
-        if os.path.exists(self.embeddings_cache_path):
-            print("Loading cache...")
-            with open(self.embeddings_cache_path, "rb") as f:
-                self.embeddings = np.load(f)
-
-            if len(self.embeddings) == len(self.documents):
-                print("Cache matched")
-                return self.embeddings
-
-        print("Cache not matched. Rebuilding embeddings...")
-        return self.build_embeddings(documents)
-
-    def search(self, query, limit) -> List[Tuple[float, Movie]]:
-        if self.embeddings is None:
+        if self.query_cache is not None:
+            key = (self.encoder_id, text)
+            embedding = self.query_cache.get(key)
+            if embedding is not None:
+                return embedding
+
+        with span("encode_query"):
+            embedding = self.model.encode([text])[0]
+        if self.query_cache is not None:
+            self.query_cache.put(key, embedding)
+        return embedding
+
+    def generate_embeddings(self, texts: List[str]) -> np.ndarray:
+        if any(not text.strip() for text in texts):
+            raise ValueError("Query must not be empty")
+
+        if self.query_cache is None:
+            with span("encode_queries"):
+                return self.model.encode(texts)
+
+        # Only the queries that are not cached go to the model, in one call.
+        cached = [self.query_cache.get((self.encoder_id, t)) for t in texts]
+        missing = list(dict.fromkeys(t for t, e in zip(texts, cached) if e is None))
+        encoded: Dict[str, np.ndarray] = {}
+        if missing:
+            with span("encode_queries"):
+                encoded = dict(zip(missing, self.model.encode(missing)))
+            for t, e in encoded.items():
+                self.query_cache.put((self.encoder_id, t), e)
+        return np.stack([e if e is not None else encoded[t] for t, e in zip(texts, cached)])
+
+    def version(self) -> str:
+        return f"{self.generation}:{file_stamp(self.embeddings_cache_path)}"
+
+    def _cached_results(self, key: Tuple, compute: Callable[[], Any]) -> Any:
+        if self.result_cache is None:
+            return compute()
+        return self.result_cache.get_or_compute(key + (self.precision, self.version()), compute)
+
+    def _encode_documents(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, show_progress_bar=True)
+
+    def _store_documents(self, documents: Iterable[Movie], doc_ids: List[int]) -> Iterator[Movie]:
+        # Passes `documents` through, writing them to the DocStore and their
+        # ids to `doc_ids` a batch at a time.
+        for batch in itertools.batched(documents, DOC_STORE_BATCH_SIZE):
+            self.docs.update(batch)
+            doc_ids.extend(m.id for m in batch)
+            yield from batch
+
+    def _results(self, rows: List[int], scores: List[float]) -> List[Tuple[float, StoredMovie]]:
+        return list(zip(scores, self.docs.get_many(self.doc_ids[rows].tolist())))
+
+    def _docs_stored(self, doc_ids: np.ndarray) -> bool:
+        return bool(np.all(self.docs.latest_rows(doc_ids) >= 0))
+
+    def _movie_store(self) -> EmbeddingStore:
+        return EmbeddingStore(self.embeddings_cache_path, self.encoder_id, {"text": "title: description"})
+
+    def build_embeddings(self, documents: Iterable[Movie]):
+        # Streams `documents` into the DocStore and the embeddings, which
+        # are then current with them.
+        doc_ids: List[int] = []
+
+        def texts() -> Iterator[str]:
+            for doc in self._store_documents(documents, doc_ids):
+                yield f"{doc.title}: {doc.description}"
+
+        # Only documents whose text changed since the last build are encoded,
+        # a batch at a time as they stream in.
+        store = self._movie_store()
+        x, _ = store.load_or_encode(texts(), self._encode_documents)
+        self.doc_ids = np.array(doc_ids, dtype=np.int64)
+        save_doc_ids(self.doc_ids_cache_path, self.doc_ids, store.fingerprint())
+        self.encoded_count, self.encode_seconds = store.encoded, store.encode_seconds
+        return self._set_embeddings(x, store.fingerprint())
+
+    def load_embeddings(self) -> bool:
+        # Opens the saved embeddings and the movie id of every row without
+        # reading the movies. False when they are missing, or stale: of
+        # another encoder, or not saved together.
+        store = self._movie_store()
+        x = store.load()
+        if x is None:
+            return False
+        doc_ids = load_doc_ids(self.doc_ids_cache_path, store.fingerprint())
+        if doc_ids is None or len(doc_ids) != len(x) or not self._docs_stored(doc_ids):
+            return False
+
+        self.doc_ids = doc_ids
+        self.encoded_count, self.encode_seconds = 0, 0.0
+        self._set_embeddings(x, store.fingerprint())
+        return True
+
+    def _set_embeddings(self, x: np.ndarray, fingerprint: str) -> np.ndarray:
+        self.generation += 1
+        if self.precision == "float32":
+            self.embeddings = l2_normalize(x)
+            return self.embeddings
+
+        self.full_embeddings = x
+        self.quantized = self._quantize(self.full_embeddings, fingerprint, self.embeddings_cache_path)
+        return self.full_embeddings
+
+    def _quantize(self, x: np.ndarray, fingerprint: str, embeddings_path: str) -> QuantizedMatrix:
+        # Reuses the cached quantized matrix while the rows it was built
+        # from are unchanged.
+        path = quantized_path(embeddings_path, self.precision)
+        if os.path.exists(path):
+            quantized = QuantizedMatrix.load(path)
+            if quantized.fingerprint == fingerprint and quantized.precision == self.precision:
+                return quantized
+
+        quantized = QuantizedMatrix.from_matrix(l2_normalize(x), self.precision, fingerprint)
+        quantized.save(path)
+        return quantized
+
+    def _check_embeddings(self) -> None:
+        if self.embeddings is None and self.quantized is None:
             raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
 
-        q_embed = self.generate_embedding(query)
-        scores: List[float] = []
-        for e in self.embeddings:
-            score = cosine_similarity(q_embed, e)
-            scores.append(score)
-        
-        x: List[Tuple[float, Movie]] = list(zip(scores, self.documents)) # type: ignore
-        result = sorted(x, key=lambda item: item[0], reverse=True)
-        return result[:limit]
+    def load_or_create_embeddings(self, documents: Iterable[Movie]):
+        # `documents` are only read when the saved embeddings can't be used;
+        # `build_embeddings` picks up changes to them.
+        with span("semantic.load_embeddings"):
+            if self.load_embeddings():
+                return self.embeddings if self.embeddings is not None else self.full_embeddings
+            return self.build_embeddings(documents)
+
+    def search(self, query, limit) -> List[Tuple[float, StoredMovie]]:
+        with span("semantic.search"):
+            return self._cached_results(
+                ("semantic", query, limit), lambda: self.search_embedding(self.generate_embedding(query), limit)
+            )
+
+    def search_embedding(self, q_embed: np.ndarray, limit: int) -> List[Tuple[float, StoredMovie]]:
+        self._check_embeddings()
+        q_embed = l2_normalize(q_embed)
+        if self.quantized is not None:
+            with span("score"):
+                approx = self.quantized.scores(q_embed)
+            with span("rescore"):
+                top, scores = rescore(q_embed, approx, self.full_embeddings, limit)  # type: ignore[arg-type]
+            with span("results"):
+                return self._results(top.tolist(), scores.tolist())
+
+        # Rows are unit length, so one matrix-vector product gives every
+        # document's cosine similarity.
+        with span("score"):
+            scores = self.embeddings @ q_embed
+        with span("top_k"):
+            top = top_k_indices(scores, limit)
+        with span("results"):
+            return self._results(top.tolist(), scores[top].tolist())
+
+    def search_batch(self, queries: List[str], limit: int) -> List[List[Tuple[float, StoredMovie]]]:
+        with span("semantic.search_batch"):
+            return self._search_batch(queries, limit)
+
+    def _search_batch(self, queries: List[str], limit: int) -> List[List[Tuple[float, StoredMovie]]]:
+        self._check_embeddings()
+        if not queries:
+            return []
+
+        q_embeds = l2_normalize(self.generate_embeddings(queries))
+        if self.quantized is not None:
+            quantized_results: List[List[Tuple[float, StoredMovie]]] = []
+            for q, row in zip(q_embeds, itertools.chain.from_iterable(score_blocks(q_embeds, self.quantized))):
+                top, exact = rescore(q, row, self.full_embeddings, limit)  # type: ignore[arg-type]
+                quantized_results.append(self._results(top.tolist(), exact.tolist()))
+            return quantized_results
+
+        results: List[List[Tuple[float, StoredMovie]]] = []
+        for scores in score_blocks(q_embeds, self.embeddings):
+            for row, top in zip(scores, top_k_indices(scores, limit)):
+                results.append(self._results(top.tolist(), row[top].tolist()))
+
+        return results
 
 
-def verify_model():
-    s = SemanticSearch()
-    print(f"Model loaded: {s.model}")
+# `options` are SemanticSearch arguments (precision, backend, encoder_path,
+# threads), so these check the same model a search with them uses.
+def verify_model(**options):
+    s = SemanticSearch(**options)
+    print(f"Model loaded ({s.encoder_id}): {s.model}")
     print(f"Max sequence length: {s.model.max_seq_length}")
 
 
-def embed_text(text: str):
-    s = SemanticSearch()
+def embed_text(text: str, **options):
+    s = SemanticSearch(**options)
     embedding = s.generate_embedding(text)
     print(f"Text: {text}")
     print(f"First 3 dimensions: {embedding[:3]}")
     print(f"Dimensions: {embedding.shape[0]}")
 
-def verify_embeddings():
-    s = SemanticSearch()
-    movies = load_movies()
-    embeddings = s.load_or_create_embeddings(movies)
+def verify_embeddings(**options):
+    s = SemanticSearch(**options)
+    embeddings = s.build_embeddings(iter_movies())
     
-    print(f"Number of docs:   {len(movies)}")
+    print(f"Number of docs:   {len(s.doc_ids)}")
     print(f"Embeddings shape: {embeddings.shape[0]} vectors in {embeddings.shape[1]} dimensions")
 
-def embed_query_text(query):
-    s = SemanticSearch()
+def embed_query_text(query, **options):
+    s = SemanticSearch(**options)
     embedding = s.generate_embedding(query)
     print(f"Query: {query}")
     print(f"First 5 dimensions: {embedding[:5]}")
     print(f"Shape: {embedding.shape}")
 
+def save_doc_ids(path: str, doc_ids: np.ndarray, fingerprint: str) -> None:
+    # The movie ids a build of the embeddings identified by `fingerprint`
+    # read, in order; rewritten only when they changed.
+    saved = load_doc_ids(path, fingerprint)
+    if saved is not None and np.array_equal(saved, doc_ids):
+        return
+    with open(f"{path}.tmp", "wb") as f:
+        np.savez(f, version=DOC_IDS_VERSION, fingerprint=fingerprint, doc_ids=doc_ids)
+    os.replace(f"{path}.tmp", path)
+
+def load_doc_ids(path: str, fingerprint: str) -> np.ndarray | None:
+    # None when there is no file, it is of another version or it was saved
+    # with other embeddings.
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if int(data["version"]) != DOC_IDS_VERSION or str(data["fingerprint"]) != fingerprint:
+            return None
+        return data["doc_ids"].astype(np.int64)
+
+def l2_normalize(x: np.ndarray) -> np.ndarray:
+    # Works on a single vector or row-wise on a matrix; zero vectors stay
+    # zero, matching cosine_similarity's 0.0 for them. Memory-mapped input
+    # comes back as a plain in-memory array.
+    x = np.asarray(x)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return np.divide(x, norms, out=np.zeros_like(x), where=norms != 0)
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    # Indices of the k highest scores along the last axis, best first, ties
+    # in index order. Works on one score vector or a matrix of them.
+    n = scores.shape[-1]
+    k = max(0, min(k, n))
+    if k < n:
+        idx = np.argpartition(-scores, max(k - 1, 0), axis=-1)[..., :k]
+    else:
+        idx = np.broadcast_to(np.arange(n), scores.shape).copy()
+
+    top = np.take_along_axis(scores, idx, axis=-1)
+    order = np.lexsort((idx, -top), axis=-1)
+    return np.take_along_axis(idx, order, axis=-1)
+
+def score_blocks(queries: np.ndarray, matrix: np.ndarray | QuantizedMatrix) -> Iterator[np.ndarray]:
+    # Query-by-row score matrices, a block of queries at a time.
+    step = max(1, SCORE_BLOCK_ELEMENTS // max(1, len(matrix)))
+    for start in range(0, len(queries), step):
+        if isinstance(matrix, QuantizedMatrix):
+            yield matrix.scores(queries[start:start + step])
+        else:
+            yield queries[start:start + step] @ matrix.T
+
+def rescore(q: np.ndarray, approx_scores: np.ndarray, full_embeddings: np.ndarray, limit: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Re-scores the best RESCORE_CANDIDATES rows of a quantized first pass
+    # against the float32 rows and returns the top `limit` indices and
+    # their exact scores. Candidates are kept in index order so ties break
+    # the same way as a full exact scan.
+    candidates = np.sort(top_k_indices(approx_scores, max(limit, RESCORE_CANDIDATES)))
+    exact = l2_normalize(full_embeddings[candidates]) @ q
+    top = top_k_indices(exact, limit)
+    return candidates[top], exact[top]
+
 def cosine_similarity(vec1, vec2):
     dot_product = np.dot(vec1, vec2)
     norm1 = np.linalg.norm(vec1)
@@ -140,108 +407,301 @@ def chunk_semantically(text:str, chunk_size: int, overlap: int) -> List[str]:
 
 
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self, model_name = 'all-MiniLM-L6-v2') -> None:
-        super().__init__(model_name)
+    def __init__(
+        self,
+        model_name = DEFAULT_MODEL_NAME,
+        model=None,
+        precision: str = "float32",
+        query_cache: QueryEmbeddingCache | None = None,
+        result_cache: LRUCache | None = None,
+        docs: DocStore | None = None,
+        backend: str = DEFAULT_ENCODER_BACKEND,
+        encoder_path: str | None = None,
+        threads: int | None = None,
+    ) -> None:
+        super().__init__(model_name, model, precision, query_cache, result_cache, docs, backend, encoder_path, threads)
         self.chunk_embeddings = None
-        self.chunk_metadata = None
+        self.chunk_quantized: QuantizedMatrix | None = None
+        self.chunk_full: np.ndarray | None = None
+        self.chunk_metadata: ChunkMetadata | None = None
+        self.chunk_movie_idx = None
+        self.chunk_group_starts = None
+        self.chunk_group_movies = None
+        self.chunk_group = None
+        self.chunk_fingerprint = None
+        self.ann_index: IVFIndex | None = None
         self.embeddings_cache_path = os.path.join(
             self.cache_path, "chunk_embeddings.npy"
         )
         self.metadata_cache_path = os.path.join(
+            self.cache_path, "chunk_metadata.npz"
+        )
+        self.doc_ids_cache_path = os.path.join(
+            self.cache_path, "chunk_embeddings_doc_ids.npz"
+        )
+        # Written by `export_chunk_metadata` only, for debugging.
+        self.metadata_json_path = os.path.join(
             self.cache_path, "chunk_metadata.json"
         )
+        self.ann_cache_path = os.path.join(
+            self.cache_path, "chunk_embeddings_ivf.npz"
+        )
 
-    def build_chunk_embeddings(self, documents:List[Movie]):
-        self.documents = documents
-        all_chunks:List[str] = []
-        metadata:List[Dict] = []
-        for movie_idx, doc in enumerate(documents):
-            self.document_map[doc.id] = doc
-            if doc.description == "":
-                continue
-
-            chunks = chunk_semantically(doc.description, 4, 1)
-            all_chunks.extend(chunks)
-            for chunk_idx, _ in enumerate(chunks):
-                meta = {"movie_idx": movie_idx, "chunk_idx": chunk_idx, "total_chunks": len(chunks)}
-                metadata.append(meta)
-
-        self.chunk_embeddings = self.model.encode(all_chunks, show_progress_bar=True)
+    def build_chunk_embeddings(self, documents: Iterable[Movie]):
+        # Streams `documents` into the DocStore and the chunk embeddings,
+        # which are then current with them.
+        doc_ids: List[int] = []
+        # Chunks per movie; the per-chunk metadata is derived from these.
+        chunk_counts: List[int] = []
+
+        def chunk_texts() -> Iterator[str]:
+            for doc in self._store_documents(documents, doc_ids):
+                if doc.description == "":
+                    chunk_counts.append(0)
+                    continue
+
+                chunks = chunk_semantically(doc.description, CHUNK_SIZE, CHUNK_OVERLAP)
+                chunk_counts.append(len(chunks))
+                yield from chunks
+
+        # Only new or edited chunks are encoded; the store drops the rows of
+        # chunks that no longer exist.
+        store = self._chunk_store()
+        chunk_embeddings, changed = store.load_or_encode(chunk_texts(), self._encode_documents)
+        self.doc_ids = np.array(doc_ids, dtype=np.int64)
+        self.encoded_count, self.encode_seconds = store.encoded, store.encode_seconds
+        self.chunk_fingerprint = store.fingerprint()
+        save_doc_ids(self.doc_ids_cache_path, self.doc_ids, self.chunk_fingerprint)
+
+        metadata = ChunkMetadata.from_chunk_counts(chunk_counts, self.chunk_fingerprint)
+        # Also rewritten when the saved metadata is of other embeddings
+        # (say, left by an interrupted build) or of another version.
+        if changed or ChunkMetadata.saved_fingerprint(self.metadata_cache_path) != self.chunk_fingerprint:
+            metadata.save(self.metadata_cache_path)
+            # An export of the metadata this replaces would be stale.
+            if os.path.exists(self.metadata_json_path):
+                os.remove(self.metadata_json_path)
+
+        self._set_chunks(chunk_embeddings, metadata)
+        return self.chunk_embeddings if self.chunk_embeddings is not None else self.chunk_full
+
+    def _chunk_store(self) -> EmbeddingStore:
+        settings = {"chunker": "semantic", "chunk_size": CHUNK_SIZE, "overlap": CHUNK_OVERLAP}
+        return EmbeddingStore(self.embeddings_cache_path, self.encoder_id, settings)
+
+    def version(self) -> str:
+        return f"{self.generation}:{file_stamp(self.embeddings_cache_path, self.metadata_cache_path)}"
+
+    def _set_chunks(self, chunk_embeddings: np.ndarray, metadata: ChunkMetadata) -> None:
+        if len(metadata) != len(chunk_embeddings):
+            raise ValueError(f"Chunk metadata describes {len(metadata)} chunks, the embeddings have {len(chunk_embeddings)}")
+
+        self.generation += 1
+        movie_idx = metadata.movie_idx.astype(np.int64)
+        if np.any(movie_idx[1:] < movie_idx[:-1]):
+            # Group-max below needs each movie's chunks to be contiguous.
+            order = np.argsort(movie_idx, kind="stable")
+            chunk_embeddings = chunk_embeddings[order]
+            metadata = metadata.take(order)
+            movie_idx = movie_idx[order]
+
+        if self.precision == "float32":
+            self.chunk_embeddings = l2_normalize(chunk_embeddings)
+        else:
+            self.chunk_full = chunk_embeddings
+            self.chunk_quantized = self._quantize(chunk_embeddings, self.chunk_fingerprint or "", self.embeddings_cache_path)
         self.chunk_metadata = metadata
+        self.chunk_movie_idx = movie_idx
+        self.chunk_group_starts = np.flatnonzero(np.diff(movie_idx, prepend=-1))
+        self.chunk_group_movies = movie_idx[self.chunk_group_starts]
+        self.chunk_group = np.cumsum(np.diff(movie_idx, prepend=-1) != 0) - 1
+        self.ann_index = None
+
+    def load_chunk_embeddings(self) -> bool:
+        # Opens the saved chunk embeddings, their metadata and the movie ids
+        # without reading the movies. False when any of them is missing or
+        # they were not saved together.
+        store = self._chunk_store()
+        chunk_embeddings = store.load()
+        if chunk_embeddings is None:
+            return False
+        fingerprint = store.fingerprint()
+        doc_ids = load_doc_ids(self.doc_ids_cache_path, fingerprint)
+        if doc_ids is None or ChunkMetadata.saved_fingerprint(self.metadata_cache_path) != fingerprint:
+            return False
+        metadata = ChunkMetadata.load(self.metadata_cache_path, len(chunk_embeddings), fingerprint)
+        if (len(metadata) and int(metadata.movie_idx.max()) >= len(doc_ids)) or not self._docs_stored(doc_ids):
+            return False
+
+        self.doc_ids = doc_ids
+        self.encoded_count, self.encode_seconds = 0, 0.0
+        self.chunk_fingerprint = fingerprint
+        self._set_chunks(chunk_embeddings, metadata)
+        return True
+
+    def load_or_create_chunk_embeddings(self, documents: Iterable[Movie]) -> np.ndarray:
+        # `documents` are only read when the saved embeddings can't be used;
+        # `build_chunk_embeddings` picks up changes to them.
+        with span("chunked.load_embeddings"):
+            if not self.load_chunk_embeddings():
+                self.build_chunk_embeddings(documents)
+            return self.chunk_embeddings if self.chunk_embeddings is not None else self.chunk_full
+
+    def export_chunk_metadata(self, path: str | None = None) -> ChunkMetadata:
+        # Writes the saved chunk metadata as JSON, checked against the saved
+        # chunk embeddings; needs neither the model nor the movies.
+        if not ChunkMetadata.exists(self.metadata_cache_path):
+            raise FileNotFoundError(f"{self.metadata_cache_path} doesn't exist, run embed_chunks first")
+
+        rows = len(np.load(self.embeddings_cache_path, mmap_mode="r"))
+        metadata = ChunkMetadata.load(self.metadata_cache_path, rows, self._chunk_store().stored_fingerprint())
+        metadata.export_json(path or self.metadata_json_path)
+        return metadata
+
+    def load_or_build_ann_index(self, n_lists: int | None = None) -> IVFIndex:
+        # The IVF index is rebuilt whenever the chunk embeddings it was built
+        # from change.
+        self._check_chunks()
+        if self.ann_index is not None and (n_lists is None or self.ann_index.n_lists == n_lists):
+            return self.ann_index
+
+        if IVFIndex.exists(self.ann_cache_path):
+            ann_index = IVFIndex.load(self.ann_cache_path)
+            if ann_index.fingerprint == self.chunk_fingerprint and (n_lists is None or ann_index.n_lists == n_lists):
+                self.ann_index = ann_index
+                return ann_index
+
+        print("Building IVF index...")
+        embeddings = self.chunk_embeddings
+        if embeddings is None:
+            embeddings = l2_normalize(self.chunk_full)
+        with span("chunked.build_ann_index"):
+            self.ann_index = IVFIndex.build(embeddings, self.chunk_fingerprint or "", n_lists)
+            self.ann_index.save(self.ann_cache_path)
+        return self.ann_index
+
+    def search_chunks(self, query:str, limit:int = 10, ann: bool = False, nprobe: int = DEFAULT_NPROBE):
+        with span("chunked.search"):
+            return self._cached_results(
+                ("chunked", query, limit, ann, nprobe),
+                lambda: self.search_chunks_embedding(self.generate_embedding(query), limit, ann, nprobe),
+            )
+
+    def search_chunks_embedding(
+        self, q_embed: np.ndarray, limit: int = 10, ann: bool = False, nprobe: int = DEFAULT_NPROBE
+    ) -> List[SemanticSearchResult]:
+        self._check_chunks()
+        if not len(self.chunk_metadata):  # type: ignore[arg-type]
+            # Nothing to score, and no ANN index to build.
+            return []
+
+        q = l2_normalize(q_embed)
+        if ann:
+            return self._search_chunks_ann(q, limit, nprobe)
+
+        if self.chunk_quantized is not None:
+            with span("score"):
+                approx = self._group_max(self.chunk_quantized.scores(q))
+            return self._rescore_chunks(q, approx, limit)
+
+        with span("score"):
+            movie_scores = self._group_max(self.chunk_embeddings @ q)
+        with span("top_k"):
+            top = top_k_indices(movie_scores, limit)
+        return self._chunk_results(top, movie_scores[top])
+
+    def _check_chunks(self) -> None:
+        if (self.chunk_embeddings is None and self.chunk_quantized is None) or self.chunk_metadata is None:
+            raise ValueError("Embeddings are not loaded. Load or build embeddings first")
 
+    def _chunk_scores(self, ids: np.ndarray, q: np.ndarray) -> np.ndarray:
+        # Full-precision scores of the chunks `ids`.
+        if self.chunk_embeddings is not None:
+            return self.chunk_embeddings[ids] @ q
+
+        return l2_normalize(self.chunk_full[ids]) @ q  # type: ignore[index]
+
+    def _rescore_chunks(self, q: np.ndarray, approx_movie_scores: np.ndarray, limit: int) -> List[SemanticSearchResult]:
+        # Every chunk of the best RESCORE_CANDIDATES movies by quantized
+        # score is re-scored at full precision before the final top-k.
+        with span("rescore"):
+            groups = np.sort(top_k_indices(approx_movie_scores, max(limit, RESCORE_CANDIDATES)))
+            starts = self.chunk_group_starts[groups]  # type: ignore[index]
+            ends = np.append(self.chunk_group_starts, len(self.chunk_metadata))[groups + 1]  # type: ignore[arg-type]
+            lengths = ends - starts
+            offsets = np.cumsum(lengths) - lengths
+            ids = np.repeat(starts - offsets, lengths) + np.arange(int(lengths.sum()))
+            movie_scores = np.maximum.reduceat(self._chunk_scores(ids, q), offsets) if len(ids) else np.empty(0, dtype=np.float32)
+            top = top_k_indices(movie_scores, limit)
+        return self._chunk_results(groups[top], movie_scores[top])
+
+    def _search_chunks_ann(self, q: np.ndarray, limit: int, nprobe: int) -> List[SemanticSearchResult]:
+        ann_index = self.load_or_build_ann_index()
+        with span("ann_probe"):
+            ids = ann_index.candidates(q, nprobe)
+        with span("score"):
+            scores = self._chunk_scores(ids, q)
+            # Same group-max as the exact path, over the probed chunks only.
+            groups, inverse = np.unique(self.chunk_group[ids], return_inverse=True)  # type: ignore[index]
+            movie_scores = np.full(len(groups), -np.inf, dtype=scores.dtype)
+            np.maximum.at(movie_scores, inverse, scores)
+        with span("top_k"):
+            top = top_k_indices(movie_scores, limit)
+        return self._chunk_results(groups[top], movie_scores[top])
+
+    def search_chunks_batch(self, queries: List[str], limit: int = 10) -> List[List[SemanticSearchResult]]:
+        with span("chunked.search_batch"):
+            return self._search_chunks_batch(queries, limit)
+
+    def _search_chunks_batch(self, queries: List[str], limit: int) -> List[List[SemanticSearchResult]]:
+        self._check_chunks()
+        if not queries:
+            return []
+        if not len(self.chunk_metadata):  # type: ignore[arg-type]
+            return [[] for _ in queries]
+
+        q_embeds = l2_normalize(self.generate_embeddings(queries))
+        results: List[List[SemanticSearchResult]] = []
+        if self.chunk_quantized is not None:
+            for q, row in zip(q_embeds, itertools.chain.from_iterable(score_blocks(q_embeds, self.chunk_quantized))):
+                results.append(self._rescore_chunks(q, self._group_max(row), limit))
+            return results
+
+        for scores in score_blocks(q_embeds, self.chunk_embeddings):
+            movie_scores = self._group_max(scores)
+            for row, top in zip(movie_scores, top_k_indices(movie_scores, limit)):
+                results.append(self._chunk_results(top, row[top]))
 
-        with open(self.embeddings_cache_path, "wb") as f:
-            np.save(f, self.chunk_embeddings)
-
-        with open(self.metadata_cache_path, "w") as f:
-            json.dump({"chunks": metadata, "total_chunks": len(all_chunks)}, f, indent=2)
-
-        return self.chunk_embeddings
-
-    def load_or_create_chunk_embeddings(self, documents: List[Movie]) -> np.ndarray:
-        self.documents = documents
-        for doc in documents:
-            self.document_map[doc.id] = doc
-
-        
-        if os.path.exists(self.embeddings_cache_path) and os.path.exists(self.metadata_cache_path):
-            print("Loading cache...")
-            with open(self.embeddings_cache_path, "rb") as f:
-                self.chunk_embeddings = np.load(f)
-
-            with open(self.metadata_cache_path, "r") as f:
-                self.chunk_metadata = json.load(f)["chunks"]
+        return results
 
+    def _group_max(self, chunk_scores: np.ndarray) -> np.ndarray:
+        # A movie scores as its best chunk: max over each contiguous run of
+        # the movie's chunks, along the last axis.
+        if chunk_scores.shape[-1] == 0:
+            return chunk_scores
 
-            print(self.chunk_embeddings.shape[0], len(self.chunk_metadata))
-            return self.chunk_embeddings
+        return np.maximum.reduceat(chunk_scores, self.chunk_group_starts, axis=-1)
 
-        return self.build_chunk_embeddings(documents)
+    def _chunk_results(self, groups: np.ndarray, scores: np.ndarray) -> List[SemanticSearchResult]:
+        with span("results"):
+            return self.__chunk_results(groups, scores)
 
+    def __chunk_results(self, groups: np.ndarray, scores: np.ndarray) -> List[SemanticSearchResult]:
+        doc_ids = self.doc_ids[self.chunk_group_movies[groups]].tolist()
+        scores_sorted = zip(self.docs.get_many(doc_ids), scores.tolist())
 
-    def search_chunks(self, query:str, limit:int = 10):
-        if self.chunk_embeddings is None or self.chunk_metadata is None:
-            raise ValueError("Embeddings are not loaded. Load or build embeddings first")
-        q = self.generate_embedding(query)
-        chunk_scores = []
-
-        for i in range(len(self.chunk_embeddings)):
-            e = self.chunk_embeddings[i]
-            cmeta = self.chunk_metadata[i]
-            score = cosine_similarity(q, e)
-            chunk_scores.append(
-                     {
-                        "movie_idx": cmeta["movie_idx"],
-                        "chunk_idx": cmeta["chunk_idx"],
-                        "score": score
-                     })
-
-        score_map: Dict[int, float] = {}
-        for cs in chunk_scores:
-            movie_idx = cs["movie_idx"] 
-            new_score = cs["score"]
-            if movie_idx not in score_map or new_score > score_map[movie_idx]:
-                score_map[movie_idx] = new_score
-
-        scores_sorted = sorted(score_map.items(), key=lambda item: item[1], reverse=True)[:limit]
         results: List[SemanticSearchResult] = []
         for ss in scores_sorted:
-            movie_idx = ss[0]
-            doc = self.documents[movie_idx]
-            doc_id = doc.id
+            movie = ss[0]
             score = ss[1]
-            movie = self.document_map[doc_id]
-            title = movie.title
-            document = movie.description
             metadata = {}
             item: SemanticSearchResult = {
-              "id": doc_id,
-              "title": title,
-              "document": document[:100],
+              "id": movie.id,
+              "title": movie.title,
+              "document": movie.snippet(SNIPPET_LENGTH),
               "score": round(score, SCORE_PRECISION),
               "metadata": metadata or {}
             }
             results.append(item)
 
         return results
-
@@ -0,0 +1,132 @@
+import cProfile
+from contextlib import contextmanager
+import contextvars
+import functools
+import pstats
+import sys
+import threading
+import time
+from typing import IO, Callable, Dict, Iterator, List, Tuple
+
+# Functions listed by `--profile` without a file, by cumulative time.
+PROFILE_TOP = 30
+
+
+class Span:
+    # A timed stage. `path` is the names of the enclosing spans plus this
+    # one, so the same stage under different callers is kept apart.
+    __slots__ = ("name", "path", "start", "duration", "_sink", "_token")
+
+    def __init__(self, name: str, sink: Callable[["Span"], None]) -> None:
+        self.name = name
+        self._sink = sink
+
+    def __enter__(self) -> "Span":
+        self.path = _current_path.get() + (self.name,)
+        self._token = _current_path.set(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.duration = time.perf_counter() - self.start
+        _current_path.reset(self._token)
+        self._sink(self)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+
+_NOOP_SPAN = _NoopSpan()
+_current_path: contextvars.ContextVar[Tuple[str, ...]] = contextvars.ContextVar("span_path", default=())
+_sink: Callable[[Span], None] | None = None
+
+
+def span(name: str) -> Span | _NoopSpan:
+    # With no sink installed this returns a shared do-nothing context
+    # manager, so instrumented code pays one global lookup per stage.
+    if _sink is None:
+        return _NOOP_SPAN
+    return Span(name, _sink)
+
+
+def set_sink(sink: Callable[[Span], None] | None) -> None:
+    global _sink
+    _sink = sink
+
+
+def propagate(fn: Callable) -> Callable:
+    # Wraps `fn` for another thread so its spans nest under the caller's
+    # current span. A no-op while tracing is off.
+    if _sink is None:
+        return fn
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+class TimingCollector:
+    # Sink that sums the time and calls of every span path. Spans can end
+    # on several threads at once.
+    def __init__(self) -> None:
+        self.totals: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, s: Span) -> None:
+        with self._lock:
+            total = self.totals.setdefault(s.path, [0, 0.0])
+            total[0] += 1
+            total[1] += s.duration
+
+    def report(self, out: IO[str] = sys.stderr) -> None:
+        # Children are listed under their parent, in the order they first
+        # finished.
+        if not self.totals:
+            print("Trace: no spans recorded", file=out)
+            return
+
+        children: Dict[Tuple[str, ...], List[Tuple[str, ...]]] = {}
+        for path in self.totals:
+            children.setdefault(path[:-1], []).append(path)
+
+        print(f"{'stage':<48} {'calls':>7} {'total ms':>11} {'mean ms':>10}", file=out)
+
+        def walk(parent: Tuple[str, ...]) -> None:
+            for path in children.get(parent, []):
+                calls, seconds = self.totals[path]
+                label = "  " * (len(path) - 1) + path[-1]
+                print(f"{label:<48} {int(calls):>7} {seconds * 1000:>11.2f} {seconds * 1000 / calls:>10.3f}", file=out)
+                walk(path)
+
+        walk(())
+
+
+@contextmanager
+def instrument(trace: bool = False, profile: str | None = None) -> Iterator[None]:
+    # `trace` prints the span breakdown when the block ends. `profile`
+    # runs cProfile over the block; "-" prints the top functions, anything
+    # else is a file for pstats / snakeviz. cProfile only sees the calling
+    # thread.
+    collector = TimingCollector() if trace else None
+    profiler = cProfile.Profile() if profile is not None else None
+    if collector is not None:
+        set_sink(collector)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            if profile == "-":
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            else:
+                profiler.dump_stats(profile)
+                print(f"Profile written to {profile}", file=sys.stderr)
+        if collector is not None:
+            set_sink(None)
+            collector.report()
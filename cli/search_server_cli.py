@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+
+from lib.encoders import DEFAULT_ENCODER_BACKEND, ENCODER_BACKENDS
+from lib.query_cache import DEFAULT_QUERY_CACHE_SIZE, DEFAULT_RESULT_CACHE_SIZE
+from lib.search_client import DEFAULT_SOCKET_PATH
+from lib.search_server import SearchServer
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search server: keeps the model, index and embeddings loaded")
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET_PATH, help="Unix socket path to listen on")
+    parser.add_argument("--max-batch", type=int, default=32, help="Max queries encoded in one model call")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="How long to wait for more queries to batch")
+    parser.add_argument("--workers", type=int, default=4, help="Threads used for scoring")
+    parser.add_argument("--query-cache-size", type=int, default=DEFAULT_QUERY_CACHE_SIZE, help="Query embeddings kept, 0 disables")
+    parser.add_argument("--result-cache-size", type=int, default=DEFAULT_RESULT_CACHE_SIZE, help="Responses kept, 0 disables")
+    parser.add_argument("--cache-ttl", type=float, help="Seconds a cached embedding or response stays valid, forever by default")
+    parser.add_argument("--encoder", choices=ENCODER_BACKENDS, default=DEFAULT_ENCODER_BACKEND, help="Encoder backend, see semantic_search_cli.py export_encoder")
+    parser.add_argument("--encoder-path", type=str, help="Directory of the exported ONNX model, cache/encoders/<model>-onnx by default")
+    parser.add_argument("--threads", type=int, help="Threads per encode call, one per core by default, split between processes")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes forked after loading, sharing its memory")
+    args = parser.parse_args()
+
+    server = SearchServer(
+        args.socket,
+        args.max_batch,
+        args.max_wait_ms / 1000,
+        args.workers,
+        args.query_cache_size,
+        args.result_cache_size,
+        args.cache_ttl,
+        args.encoder,
+        args.encoder_path,
+        args.threads,
+        args.processes,
+    )
+    if args.processes > 1:
+        raise SystemExit(server.serve_processes())
+
+    try:
+        asyncio.run(server.serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,24 @@
+import json
+import sys
+from typing import Any, Iterator
+
 BM25_K1 = 1.5
 BM25_B = 0.75
+
+
+def read_queries(path: str) -> Iterator[str]:
+    # One query per line from `path`, or from stdin when `path` is "-".
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        for line in f:
+            query = line.strip()
+            if query:
+                yield query
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def write_jsonl(record: Any) -> None:
+    sys.stdout.write(json.dumps(record) + "\n")
+    sys.stdout.flush()
@@ -1,9 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+from contextlib import redirect_stdout
+from itertools import batched
 from json import load
 import re
-from lib.movie import load_movies
+import sys
+from search_utils import read_queries, write_jsonl
+from lib.ann_index import DEFAULT_NPROBE
+from lib.encoders import (
+    DEFAULT_ENCODER_BACKEND,
+    DEFAULT_MODEL_NAME,
+    ENCODER_BACKENDS,
+    QUANTIZATION_CONFIGS,
+    export_encoder,
+    host_quantization_config,
+)
+from lib.quantization import PRECISIONS
+from lib.movie import iter_movies
+from lib.search_client import DEFAULT_SOCKET_PATH, query_server
+from lib.query_cache import DEFAULT_QUERY_CACHE_SIZE, QueryEmbeddingCache
+from lib.tracing import instrument
 from lib.semantic_search import (
     ChunkedSemanticSearch,
     SemanticSearch,
@@ -17,6 +34,26 @@ from lib.semantic_search import (
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
+    parser.add_argument("--server", action="store_true", help="Forward searches to a running search_server_cli.py")
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET_PATH, help="Search server socket path")
+    parser.add_argument("--trace", action="store_true", help="Print a per-stage timing breakdown to stderr")
+    parser.add_argument(
+        "--query-cache-size",
+        type=int,
+        default=DEFAULT_QUERY_CACHE_SIZE,
+        help="Query embeddings kept in cache/query_embeddings.npz between runs, 0 disables",
+    )
+    parser.add_argument("--cache-ttl", type=float, help="Seconds a cached query embedding stays valid, forever by default")
+    parser.add_argument("--profile", metavar="PATH", help="Run under cProfile and write the stats to PATH, or print the top functions with -")
+    parser.add_argument(
+        "--precision",
+        choices=PRECISIONS,
+        default="float32",
+        help="Embedding precision for the first scoring pass; float16/int8 re-score the top candidates in float32",
+    )
+    parser.add_argument("--encoder", choices=ENCODER_BACKENDS, default=DEFAULT_ENCODER_BACKEND, help="Encoder backend, onnx/onnx-int8 need export_encoder first")
+    parser.add_argument("--encoder-path", type=str, help="Directory of the exported ONNX model, cache/encoders/<model>-onnx by default")
+    parser.add_argument("--threads", type=int, help="Threads per encode call, one per core by default")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     verify_cmd = subparsers.add_parser("verify")
@@ -45,25 +82,64 @@ def main():
 
     embed_chunks_cmd = subparsers.add_parser("embed_chunks")
 
+    export_chunk_metadata_cmd = subparsers.add_parser(
+        "export_chunk_metadata", help="Write the chunk metadata saved by embed_chunks as JSON, for debugging"
+    )
+    export_chunk_metadata_cmd.add_argument("--output", type=str, help="Output path, cache/chunk_metadata.json by default")
+
+    export_encoder_cmd = subparsers.add_parser("export_encoder", help="Export the model to ONNX for --encoder onnx/onnx-int8")
+    export_encoder_cmd.add_argument("--backend", choices=ENCODER_BACKENDS[1:], default="onnx-int8")
+    export_encoder_cmd.add_argument("--output", type=str, help="Output directory, cache/encoders/<model>-onnx by default")
+    export_encoder_cmd.add_argument(
+        "--quantization-config",
+        choices=QUANTIZATION_CONFIGS,
+        default=host_quantization_config(),
+        help="Instruction set the onnx-int8 weights are quantized for, this CPU's by default",
+    )
+
     search_chunked_cmd = subparsers.add_parser("search_chunked")
     search_chunked_cmd.add_argument("text", type=str)
     search_chunked_cmd.add_argument("--limit", type=int, default=5)
+    search_chunked_cmd.add_argument("--ann", action="store_true", help="Search an IVF index instead of scanning every chunk")
+    search_chunked_cmd.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE, help="IVF lists scanned per query with --ann")
 
+    batch_search_cmd = subparsers.add_parser("batch-search", help="Search many queries, one JSON line per query")
+    batch_search_cmd.add_argument("--input", type=str, default="-", help="File with one query per line, stdin by default")
+    batch_search_cmd.add_argument("--limit", type=int, default=5)
+    batch_search_cmd.add_argument("--batch-size", type=int, default=256, help="Queries encoded and scored per batch")
+    batch_search_cmd.add_argument("--chunked", action="store_true", help="Search chunk embeddings instead of whole-movie embeddings")
 
     args = parser.parse_args()
+    query_cache = QueryEmbeddingCache(args.query_cache_size, args.cache_ttl)
+    query_cache.load()
+    with instrument(args.trace, args.profile):
+        run(args, parser, query_cache)
+    query_cache.save()
+
+
+def encoder_options(args: argparse.Namespace) -> dict:
+    return {"backend": args.encoder, "encoder_path": args.encoder_path, "threads": args.threads}
+
 
+def run(args: argparse.Namespace, parser: argparse.ArgumentParser, query_cache: QueryEmbeddingCache) -> None:
     match args.command:
         case "verify":
-            verify_model()
+            verify_model(precision=args.precision, **encoder_options(args))
         case "embed_text":
-            embed_text(args.text)
+            embed_text(args.text, precision=args.precision, **encoder_options(args))
         case "verify_embeddings":
-            verify_embeddings()
+            verify_embeddings(precision=args.precision, **encoder_options(args))
         case "embedquery":
-            embed_query_text(args.query)
+            embed_query_text(args.query, precision=args.precision, **encoder_options(args))
+        case "search" if args.server:
+            results = query_server({"op": "semantic", "query": args.query, "limit": args.limit}, args.socket)
+            for i, r in enumerate(results):
+                print(f"{i+1}. {r['title']} (score: {r['score']:.4f})")
+                print(r["description"])
+                print()
         case "search":
-            s = SemanticSearch()
-            docs = load_movies()
+            s = SemanticSearch(precision=args.precision, query_cache=query_cache, **encoder_options(args))
+            docs = iter_movies()
             s.load_or_create_embeddings(docs)
             res = s.search(args.query, args.limit)
             for i, k in enumerate(res):
@@ -108,23 +184,57 @@ def main():
                 print(f"{index + 1}. {c}")
                 
         case "embed_chunks":
-            movies = load_movies()
-            cs = ChunkedSemanticSearch()
-            embeddings = cs.load_or_create_chunk_embeddings(movies)
+            movies = iter_movies()
+            cs = ChunkedSemanticSearch(precision=args.precision, query_cache=query_cache, **encoder_options(args))
+            embeddings = cs.build_chunk_embeddings(movies)
             print(f"Generated {len(embeddings)} chunked embeddings")
+            if cs.encoded_count:
+                rate = cs.encoded_count / cs.encode_seconds if cs.encode_seconds else float("inf")
+                print(f"Encoded {cs.encoded_count} chunks in {cs.encode_seconds:.2f}s ({rate:.1f} chunks/sec)")
+        case "export_chunk_metadata":
+            cs = ChunkedSemanticSearch(precision=args.precision, query_cache=query_cache, **encoder_options(args))
+            metadata = cs.export_chunk_metadata(args.output)
+            print(f"Exported metadata of {len(metadata)} chunks to {args.output or cs.metadata_json_path}")
+        case "export_encoder":
+            path = export_encoder(DEFAULT_MODEL_NAME, args.backend, args.output, args.quantization_config)
+            print(f"Exported {DEFAULT_MODEL_NAME} for --encoder {args.backend} to {path}")
+        case "search_chunked" if args.server:
+            request = {"op": "chunked", "query": args.text, "limit": args.limit, "ann": args.ann, "nprobe": args.nprobe}
+            results = query_server(request, args.socket)
+            for i, r in enumerate(results):
+                print(f"\n{i+1}. {r['title']} (score: {r['score']:.4f})")
+                print(f"   {r['document']}...")
         case "search_chunked":
-            movies = load_movies()
-            cs = ChunkedSemanticSearch()
+            movies = iter_movies()
+            cs = ChunkedSemanticSearch(precision=args.precision, query_cache=query_cache, **encoder_options(args))
             embeddings = cs.load_or_create_chunk_embeddings(movies)
             # print(len(embeddings))
             # print(cs.chunk_metadata)
-            results = cs.search_chunks(args.text, args.limit)
+            results = cs.search_chunks(args.text, args.limit, args.ann, args.nprobe)
             for i, r in enumerate(results):
                 TITLE = r.get("title")
                 SCORE = r.get("score")
                 DESCRIPTION = r.get("document")
                 print(f"\n{i+1}. {TITLE} (score: {SCORE:.4f})")
                 print(f"   {DESCRIPTION}...")
+        case "batch-search":
+            movies = iter_movies()
+            if args.chunked:
+                cs = ChunkedSemanticSearch(precision=args.precision, query_cache=query_cache, **encoder_options(args))
+                # Keep cache status messages out of the JSONL stream.
+                with redirect_stdout(sys.stderr):
+                    cs.load_or_create_chunk_embeddings(movies)
+                for queries in batched(read_queries(args.input), args.batch_size):
+                    for query, results in zip(queries, cs.search_chunks_batch(list(queries), args.limit)):
+                        write_jsonl({"query": query, "results": results})
+            else:
+                s = SemanticSearch(precision=args.precision, query_cache=query_cache, **encoder_options(args))
+                with redirect_stdout(sys.stderr):
+                    s.load_or_create_embeddings(movies)
+                for queries in batched(read_queries(args.input), args.batch_size):
+                    for query, res in zip(queries, s.search_batch(list(queries), args.limit)):
+                        results = [{"id": doc.id, "title": doc.title, "score": score} for score, doc in res]
+                        write_jsonl({"query": query, "results": results})
         case _:
             parser.print_help()
 
@@ -1,8 +1,8 @@
 from dataclasses import dataclass
+from functools import cache, lru_cache
 import json
-from typing import List
+from typing import Iterable, Iterator, List
 import string
-from nltk.stem import PorterStemmer
 from lib.movie import Movie, load_movies
 
 # @dataclass
@@ -37,14 +37,8 @@ def load_stopwords() -> List[str]:
 
 
 def remove_stopwords(tokens: List[str]) -> List[str]:
-    stopwords = load_stopwords()
-    # result = set(tokens).difference(stopwords)
-    result = []
-    for t in tokens:
-        if t in stopwords:
-            continue
-        result.append(t)
-    return list(result)
+    stopwords = get_analyzer().stopwords
+    return [t for t in tokens if t not in stopwords]
 
 
 # def stem(tokens: List[str]) -> List[str]:
@@ -52,16 +46,36 @@ def remove_stopwords(tokens: List[str]) -> List[str]:
 #     return list(map(stemmer.stem, tokens))
 
 
-def preprocess(d: str) -> List[str]:
-    # transformers = [str.lower, strip_punctuation, tokenize, remove_stopwords, stem]
+STEM_CACHE_SIZE = 1 << 16
+
+
+class Analyzer:
+    # lower -> strip punctuation -> tokenize -> remove stopwords -> stem, with
+    # the stopwords loaded once and stems memoized across calls.
+    def __init__(self, stem_cache_size: int = STEM_CACHE_SIZE) -> None:
+        # nltk takes a few hundred ms to import; only paths that tokenize
+        # pay for it.
+        from nltk.stem import PorterStemmer
+
+        self.stopwords = frozenset(load_stopwords())
+        self.stemmer = PorterStemmer()
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.stemmer.stem)
+        self.translator = str.maketrans("", "", string.punctuation)
 
-    stemmer = PorterStemmer()
-    val = d.lower()
+    def preprocess(self, d: str) -> List[str]:
+        stopwords = self.stopwords
+        stem = self.stem
+        return [stem(t) for t in d.lower().translate(self.translator).split() if t not in stopwords]
 
-    val = strip_punctuation(val)
+    def preprocess_many(self, texts: Iterable[str]) -> Iterator[List[str]]:
+        for d in texts:
+            yield self.preprocess(d)
 
-    tokens = tokenize(val)
-    no_stopwords = remove_stopwords(tokens)
-    stemmed = list(map(stemmer.stem, no_stopwords))
 
-    return stemmed
+@cache
+def get_analyzer() -> Analyzer:
+    return Analyzer()
+
+
+def preprocess(d: str) -> List[str]:
+    return get_analyzer().preprocess(d)